@@ -5,7 +5,7 @@
 """
 
 __all__ = ('INVERSE_C_MS INVERSE_C_MNS pol_names pol_to_miriad msselect_keys '
-           'datadir logger forkandlog tools').split ()
+           'datadir logger forkandlog MSChunkReader TimeBinner VisAccumulator tools').split ()
 
 
 # Some constants that can be useful
@@ -156,6 +156,376 @@ def forkandlog (function, filter='INFO5', debug=False):
         raise e
 
 
+# Streaming MeasurementSet data in chunks.
+
+_complex_items = frozenset ('data corrected_data model_data '
+                            'residual_data'.split ())
+
+class MSChunkReader (object):
+    """Stream columns of a MeasurementSet as typed NumPy chunks.
+
+    `vis` is the MS path; `sels` is a dict of MS selection keywords (see
+    `msselect_keys`); `polarization` is an optional comma-separated list of
+    polarizations to select. The number of rows per chunk is `maxrows` if
+    given; otherwise it's chosen so that each chunk of the requested columns
+    takes about `membudget` bytes.
+
+    Usage::
+
+      reader = MSChunkReader (vis, sels, 'RR,LL')
+      for ddid in reader.ddids:
+        for cols in reader.chunks (ddid, ['data', 'flag', 'time']):
+          ... cols['data'] is (ncorr, nchan, nrow) complex, etc. ...
+          freqs = reader.chanfreqs (ddid) # Hz, after channel selection
+      reader.close ()
+
+    Only the requested columns are fetched per chunk. Per-DDID and per-SPW
+    metadata (channel frequencies, spectral window mappings, phase centers)
+    are read once and cached rather than requeried every chunk."""
+
+    def __init__ (self, vis, sels=None, polarization=None, maxrows=None,
+                  membudget=64 * 1024**2):
+        import os.path
+
+        self.vis = vis
+        self.polarization = polarization
+        self.maxrows = maxrows
+        self.membudget = membudget
+
+        self.ms = tools.ms ()
+        self.ms.open (vis)
+        if sels:
+            self.ms.msselect (sels)
+
+        rangeinfo = self.ms.range ('data_desc_id field_id'.split ())
+        self.ddids = rangeinfo['data_desc_id']
+        self.fields = rangeinfo['field_id']
+
+        tb = tools.table ()
+        tb.open (os.path.join (vis, 'DATA_DESCRIPTION'))
+        self.ddspws = tb.getcol ('SPECTRAL_WINDOW_ID')
+        self.ddpols = tb.getcol ('POLARIZATION_ID')
+        tb.close ()
+
+        self._tb = tb
+        self._spwfreqs = None
+        self._phasedirs = {}
+        self._chanfreqs = {}
+
+    def close (self):
+        self.ms.close ()
+
+    def _readcells (self, table, column, rows=None):
+        import os.path
+
+        tb = self._tb
+        tb.open (os.path.join (self.vis, table))
+        try:
+            if rows is None:
+                rows = xrange (tb.nrows ())
+            return [tb.getcell (column, i) for i in rows]
+        finally:
+            tb.close ()
+
+    def spwfreqs (self):
+        """Return a list of the CHAN_FREQ arrays (in Hz) of every spectral
+        window in the dataset, without regard to any channel selection."""
+        if self._spwfreqs is None:
+            self._spwfreqs = self._readcells ('SPECTRAL_WINDOW', 'CHAN_FREQ')
+        return self._spwfreqs
+
+    def phasedir (self, fieldid):
+        """Return the PHASE_DIR cell of field `fieldid`, shape (2, npoly),
+        in radians."""
+        phdir = self._phasedirs.get (fieldid)
+        if phdir is None:
+            phdir = self._readcells ('FIELD', 'PHASE_DIR', [fieldid])[0]
+            self._phasedirs[fieldid] = phdir
+        return phdir
+
+    def chanfreqs (self, ddid):
+        """Return the frequencies (in Hz) of the selected channels of
+        `ddid`. Only available once chunks() has yielded data for it."""
+        return self._chanfreqs[ddid]
+
+    def _rowbytes (self, ddid, items):
+        if self.polarization is not None:
+            ncorr = len (self.polarization.split (','))
+        else:
+            ncorr = self._readcells ('POLARIZATION', 'NUM_CORR',
+                                     [self.ddpols[ddid]])[0]
+        nchan = self.spwfreqs ()[self.ddspws[ddid]].size
+        nbytes = 0
+
+        for item in items:
+            if item in _complex_items:
+                nbytes += 16 * ncorr * nchan
+            elif item == 'float_data':
+                nbytes += 8 * ncorr * nchan
+            elif item == 'flag':
+                nbytes += ncorr * nchan
+            elif item in ('weight', 'sigma'):
+                nbytes += 8 * ncorr
+            elif item == 'uvw':
+                nbytes += 24
+            else:
+                nbytes += 8
+
+        # CASA's and our copies of the data coexist for a while.
+        return 2 * nbytes
+
+    def chunkrows (self, ddid, items):
+        """Return the number of rows per chunk that chunks() will use."""
+        if self.maxrows is not None:
+            return self.maxrows
+        return max (int (self.membudget // self._rowbytes (ddid, items)), 1)
+
+    def chunks (self, ddid, items):
+        """Generate dicts of arrays, one per chunk of rows of `ddid`, with the
+        columns named in `items`. Flags are bool and visibilities complex;
+        everything else keeps the type CASA gives it, so that integer
+        columns such as antenna1 and scan_number stay integers."""
+        import numpy as np
+
+        ms = self.ms
+        ms.selectinit (ddid)
+        if self.polarization is not None:
+            ms.selectpolarization (self.polarization.split (','))
+        ms.iterinit (maxrows=self.chunkrows (ddid, items))
+        ms.iterorigin ()
+
+        while True:
+            want = list (items)
+            # axis_info is a big nested record, so only fetch it the first
+            # time through.
+            needaxes = ddid not in self._chanfreqs
+            if needaxes:
+                want.append ('axis_info')
+
+            cols = ms.getdata (items=want)
+
+            if needaxes:
+                freqs = cols.pop ('axis_info')['freq_axis']['chan_freq']
+                # In our usage, freqs should be of shape (nchan, 1). If you
+                # don't selectinit() with a specific DD, you seem to get
+                # (nchan, nspw). Neither seems to really agree with the docs.
+                # Trying to be careful in case CASA changes.
+                assert freqs.shape[1] == 1, 'internal inconsistency, chan_freq??'
+                self._chanfreqs[ddid] = freqs[:,0]
+
+            for item in items:
+                if item == 'flag':
+                    cols[item] = np.asarray (cols[item], dtype=np.bool)
+                elif item in _complex_items:
+                    cols[item] = np.asarray (cols[item], dtype=np.complex)
+                else:
+                    cols[item] = np.asarray (cols[item])
+
+            yield cols
+
+            if not ms.iternext ():
+                break
+
+
+# Batched conversion of MS timestamps to TT.
+
+class TimeBinner (object):
+    """Assign MeasurementSet TIME values to dense integer time bins, and
+    convert the bin times from UTC to MJD(TT).
+
+    Calling me.epoch() and me.measure() once per visibility record is
+    painfully slow. But TT - UTC only changes at leap seconds, which happen
+    at the ends of UTC days, so we need one measures conversion per UTC day
+    that the data touch; everything else is vectorized arithmetic. Each
+    distinct TIME value gets an integer bin index the first time it is
+    seen, so callers can accumulate into arrays rather than into dicts keyed
+    by floating-point MJDs.
+
+    Usage::
+
+      binner = TimeBinner ()
+      for each chunk:
+        tidx = binner.bin (cols['time']) # -> int array, one per record
+        ... accumulate into arrays indexed by tidx ...
+      mjdtt = binner.mjdtt () # -> MJD(TT) of each bin, indexed by bin
+
+    Note that bins are numbered in order of first appearance, not time
+    order; use np.argsort (binner.mjdtt ()) to sort them."""
+
+    def __init__ (self, me=None):
+        if me is None:
+            me = tools.measures ()
+
+        self.me = me
+        self._offsets = {} # integer UTC MJD -> TT - UTC in days
+        self._index = {} # MS TIME value -> bin index
+        self._mjdtt = []
+
+    def _dayoffset (self, day):
+        offset = self._offsets.get (day)
+
+        if offset is None:
+            # For some reason giving 'unit=s' doesn't do what one might hope
+            # it would, so we work in days. We evaluate at midday to stay
+            # well clear of any leap second.
+            mjd = day + 0.5
+            mq = self.me.epoch ('utc', {'value': mjd, 'unit': 'd'})
+            offset = self.me.measure (mq, 'tt')['m0']['value'] - mjd
+            self._offsets[day] = offset
+
+        return offset
+
+    def tt (self, times):
+        """Convert an array of MS TIME values (UTC MJD seconds) to MJD(TT)."""
+        import numpy as np
+
+        mjd = np.asarray (times, dtype=np.float) / 86400.
+        days, dayidx = np.unique (np.floor (mjd).astype (np.int),
+                                  return_inverse=True)
+        offsets = np.asarray ([self._dayoffset (d) for d in days])
+        return mjd + offsets[dayidx]
+
+    def bin (self, times):
+        """Return an array of bin indices, one per element of `times` (MS TIME
+        values), creating new bins for previously unseen times."""
+        import numpy as np
+
+        utimes, inverse = np.unique (np.asarray (times), return_inverse=True)
+        uidx = np.empty (utimes.size, dtype=np.int)
+        index = self._index
+        newtimes = []
+
+        for i, t in enumerate (utimes):
+            idx = index.get (t)
+            if idx is None:
+                idx = index[t] = len (index)
+                newtimes.append (t)
+            uidx[i] = idx
+
+        if len (newtimes):
+            self._mjdtt.extend (self.tt (newtimes))
+
+        return uidx[inverse]
+
+    @property
+    def nbins (self):
+        return len (self._mjdtt)
+
+    def mjdtt (self):
+        """Return the MJD(TT) of each bin, indexed by bin number."""
+        import numpy as np
+        return np.asarray (self._mjdtt)
+
+
+# Vectorized accumulation of visibility statistics.
+
+class VisAccumulator (object):
+    """Accumulate weighted visibility statistics into bins, a whole chunk of
+    MS records at a time.
+
+    For each bin we track seven quantities: the sums of wt*re, wt*im,
+    wt*re**2, wt*im**2, wt, and wt**2, and the number of samples, where
+    `wt` is the visibility weight. There are two modes:
+
+    - If `nchan` is given, each bin is further divided into `nchan` output
+      channels and every unflagged (polarization, channel) sample of each
+      record is accumulated individually. Finished shape: (nbin, nchan, 7).
+    - If `nchan` is None, each (polarization, record) pair is first averaged
+      over its unflagged channels, with its weight scaled by the unflagged
+      fraction, and that average is accumulated. Finished shape: (nbin, 7).
+
+    All polarizations are lumped together. Bins are allocated on demand as
+    larger bin indices are seen."""
+
+    ncols = 7
+
+    def __init__ (self, nchan=None):
+        self.nchan = nchan
+        self._accum = None
+        self._nbin = 0
+
+    def _ensure (self, nbin):
+        import numpy as np
+
+        if nbin <= self._nbin:
+            return
+
+        if self.nchan is None:
+            shape = (nbin, self.ncols)
+        else:
+            shape = (nbin, self.nchan, self.ncols)
+
+        if self._accum is None:
+            self._accum = np.zeros (shape)
+        elif self._accum.shape[0] < nbin:
+            # Grow geometrically to avoid lots of copies.
+            newshape = (max (nbin, 2 * self._accum.shape[0]), ) + shape[1:]
+            new = np.zeros (newshape)
+            new[:self._nbin] = self._accum[:self._nbin]
+            self._accum = new
+
+        self._nbin = nbin
+
+    def add (self, binidx, data, flags, weight, chanmap=None):
+        """Accumulate a chunk of records.
+
+        `binidx` - int or (nrec) array of bin indices
+        `data` - (npol, nchan, nrec) complex visibilities
+        `flags` - (npol, nchan, nrec) bool flags; True means bad
+        `weight` - (npol, nrec) weights
+        `chanmap` - (nchan) array mapping input to output channels; required
+           in per-channel mode and ignored otherwise."""
+        import numpy as np
+
+        npol, nchan, nrec = data.shape
+        binidx = np.zeros (nrec, dtype=np.int) + binidx
+        good = ~flags
+
+        # XXXXX casacore is currently broken and returns the raw weights from
+        # the dataset rather than applying the polarization selection.
+        # Fortunately all of our weights are the same, and you can never
+        # fetch more pol types than the dataset has, so trimming works
+        # despite the bug.
+        weight = weight[:npol]
+
+        if self.nchan is None:
+            ngood = good.sum (axis=1) # (npol, nrec)
+            ok = ngood > 0
+            d = np.where (good, data, 0).sum (axis=1)[ok] / ngood[ok]
+            # account for flagged parts. 90% sure this is the right thing to
+            # do:
+            wt = weight[ok] * ngood[ok] / float (nchan)
+            idx = np.broadcast_arrays (binidx[np.newaxis,:], ok)[0][ok]
+        else:
+            d = data[good]
+            wt = np.broadcast_arrays (weight[:,np.newaxis,:], good)[0][good]
+            idx = (binidx[np.newaxis,np.newaxis,:] * self.nchan +
+                   np.asarray (chanmap)[np.newaxis,:,np.newaxis])
+            idx = np.broadcast_arrays (idx, good)[0][good]
+
+        if not idx.size:
+            return self
+
+        self._ensure (binidx.max () + 1)
+        flat = self._accum.reshape ((-1, self.ncols))
+        n = idx.max () + 1
+
+        for col, vals in enumerate ((wt * d.real, wt * d.imag,
+                                     wt * d.real**2, wt * d.imag**2,
+                                     wt, wt**2, None)):
+            flat[:n,col] += np.bincount (idx, weights=vals, minlength=n)
+
+        return self
+
+    def finish (self, nbin=None):
+        """Return the accumulated sums. If `nbin` is given, the result has
+        that many bins, even if some were never touched."""
+        if nbin is None:
+            nbin = self._nbin
+        self._ensure (max (nbin, 1))
+        return self._accum[:nbin]
+
+
 # Tool factories.
 
 class _Tools (object):
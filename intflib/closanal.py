@@ -322,139 +322,221 @@ def _format (aps):
     return '-'.join (util.fmtAP (x) for x in aps)
 
 
-def _flagAnd (flags1, flags2, *rest):
-    # Avoid allocation of many temporary arrays here.
-    isect = np.logical_and (flags1, flags2)
+def _combinations (n, k):
+    """Return an (ncomb, k) int array of all strictly increasing k-tuples of
+    indices drawn from range(n), in lexicographic order. Equivalent to
+    itertools.combinations (range (n), k) but built with array operations."""
+
+    combos = np.arange (n).reshape ((n, 1))
+
+    for _ in xrange (k - 1):
+        last = combos[:,-1]
+        nnext = n - 1 - last # number of ways to extend each row
+        rows = np.repeat (np.arange (combos.shape[0]), nnext)
+        starts = np.repeat (np.cumsum (nnext) - nnext, nnext)
+        newcol = last[rows] + 1 + (np.arange (rows.size) - starts)
+        combos = np.column_stack ((combos[rows], newcol))
+
+    return combos
+
+
+# Rough cap on the number of (closure, channel) elements processed at once.
+_block_elements = 1 << 20
+
+
+class _DenseAcc (object):
+    """Accumulated closure sums for every k-tuple of one polarization's
+    antpols, stored densely: entry `i` of `time`, `clos`, and `var`
+    corresponds to the antpols `aps[combos[i]]`. `edges` gives, for each
+    tuple, the indices of the baselines it involves, in the order set by
+    the computer's `edgepairs`; baseline `p` is `pbps[p]`."""
+
+    def __init__ (self, aps, order, edgepairs):
+        self.aps = aps
+        m = aps.size
+        self.combos = _combinations (m, order)
+
+        i, j = np.triu_indices (m, 1)
+        pairidx = np.empty ((m, m), dtype=np.int)
+        pairidx[i,j] = np.arange (i.size)
+        self.pbps = dict ((p2p (int (aps[a]), int (aps[b])), n)
+                          for n, (a, b) in enumerate (zip (i, j)))
+        self.npair = i.size
+        self.edges = np.column_stack ([pairidx[self.combos[:,a], self.combos[:,b]]
+                                       for a, b in edgepairs])
+
+        n = self.combos.shape[0]
+        self.seen = np.zeros (n, dtype=np.bool)
+        self.time = np.zeros (n)
+        self.clos = np.zeros (n, dtype=np.complex)
+        self.var = np.zeros (n)
+
+    def absorb (self, other):
+        """Copy in the sums of `other`, whose antpols must be a subset of
+        ours; used when new antpols show up partway through an interval."""
+        m = self.aps.size
+        k = self.combos.shape[1]
+        scale = m ** np.arange (k - 1, -1, -1)
+        mine = (self.combos * scale).sum (1)
+        theirs = (np.searchsorted (self.aps, other.aps)[other.combos] * scale).sum (1)
+        idx = np.searchsorted (mine, theirs)
+        self.seen[idx] = other.seen
+        self.time[idx] = other.time
+        self.clos[idx] = other.clos
+        self.var[idx] = other.var
+
+    def pack (self, integData):
+        """Pack one integration's baseline data into dense (npair, nchan)
+        arrays."""
+        nchan = iter (integData.itervalues ()).next ()[0].size
+        data = np.zeros ((self.npair, nchan), dtype=np.complex)
+        flags = np.zeros ((self.npair, nchan), dtype=np.bool)
+        var = np.zeros (self.npair)
+        inttime = np.zeros (self.npair)
+        present = np.zeros (self.npair, dtype=np.bool)
+
+        for pbp, (d, f, v, t) in integData.iteritems ():
+            p = self.pbps.get (pbp)
+            if p is None:
+                continue # other polarization
+            data[p] = d
+            flags[p] = f
+            var[p] = v
+            inttime[p] = t
+            present[p] = True
+
+        return data, flags, var, inttime, present
+
+
+def _closureSums (data, eflags, e):
+    # Given dense baseline data and an (nclos, nedge) array of baseline
+    # indices, return the number of channels good in every baseline of each
+    # closure, and the per-baseline sums over those channels. `eflags` gives
+    # the flag array to use for each edge position.
+    mask = eflags[0][e[:,0]].copy ()
+    for i in xrange (1, e.shape[1]):
+        mask &= eflags[i][e[:,i]]
+
+    n = mask.sum (1)
+    sums = [np.where (mask, data[e[:,i]], 0).sum (1) for i in xrange (e.shape[1])]
+    return n, sums
 
-    for f in rest:
-        np.logical_and (isect, f, isect)
 
-    return isect
-
-
-def _flushOneInteg3 (integData, accData, ap1, ap2, ap3):
-    tup12 = integData.get (p2p (ap1, ap2))
-    tup13 = integData.get (p2p (ap1, ap3))
-    tup23 = integData.get (p2p (ap2, ap3))
-
-    if tup12 is None or tup13 is None or tup23 is None:
-        return
-
-    (d12, f12, v12, t12) =  tup12
-    (d13, f13, v13, t13) =  tup13
-    (d23, f23, v23, t23) =  tup23
-
-    assert t12 == t13 and t12 == t23
-
-    w = np.where (_flagAnd (f12, f13, f23))
-    n = len (w[0])
-
-    if n == 0: return
+class ClosureComputer (object):
+    def __init__ (self, rmshist, relative):
+        self.rmshist = rmshist
+        self.relative = relative
 
-    t = n * t12
-    c = (d12[w].sum () * d23[w].sum () * d13[w].sum ().conj ()) * t
-    v = (v12 + v13 + v23) * n**3 * t
+        self.integData = {}
+        self.accs = {}
+        self.allChunks = []
+        self._allData = None
+        self.seenaps = {}
+        self.seenpols = set ()
 
-    accKey = (ap1, ap2, ap3)
-    if accKey not in accData:
-        accData[accKey] = (t, c, v)
-    else:
-        (t0, c0, v0) = accData[accKey]
-        accData[accKey] = (t + t0, c + c0, v + v0)
+    def integrate (self, pbp, data, flags, var, inttime):
+        for ap in util.pbp32ToBP (pbp):
+            fpol = util.apFPol (ap)
+            self.seenpols.add (fpol)
 
+            if fpol in self.seenaps:
+                self.seenaps[fpol].add (ap)
+            else:
+                self.seenaps[fpol] = set ((ap, ))
 
-def _flushOneInteg4 (integData, accData, ap1, ap2, ap3, ap4):
-    tup12 = integData.get (p2p (ap1, ap2))
-    tup13 = integData.get (p2p (ap1, ap3))
-    tup24 = integData.get (p2p (ap2, ap4))
-    tup34 = integData.get (p2p (ap3, ap4))
+        self.integData[pbp] = (data, flags, var, inttime)
 
-    if tup12 is None or tup13 is None or tup24 is None or tup34 is None:
-        return
 
-    (d12, f12, v12, t12) =  tup12
-    (d13, f13, v13, t13) =  tup13
-    (d24, f24, v24, t24) =  tup24
-    (d34, f34, v34, t34) =  tup34
+    def _getAcc (self, pol):
+        aps = np.asarray (sorted (self.seenaps[pol]))
+        acc = self.accs.get (pol)
 
-    assert t12 == t13 and t12 == t24 and t12 == t34
+        if acc is None or acc.aps.size != aps.size or (acc.aps != aps).any ():
+            newacc = _DenseAcc (aps, self.order, self.edgepairs)
+            if acc is not None:
+                newacc.absorb (acc)
+            acc = self.accs[pol] = newacc
 
-    # Avoid div-by-zero
-    w = np.where (_flagAnd (f12, f13, f24, f34, d13 != 0, d24 != 0))
-    n = len (w[0])
+        return acc
 
-    if n == 0: return
 
-    t = n * t12
-    c = (d12[w].sum () * d34[w].sum () / d13[w].sum () / d24[w].sum ().conj ()) * t
+    def flushInteg (self):
+        # All of the closures for each polarization are computed with array
+        # operations on the integration's baselines, in blocks to bound
+        # memory usage.
 
-    # FIXME: in closure.for, the variance is the sum of the variances
-    # over flux**2, where flux = (|d12| + |d34| + |d14| + |d23|) / 4,
-    # but need to think through whether this is by channel or what.
+        if not len (self.integData):
+            return
 
-    v = (v12 + v13 + v24 + v34) * t
+        for pol in self.seenpols:
+            acc = self._getAcc (pol)
+            data, flags, var, inttime, present = acc.pack (self.integData)
+            nclos = acc.edges.shape[0]
+            blocksize = max (_block_elements // data.shape[1], 1)
+
+            for start in xrange (0, nclos, blocksize):
+                e = acc.edges[start:start+blocksize]
+                ok = present[e].all (1)
+                if not ok.any ():
+                    continue
 
-    accKey = (ap1, ap2, ap3, ap4)
-    if accKey not in accData:
-        accData[accKey] = (t, c, v)
-    else:
-        (t0, c0, v0) = accData[accKey]
-        accData[accKey] = (t + t0, c + c0, v + v0)
+                idx = np.nonzero (ok)[0] + start
+                e = e[ok]
+                t0 = inttime[e[:,0]]
+                assert (inttime[e] == t0[:,np.newaxis]).all ()
 
+                n, t, c, v = self._closeBlock (data, flags, var, t0, e)
+                ok = n > 0
+                idx = idx[ok]
+                acc.seen[idx] = True
+                acc.time[idx] += t[ok]
+                acc.clos[idx] += c[ok]
+                acc.var[idx] += v[ok]
 
-def _flushOneAcc3 (accData, allData, ap1, ap2, ap3):
-    key = (ap1, ap2, ap3)
-    tup = accData.get (key)
-    if tup is None:
-        return
+        self.integData = {}
 
-    (time, c, v) = tup
 
-    # note! not dividing by time since that doesn't affect phase.
-    # Does affect amp though.
-    ph = 180/np.pi * np.arctan2 (c.imag, c.real)
-    amp = np.abs (c) / time
-    thy = 180/np.pi * np.sqrt (v / time) / (amp ** (1./3))
+    def flushAcc (self):
+        for acc in self.accs.itervalues ():
+            ok = acc.seen
+            if not ok.any ():
+                continue
 
-    allData.accum (key, (ph, thy))
-    #allData.accum (key, (time, ph, v / time))
+            keys = acc.aps[acc.combos[ok]]
+            vals = self._finishAcc (acc.time[ok], acc.clos[ok], acc.var[ok])
+            self.allChunks.append ((keys, vals))
+            self._allData = None
 
+        self.accs = {}
+        self.seenpols = set ()
+        self.seenaps = {}
 
-def _flushOneAcc4 (accData, allData, ap1, ap2, ap3, ap4):
-    key = (ap1, ap2, ap3, ap4)
-    tup = accData.get (key)
-    if tup is None:
-        return
 
-    (time, c, v) = tup
-    amp = np.abs (c) / time
-    thy = np.sqrt (v) / time
+    @property
+    def allData (self):
+        """A dict mapping each closure's antpol tuple to an (n, 2) array of its
+        values in every averaging interval."""
+        if self._allData is not None:
+            return self._allData
 
-    allData.accum (key, (amp, thy))
+        result = {}
 
+        if len (self.allChunks):
+            keys = np.concatenate ([c[0] for c in self.allChunks])
+            vals = np.concatenate ([c[1] for c in self.allChunks])
+            # lexsort is stable, so values stay in time order.
+            order = np.lexsort (keys.T[::-1])
+            keys = keys[order]
+            vals = vals[order]
+            bounds = np.nonzero ((keys[1:] != keys[:-1]).any (1))[0] + 1
+            bounds = np.concatenate (([0], bounds, [keys.shape[0]]))
 
-class ClosureComputer (object):
-    def __init__ (self, rmshist, relative):
-        self.rmshist = rmshist
-        self.relative = relative
+            for i in xrange (bounds.size - 1):
+                s, e = bounds[i], bounds[i+1]
+                result[tuple (int (x) for x in keys[s])] = vals[s:e]
 
-        self.integData = {}
-        self.accData = {}
-        self.allData = AccDict (lambda: ArrayGrower (2), lambda o, v: o.addLine (v))
-        self.seenaps = {}
-        self.seenpols = set ()
-
-    def integrate (self, pbp, data, flags, var, inttime):
-        for ap in util.pbp32ToBP (pbp):
-            fpol = util.apFPol (ap)
-            self.seenpols.add (fpol)
-
-            if fpol in self.seenaps:
-                self.seenaps[fpol].add (ap)
-            else:
-                self.seenaps[fpol] = set ((ap, ))
-
-        self.integData[pbp] = (data, flags, var, inttime)
+        self._allData = result
+        return result
 
 
     def pDataSummary (self):
@@ -542,43 +624,24 @@ class TripleComputer (ClosureComputer):
     onestat = 'RMS'
     manystat = 'Mean(RMS)'
 
+    order = 3
+    edgepairs = [(0, 1), (0, 2), (1, 2)]
 
-    def flushInteg (self):
-        id, ac = self.integData, self.accData
-
-        for pol in self.seenpols:
-            aps = sorted (self.seenaps[pol])
-
-            for i in xrange (0, len (aps)):
-                ap3 = aps[i]
-                for j in xrange (0, i):
-                    ap2 = aps[j]
-                    for k in xrange (0, j):
-                        ap1 = aps[k]
+    def _closeBlock (self, data, flags, var, inttime, e):
+        n, (s12, s13, s23) = _closureSums (data, [flags] * 3, e)
+        t = n * inttime
+        c = (s12 * s23 * s13.conj ()) * t
+        v = var[e].sum (1) * n**3 * t
+        return n, t, c, v
 
-                        _flushOneInteg3 (id, ac, ap1, ap2, ap3)
 
-        self.integData = {}
-
-
-    def flushAcc (self):
-        acc, all = self.accData, self.allData
-
-        for pol in self.seenpols:
-            aps = sorted (self.seenaps[pol])
-
-            for i in xrange (0, len (aps)):
-                ap3 = aps[i]
-                for j in xrange (0, i):
-                    ap2 = aps[j]
-                    for k in xrange (0, j):
-                        ap1 = aps[k]
-
-                        _flushOneAcc3 (acc, all, ap1, ap2, ap3)
-
-        self.accData = {}
-        self.seenpols = set ()
-        self.seenaps = {}
+    def _finishAcc (self, time, c, v):
+        # note! not dividing by time since that doesn't affect phase.
+        # Does affect amp though.
+        ph = 180/np.pi * np.arctan2 (c.imag, c.real)
+        amp = np.abs (c) / time
+        thy = 180/np.pi * np.sqrt (v / time) / (amp ** (1./3))
+        return np.column_stack ((ph, thy))
 
 
     def process (self):
@@ -594,8 +657,8 @@ class TripleComputer (ClosureComputer):
             apacc = apStats.accum
 
         def c ():
-            for (key, ag) in self.allData.iteritems ():
-                phs, thys = ag.finish ().T
+            for (key, vals) in self.allData.iteritems ():
+                phs, thys = vals.T
                 (ap1, ap2, ap3) = key
                 rms = np.sqrt (np.mean (phs**2))
                 thy = np.sqrt (np.mean (thys**2))
@@ -646,46 +709,33 @@ class QuadComputer (ClosureComputer):
     onestat = 'log(RMS)'
     manystat = 'RMS(log(RMS))'
 
-    def flushInteg (self):
-        id, ac = self.integData, self.accData
+    order = 4
+    edgepairs = [(0, 1), (0, 2), (1, 3), (2, 3)]
 
-        for pol in self.seenpols:
-            aps = sorted (self.seenaps[pol])
+    def _closeBlock (self, data, flags, var, inttime, e):
+        # Avoid div-by-zero
+        nzflags = flags & (data != 0)
+        n, (s12, s13, s24, s34) = _closureSums (data, [flags, nzflags,
+                                                       nzflags, flags], e)
+        t = n * inttime
 
-            for i in xrange (0, len (aps)):
-                ap4 = aps[i]
-                for j in xrange (0, i):
-                    ap3 = aps[j]
-                    for k in xrange (0, j):
-                        ap2 = aps[k]
-                        for l in xrange (0, k):
-                            ap1 = aps[l]
+        # Quads with no good channels (n = 0) get 0/0 here; the caller
+        # drops them.
+        with np.errstate (invalid='ignore', divide='ignore'):
+            c = (s12 * s34 / s13 / s24.conj ()) * t
 
-                            _flushOneInteg4 (id, ac, ap1, ap2, ap3, ap4)
-
-        self.integData = {}
+        # FIXME: in closure.for, the variance is the sum of the variances
+        # over flux**2, where flux = (|d12| + |d34| + |d14| + |d23|) / 4,
+        # but need to think through whether this is by channel or what.
 
+        v = var[e].sum (1) * t
+        return n, t, c, v
 
-    def flushAcc (self):
-        acc, all = self.accData, self.allData
-
-        for pol in self.seenpols:
-            aps = sorted (self.seenaps[pol])
 
-            for i in xrange (0, len (aps)):
-                ap4 = aps[i]
-                for j in xrange (0, i):
-                    ap3 = aps[j]
-                    for k in xrange (0, j):
-                        ap2 = aps[k]
-                        for l in xrange (0, k):
-                            ap1 = aps[l]
-
-                            _flushOneAcc4 (acc, all, ap1, ap2, ap3, ap4)
-
-        self.accData = {}
-        self.seenpols = set ()
-        self.seenaps = {}
+    def _finishAcc (self, time, c, v):
+        amp = np.abs (c) / time
+        thy = np.sqrt (v) / time
+        return np.column_stack ((amp, thy))
 
 
     def process (self):
@@ -698,8 +748,8 @@ class QuadComputer (ClosureComputer):
         apacc = apStats.accum
 
         def c ():
-            for (key, ag) in self.allData.iteritems ():
-                amps, thy = ag.finish ().T
+            for (key, vals) in self.allData.iteritems ():
+                amps, thy = vals.T
                 (ap1, ap2, ap3, ap4) = key
 
                 # Cf. Pearson & Readhead 1984 ARAA 22 97:
@@ -141,6 +141,15 @@ Basic usage::
     p2.setNPar (npar) # enables configuration of parameter meta-info
     p2.setFunc (nout, yfunc, jfunc)
 
+Many same-shaped problems can be solved in lockstep; the functions
+then operate on stacks with a leading batch axis:
+
+    def byfunc (params, vals):
+        vals[k] = {stuff with params[k]} # for each problem k
+    bp = BatchProblem (npar, nout, byfunc, bjfunc=None)
+    solutions = bp.solve (guesses) # guesses.shape = (nbatch, npar)
+    bp = BatchResidualProblem (npar, yobs, errinv, byfunc, bjfunc=None)
+
 Main Solution properties:
 
     prob - the Problem
@@ -151,6 +160,24 @@ Main Solution properties:
    fnorm - final norm of function output
     fvec - final vector of function outputs
     fjac - final Jacobian matrix of d(fvec)/d(params)
+time_* - seconds spent in the function, Jacobian, QR factorization,
+         and LM step solutions ('func', 'jac', 'qr', 'lmsolve'), and
+         in solve() overall ('total')
+
+Monitoring: if p.iterhook is set, it is called after every trial
+step with an IterationInfo object giving the iteration number, trial
+params, squared fnorm, LM parameter 'par', scaled step norm 'pnorm',
+step bound 'delta', reduction 'ratio', whether the step was
+'accepted', the current status set, and the time spent in each stage
+since the previous call. (p.iterhook = infolist.append records them.)
+
+If most parameters affect only a few outputs, the Jacobian can be
+given as a scipy.sparse matrix and the dense one is never formed:
+
+    def sjfunc (params):
+        return {sparse matrix, shape (npar, nout)}
+    sp = SparseProblem (npar, nout, yfunc, sjfunc)
+    sp = SparseResidualProblem (npar, yobs, errinv, yrfunc, sjrfunc)
 
 Automatic least-squares model-fitting (subtracts "observed" Y values
 and multiplies by inverse errors):
@@ -162,6 +189,25 @@ and multiplies by inverse errors):
     p.setResidualFunc (yobs, errinv, yrfunc, jrfunc, reckless=False)
     p = ResidualProblem (npar, yobs, errinv, yrfunc, jrfunc=None, reckless=False)
 
+Automatic derivatives: by default the function is called once per
+free parameter (twice if two-sided). Faster alternatives:
+
+    def yblockfunc (paramblock, valblock):
+        valblock[k] = {stuff with paramblock[k]} # for each row k
+    p.setFunc (nout, yfunc, None, blockfunc=yblockfunc)
+    p.setResidualFunc (yobs, errinv, yrfunc, None, blockfunc=yblockfunc)
+    p.jacpool = multiprocessing.pool.ThreadPool (4) # or anything with map()
+
+The block function, if given, evaluates all of the perturbed
+parameter vectors in one call. Otherwise, if 'jacpool' is set, the
+individual calls are distributed with jacpool.map (). Process pools
+require the model function (and its data) to be picklable.
+
+Numerical core: set p.linalg = 'lapack' to do the Q-R factorizations
+and LM-step solutions with LAPACK (via scipy.linalg) rather than with
+the default Python translations of MINPACK ('minpack'). This is much
+faster when there are more than a handful of free parameters.
+
 Parameter meta-information:
 
     p.pValue (paramindex, value, fixed=False)
@@ -218,7 +264,9 @@ from __future__ import division
 import numpy as np
 
 __all__ = ('enorm_fast enorm_mpfit_careful enorm_minpack '
-           'Problem Solution ResidualProblem '
+           'Problem Solution IterationInfo ResidualProblem '
+           'BatchProblem BatchResidualProblem '
+           'SparseProblem SparseResidualProblem '
            'checkDerivative').split ()
 
 
@@ -231,6 +279,11 @@ def test (f): # a decorator
     return f
 
 def _runtests (namefilt=None):
+    # Keep going after a failure, so that one broken test doesn't hide the
+    # results of the ones after it. Returns the names of the failures.
+    import traceback
+    failed = []
+
     for f in _testfuncs:
         if namefilt is not None and f.__name__ != namefilt:
             continue
@@ -238,7 +291,16 @@ def _runtests (namefilt=None):
         if n[0] == '_':
             n = n[1:]
         print n, '...'
-        f ()
+
+        try:
+            f ()
+        except Exception:
+            traceback.print_exc ()
+            failed.append (n)
+
+    if len (failed):
+        print 'FAILED:', ' '.join (failed)
+    return failed
 
 from numpy.testing import assert_array_almost_equal as Taaae
 from numpy.testing import assert_almost_equal as Taae
@@ -1161,6 +1223,533 @@ the corresponding covariance entries (pmut[k]) are set to zero.
     return r
 
 
+# LAPACK-backed alternatives to _qr_factor_packed, _lm_solve, and
+# _calc_covariance. They have the same call signatures and produce
+# results in the same packed conventions, so Problem.solve() can swap
+# them in wholesale; see Problem.linalg. The MINPACK translations above
+# do O(n^2) Python-level work per factorization or per LM-parameter
+# trial, which dominates the iteration for problems with dozens of
+# parameters and many residuals.
+
+def _qr_factor_lapack (a, enorm, finfo):
+    """LAPACK-backed version of _qr_factor_packed.
+
+Same parameters, return values, and in-place packed output as
+_qr_factor_packed. The factorization is computed by scipy.linalg.qr
+(LAPACK xGEQP3) and its Householder vectors are rescaled to the
+MINPACK convention, in which the i'th transformation is
+
+H_i = I - (v^T v) / v[i]
+
+for v the i'th row of the packed 'a' with its strict lower triangular
+part set to zero. The column pivoting strategy is LAPACK's, which need
+not pick the same permutation as the MINPACK one."""
+
+    from scipy.linalg import qr
+
+    n, m = a.shape
+
+    if m < n:
+        raise ValueError ('"a" must be at least as tall as it is wide')
+
+    acnorm = np.empty (n, finfo.dtype)
+    for j in xrange (n):
+        acnorm[j] = enorm (a[j], finfo)
+
+    # a.T is Fortran-ordered if a is C-ordered, so LAPACK can usually
+    # work in-place.
+
+    (raw, tau), rmat, pmut = qr (a.T, overwrite_a=True, mode='raw', pivoting=True)
+    packed = raw.T
+    rdiag = packed.diagonal ()[:n].copy ()
+
+    for i in xrange (n):
+        packed[i,i] = 1.
+        packed[i,i:] *= tau[i]
+
+    if not np.may_share_memory (packed, a):
+        a[:] = packed
+
+    return pmut, rdiag, acnorm
+
+
+def _lm_solve_lapack (r, pmut, ddiag, bqt, delta, par0, enorm, finfo):
+    """LAPACK-backed version of _lm_solve.
+
+Same parameters and return values as _lm_solve, except that 'r' is not
+modified. The regularized least-squares problem for each trial value
+of the LM parameter is solved with a Q-R factorization of the stacked
+(2n-by-n) matrix [R^T; sqrt(par) D P] rather than with Givens
+rotations."""
+
+    from scipy.linalg import qr, solve_triangular
+
+    dwarf = finfo.tiny
+    n = r.shape[0]
+    u = np.tril (r[:,:n]).T # upper triangular
+    dp = ddiag[pmut]
+
+    def trisolve (t, b, **kwargs):
+        # Least-squares solution a la MINPACK: components at and past
+        # the first zero on the diagonal are set to zero.
+        z = np.zeros_like (b)
+        w = np.where (t.diagonal () == 0)[0]
+        nsing = w[0] if w.size else n
+        if nsing > 0:
+            z[:nsing] = solve_triangular (t[:nsing,:nsing], b[:nsing], **kwargs)
+        return z, nsing
+
+    # Gauss-Newton direction.
+
+    z, nnonsingular = trisolve (u, bqt)
+    x = np.empty_like (bqt)
+    x[pmut] = z
+
+    wa2 = ddiag * x
+    dxnorm = enorm (wa2, finfo)
+    normdiff = dxnorm - delta
+
+    if normdiff <= 0.1 * delta:
+        return 0, x
+
+    par_lower = 0.
+
+    if nnonsingular == n:
+        wa1 = solve_triangular (u, dp * wa2[pmut] / dxnorm, trans='T')
+        par_lower = normdiff / delta / enorm (wa1, finfo)**2
+
+    gnorm = enorm (np.dot (bqt, u) / dp, finfo)
+    par_upper = gnorm / delta
+    if par_upper == 0:
+        par_upper = dwarf / min (delta, 0.1)
+
+    par = np.clip (par0, par_lower, par_upper)
+    if par == 0:
+        par = gnorm / dxnorm
+
+    stacked = np.zeros ((2 * n, n), r.dtype)
+    stacked[:n] = u
+    rhs = np.zeros (2 * n, r.dtype)
+    rhs[:n] = bqt
+    itercount = 0
+
+    while True:
+        itercount += 1
+
+        if par == 0:
+            par = max (dwarf, par_upper * 0.001)
+
+        stacked[n:] = np.diag (np.sqrt (par) * dp)
+        q, s = qr (stacked, mode='economic')
+        z, nsing = trisolve (s, np.dot (rhs, q))
+        x[pmut] = z
+        wa2 = ddiag * x
+        dxnorm = enorm (wa2, finfo)
+        olddiff = normdiff
+        normdiff = dxnorm - delta
+
+        if abs (normdiff) < 0.1 * delta:
+            break # converged
+        if par_lower == 0 and normdiff <= olddiff and olddiff < 0:
+            break # overshot, I guess?
+        if itercount == 10:
+            break # this is taking too long
+
+        # Compute and apply the Newton correction
+
+        wa1 = solve_triangular (s, dp * wa2[pmut] / dxnorm, trans='T')
+        par_delta = normdiff / delta / enorm (wa1, finfo)**2
+
+        if normdiff > 0:
+            par_lower = max (par_lower, par)
+        elif normdiff < 0:
+            par_upper = min (par_upper, par)
+
+        par = max (par_lower, par + par_delta)
+
+    return par, x
+
+
+def _calc_covariance_lapack (r, pmut, tol=1e-14):
+    """LAPACK-backed version of _calc_covariance.
+
+Same parameters, return value, and rank-deficiency handling as
+_calc_covariance. The inverse of R is computed with a triangular
+solve."""
+
+    from scipy.linalg import solve_triangular
+
+    n = r.shape[1]
+    assert r.shape[0] >= n
+
+    d = np.abs (r.diagonal ()[:n])
+    w = np.where (d <= tol * d[0])[0]
+    jrank = w[0] if w.size else n
+
+    u = np.tril (r[:jrank,:jrank]).T
+    uinv = solve_triangular (u, np.eye (jrank, dtype=r.dtype))
+    cperm = np.zeros ((n, n), r.dtype)
+    cperm[:jrank,:jrank] = np.dot (uinv, uinv.T)
+
+    cov = np.empty_like (cperm)
+    cov[np.ix_ (pmut, pmut)] = cperm
+    return cov
+
+
+_linalg_cores = {
+    'minpack': (_qr_factor_packed, _lm_solve, _calc_covariance),
+    'lapack': (_qr_factor_lapack, _lm_solve_lapack, _calc_covariance_lapack),
+}
+
+
+# Batched versions of the numerical kernels. These implement exactly
+# the same algorithms as _qr_factor_packed, _qrd_solve, and _lm_solve,
+# but operate on a stack of independent problems at once: every array
+# gains a leading "batch" axis, and the Python-level loops run over
+# the (small) number of parameters rather than over the problems.
+# Branches in the scalar code become masks. The arithmetic follows the
+# order of the scalar code, with dot products going through the same
+# BLAS routine, so that the results agree with it to within roundoff.
+# They are used by BatchProblem.
+
+def _dot_batch (a, b):
+    """Compute the dot products of the vectors along the last axes of `a`
+    and `b`, which must broadcast against each other. np.matmul computes
+    each of these with the same BLAS routine as np.dot, unlike
+    summing the elementwise products."""
+    return np.matmul (a[...,np.newaxis,:], b[...,:,np.newaxis])[...,0,0]
+
+
+def _clip_batch (x, lo, hi):
+    """Elementwise equivalent of np.clip (x, lo, hi) for scalar bounds, which
+    the scalar code uses. This includes its behavior when lo > hi, which
+    np.clip does not reproduce for array bounds."""
+    return np.where (x < lo, lo, np.where (x > hi, hi, x))
+
+
+def _enorm_batch (v, finfo):
+    """Batched version of enorm_mpfit_careful: compute the Euclidean norm
+    of `v` along its last axis. Vectors with nonfinite values get
+    nonfinite norms rather than raising an exception."""
+
+    size = v.shape[-1]
+    if size == 0:
+        return np.zeros (v.shape[:-1], v.dtype)
+
+    mx = np.abs (v).max (axis=-1)
+    rescale = (mx > 0) & ((mx > finfo.max / size) | (mx < finfo.tiny * size))
+    scale = np.where (rescale, mx, 1.)
+    v = v / scale[...,np.newaxis]
+    return scale * np.sqrt (_dot_batch (v, v))
+
+
+def _qr_factor_packed_batch (a, finfo):
+    """Batched version of _qr_factor_packed.
+
+Parameters:
+a     - A k-by-n-by-m array, m >= n; *overwritten* with the k packed
+        factorizations.
+finfo - A Numpy finfo object.
+
+Returns:
+pmut   - A k-by-n array of permutation vectors
+rdiag  - A k-by-n array of the diagonals of the R matrices
+acnorm - A k-by-n array of the norms of the rows of the input matrices
+
+See _qr_factor_packed for the meaning of the outputs."""
+
+    machep = finfo.eps
+    k, n, m = a.shape
+
+    if m < n:
+        raise ValueError ('"a" must be at least as tall as it is wide')
+
+    bi = np.arange (k)
+    acnorm = _enorm_batch (a, finfo)
+    rdiag = acnorm.copy ()
+    wa = acnorm.copy ()
+    pmut = np.empty ((k, n), np.int)
+    pmut[:] = np.arange (n)
+
+    for i in xrange (n):
+        # Pivot. Where kmax == i the swaps are no-ops.
+
+        kmax = rdiag[:,i:].argmax (axis=1) + i
+
+        temp = pmut[bi,i]
+        pmut[bi,i] = pmut[bi,kmax]
+        pmut[bi,kmax] = temp
+
+        rdiag[bi,kmax] = rdiag[bi,i]
+        wa[bi,kmax] = wa[bi,i]
+
+        temp = a[bi,i].copy ()
+        a[bi,i] = a[bi,kmax]
+        a[bi,kmax] = temp
+
+        # Householder transformation. Problems with a zero row here
+        # are left alone.
+
+        ainorm = _enorm_batch (a[:,i,i:], finfo)
+        ainorm[a[:,i,i] < 0] *= -1
+        rdiag[:,i] = -ainorm
+        rdiag[ainorm == 0,i] = 0
+        nz = np.where (ainorm != 0)[0]
+
+        if not nz.size:
+            continue
+
+        ai = a[nz,i,i:] / ainorm[nz,np.newaxis]
+        ai[:,0] += 1
+        a[nz,i,i:] = ai
+
+        if i + 1 < n:
+            rest = a[nz,i+1:,i:]
+            dots = _dot_batch (ai[:,np.newaxis,:], rest)
+            rest -= ai[:,np.newaxis,:] * dots[:,:,np.newaxis] / ai[:,0,np.newaxis,np.newaxis]
+            a[nz,i+1:,i:] = rest
+
+            rdj = rdiag[nz,i+1:]
+            waj = wa[nz,i+1:]
+            upd = rdj != 0
+            ratio = rest[:,:,0] / np.where (upd, rdj, 1.)
+            rdj = np.where (upd, rdj * np.sqrt (np.maximum (1 - np.power (ratio, 2), 0)), rdj)
+
+            refresh = upd & (0.05 * np.power (rdj / np.where (upd, waj, 1.), 2) <= machep)
+            if refresh.any ():
+                kr, jr = np.nonzero (refresh)
+                rdj[kr,jr] = waj[kr,jr] = _enorm_batch (rest[kr,jr,1:], finfo)
+                wa[nz,i+1:] = waj
+
+            rdiag[nz,i+1:] = rdj
+
+    return pmut, rdiag, acnorm
+
+
+def _qrd_solve_batch (r, pmut, ddiag, bqt, sdiag):
+    """Batched version of _qrd_solve.
+
+Parameters:
+r     - **input-output** k-by-n-by-n array; see _qrd_solve.
+pmut  - k-by-n array of permutation vectors.
+ddiag - k-by-n array of the diagonals of the D matrices.
+bqt   - k-by-n array of the first n elements of B Q^T.
+sdiag - output k-by-n array, filled with the diagonals of S.
+
+Returns:
+x     - k-by-n array of solutions."""
+
+    k, n = bqt.shape
+    bi = np.arange (k)
+
+    for i in xrange (n):
+        r[:,i,i:] = r[:,i:,i]
+
+    x = r[:,np.arange (n),np.arange (n)].copy ()
+    zwork = bqt.copy ()
+    sdiag.fill (0)
+
+    for i in xrange (n):
+        dl = ddiag[bi,pmut[:,i]]
+        act = dl != 0
+        sdiag[act,i:] = 0
+        sdiag[act,i] = dl[act]
+        bqtpi = np.zeros (k, bqt.dtype)
+
+        for j in xrange (i, n):
+            # Givens rotations, applied only where the scalar code would
+            # apply them.
+
+            sj = sdiag[:,j]
+            rjj = r[:,j,j]
+            go = act & (sj != 0)
+            flip = np.abs (rjj) < np.abs (sj)
+
+            cot = rjj / np.where (flip, sj, 1.)
+            tan = sj / np.where (flip | ~go, 1., rjj)
+            sin = np.where (flip, 0.5 / np.sqrt (0.25 + 0.25 * np.power (cot, 2)), 0.)
+            cos = np.where (flip, sin * cot, 0.5 / np.sqrt (0.25 + 0.25 * np.power (tan, 2)))
+            sin = np.where (flip, sin, cos * tan)
+
+            r[:,j,j] = np.where (go, cos * rjj + sin * sj, rjj)
+            zj = zwork[:,j]
+            temp = np.where (go, cos * zj + sin * bqtpi, zj)
+            bqtpi = np.where (go, -sin * zj + cos * bqtpi, bqtpi)
+            zwork[:,j] = temp
+
+            if j + 1 < n:
+                g = go[:,np.newaxis]
+                c = cos[:,np.newaxis]
+                s = sin[:,np.newaxis]
+                rj = r[:,j,j+1:]
+                sd = sdiag[:,j+1:]
+                temp = np.where (g, c * rj + s * sd, rj)
+                sdiag[:,j+1:] = np.where (g, -s * rj + c * sd, sd)
+                r[:,j,j+1:] = temp
+
+        sdiag[:,i] = r[:,i,i]
+        r[:,i,i] = x[:,i]
+
+    # Triangular solve; everything past the first zero in sdiag is
+    # zeroed, as in the scalar version. Problems are grouped by the
+    # size of their nonsingular part so that the dot products run over
+    # the same elements as they do there.
+
+    sing = sdiag == 0
+    nsing = np.where (sing.any (axis=1), sing.argmax (axis=1), n)
+
+    for ns in np.unique (nsing):
+        g = np.where (nsing == ns)[0]
+        z = zwork[g]
+        z[:,ns:] = 0
+
+        if ns > 0:
+            rg = r[g]
+            sg = sdiag[g]
+            z[:,ns-1] /= sg[:,ns-1]
+
+            for i in xrange (ns - 2, -1, -1):
+                s = _dot_batch (z[:,i+1:ns], rg[:,i,i+1:ns])
+                z[:,i] = (z[:,i] - s) / sg[:,i]
+
+        zwork[g] = z
+
+    x[bi[:,np.newaxis],pmut] = zwork
+    return x
+
+
+def _lm_solve_batch (r, pmut, ddiag, bqt, delta, par0, finfo):
+    """Batched version of _lm_solve.
+
+Parameters:
+r     - IN/OUT k-by-n-by-m array, m >= n; see _lm_solve.
+pmut  - k-by-n array of permutation vectors.
+ddiag - k-by-n array of the diagonals of the D matrices.
+bqt   - k-by-n array of the first elements of B Q^T.
+delta - k-vector of step bounds.
+par0  - k-vector of initial estimates of the LM parameter.
+finfo - info about chosen floating-point representation
+
+Returns:
+par   - k-vector of final estimates of the LM parameter.
+x     - k-by-n array of LM solution vectors.
+
+Each problem iterates until it individually satisfies the termination
+criteria of _lm_solve; problems that have finished drop out of the
+computation. As in _lm_solve, problems for which the Gauss-Newton
+direction is already short enough get par = 0."""
+
+    dwarf = finfo.tiny
+    k, n = bqt.shape
+    bi = np.arange (k)[:,np.newaxis]
+    rdiag = r[:,np.arange (n),np.arange (n)]
+
+    # Gauss-Newton direction, with least-squares solutions for
+    # rank-deficient Jacobians.
+
+    sing = np.logical_or.accumulate (rdiag == 0, axis=1)
+    wa1 = np.where (sing, 0., bqt)
+
+    for j in xrange (n - 1, -1, -1):
+        wa1[:,j] /= np.where (sing[:,j], 1., rdiag[:,j])
+        wa1[:,:j] -= r[:,j,:j] * wa1[:,j,np.newaxis]
+
+    x = np.empty_like (bqt)
+    x[bi,pmut] = wa1
+
+    wa2 = ddiag * x
+    dxnorm = _enorm_batch (wa2, finfo)
+    normdiff = dxnorm - delta
+    par = np.zeros (k, bqt.dtype)
+    live = ~(normdiff <= 0.1 * delta)
+    done = ~live
+
+    if not live.any ():
+        return par, x
+
+    with np.errstate (invalid='ignore', divide='ignore'):
+        # Lower bound from the Newton step, if not rank deficient.
+
+        dpm = ddiag[bi,pmut]
+        wa1 = dpm * wa2[bi,pmut] / dxnorm[:,np.newaxis]
+        wa1[:,0] /= rdiag[:,0]
+
+        for j in xrange (1, n):
+            wa1[:,j] = (wa1[:,j] - _dot_batch (wa1[:,:j], r[:,j,:j])) / rdiag[:,j]
+
+        par_lower = np.where (sing[:,-1], 0.,
+                              normdiff / delta / np.power (_enorm_batch (wa1, finfo), 2))
+
+        # Upper bound.
+
+        for j in xrange (n):
+            wa1[:,j] = _dot_batch (bqt[:,:j+1], r[:,j,:j+1]) / dpm[:,j]
+
+        gnorm = _enorm_batch (wa1, finfo)
+        par_upper = gnorm / delta
+        par_upper = np.where (par_upper == 0, dwarf / np.minimum (delta, 0.1), par_upper)
+
+        par = _clip_batch (par0, par_lower, par_upper)
+        par = np.where (par == 0, gnorm / dxnorm, par)
+
+        itercount = 0
+        sdiag = np.empty_like (bqt)
+
+        while True:
+            itercount += 1
+            w = np.where (live)[0]
+            bw = np.arange (w.size)[:,np.newaxis]
+
+            p = par[w]
+            p = np.where (p == 0, np.maximum (dwarf, par_upper[w] * 0.001), p)
+            rw = r[w,:,:n]
+            dw = ddiag[w]
+            sd = sdiag[w]
+            xw = _qrd_solve_batch (rw, pmut[w], np.sqrt (p)[:,np.newaxis] * dw,
+                                   bqt[w], sd)
+            r[w,:,:n] = rw
+            sdiag[w] = sd
+            x[w] = xw
+
+            wa2 = dw * xw
+            dxn = _enorm_batch (wa2, finfo)
+            olddiff = normdiff[w]
+            nd = dxn - delta[w]
+            normdiff[w] = nd
+            pl = par_lower[w]
+            pu = par_upper[w]
+
+            stop = np.abs (nd) < 0.1 * delta[w]
+            stop |= (pl == 0) & (nd <= olddiff) & (olddiff < 0)
+            if itercount == 10:
+                stop[:] = True
+
+            # Newton correction for the problems that keep going.
+
+            pw = pmut[w]
+            wa1 = dw[bw,pw] * wa2[bw,pw] / dxn[:,np.newaxis]
+
+            for j in xrange (n - 1):
+                wa1[:,j] /= sd[:,j]
+                wa1[:,j+1:n] -= rw[:,j,j+1:n] * wa1[:,j,np.newaxis]
+            wa1[:,n-1] /= sd[:,n-1]
+
+            par_delta = nd / delta[w] / np.power (_enorm_batch (wa1, finfo), 2)
+            go = ~stop
+            pl = np.where (go & (nd > 0), np.maximum (pl, p), pl)
+            pu = np.where (go & (nd < 0), np.minimum (pu, p), pu)
+            par[w] = np.where (go, np.maximum (pl, p + par_delta), p)
+            par_lower[w] = pl
+            par_upper[w] = pu
+
+            live[w[stop]] = False
+            if not live.any ():
+                break
+
+    par[done] = 0
+    return par, x
+
+
 # The actual user interface to the problem-solving machinery:
 
 class Solution (object):
@@ -1177,13 +1766,77 @@ class Solution (object):
     nfev = -1
     njev = -1
 
+    # Wall-clock seconds spent in the various stages of solve().
+    time_func = None
+    time_jac = None
+    time_qr = None
+    time_lmsolve = None
+    time_total = None
+
     def __init__ (self, prob):
         self.prob = prob
 
 
+class IterationInfo (object):
+    """Passed to Problem.iterhook after every trial step of solve().
+    The time_* fields give the seconds spent in each stage since the
+    previous call of the hook (or the start of the solution)."""
+
+    niter = None
+    params = None
+    fnorm = None
+    par = None
+    pnorm = None
+    delta = None
+    ratio = None
+    accepted = None
+    status = None
+    time_func = None
+    time_jac = None
+    time_qr = None
+    time_lmsolve = None
+
+
+class _ResidualWrapper (object):
+    """Turns a model function into a residual function, or a model
+    Jacobian into a residual Jacobian, for Problem.setResidualFunc. This
+    is a class rather than a closure so that it can be pickled and
+    sent to worker processes (see Problem.jacpool)."""
+
+    def __init__ (self, yobs, errinv, func, isjac, reckless):
+        self.yobs = yobs
+        self.errinv = errinv
+        self.func = func
+        self.isjac = isjac
+        self.reckless = reckless
+
+    def __call__ (self, pars, out):
+        self.func (pars, out) # model Y values => out
+
+        if self.isjac:
+            if not self.reckless and anynotfinite (out):
+                raise RuntimeError ('jacobian returned nonfinite values')
+            np.multiply (out, -1, out)
+            out *= self.errinv # broadcasts how we want
+        else:
+            if not self.reckless and anynotfinite (out):
+                raise RuntimeError ('function returned nonfinite values')
+            np.subtract (self.yobs, out, out) # abs. residuals => out
+            np.multiply (out, self.errinv, out)
+
+
+def _pool_ycall (args):
+    # Worker-side model evaluation for Problem.jacpool.
+    yfunc, params, nout = args
+    vec = np.empty (nout, params.dtype)
+    yfunc (params, vec)
+    return vec
+
+
 class Problem (object):
     _yfunc = None
     _jfunc = None
+    _bfunc = None
     _npar = None
     _nout = None
 
@@ -1208,11 +1861,15 @@ class Problem (object):
 
     maxiter = 200
     normfunc = None
+    linalg = 'minpack'
 
     diag = None
 
     debugCalls = False
     debugJac = False
+    iterhook = None
+
+    jacpool = None
 
 
     def __init__ (self, npar=None, nout=None, yfunc=None, jfunc=None,
@@ -1376,7 +2033,7 @@ class Problem (object):
 
         tied = np.asarray ([x is not None for x in self._pinfoo[PI_O_TIEFUNC]])
         self._anytied = np.any (tied)
-        self._ifree = np.where (-(self._getBits (PI_M_FIXED) | tied))[0]
+        self._ifree = np.where (~(self._getBits (PI_M_FIXED) | tied))[0]
 
 
     def getNFree (self):
@@ -1386,7 +2043,12 @@ class Problem (object):
 
     # Now, the function and the constraint values
 
-    def setFunc (self, nout, yfunc, jfunc):
+    def setFunc (self, nout, yfunc, jfunc, blockfunc=None):
+        """If specified, *blockfunc* (pblock, vblock) evaluates the model
+        for a whole stack of parameter vectors at once: pblock has
+        shape (k, npar) and vblock, to be filled in, (k, nout). It is
+        used to compute automatic derivatives in one call rather
+        than one call per free parameter."""
         try:
             nout = int (nout)
             assert nout > 0
@@ -1406,17 +2068,20 @@ class Problem (object):
                 raise ValueError ('jfunc')
             self._get_jacobian = self._get_jacobian_explicit
 
+        if blockfunc is not None and not callable (blockfunc):
+            raise ValueError ('blockfunc')
+
         self._nout = nout
         self._yfunc = yfunc
         self._jfunc = jfunc
+        self._bfunc = blockfunc
         self._nfev = 0
         self._njev = 0
         return self
 
 
-    def setResidualFunc (self, yobs, errinv, yfunc, jfunc, reckless=False):
-        from numpy import subtract, multiply
-
+    def setResidualFunc (self, yobs, errinv, yfunc, jfunc, reckless=False,
+                         blockfunc=None):
         self._checkParamConfig ()
         npar = self._npar
 
@@ -1425,33 +2090,16 @@ class Problem (object):
 
         # FIXME: handle yobs.ndim != 1 and/or yobs being complex
 
-        if reckless:
-            def ywrap (pars, nresids):
-                yfunc (pars, nresids) # model Y values => nresids
-                subtract (yobs, nresids, nresids) # abs. residuals => nresids
-                multiply (nresids, errinv, nresids)
-            def jwrap (pars, jac):
-                jfunc (pars, jac)
-                multiply (jac, -1, jac)
-                jac *= errinv # broadcasts how we want
-        else:
-            def ywrap (pars, nresids):
-                yfunc (pars, nresids)
-                if anynotfinite (nresids):
-                    raise RuntimeError ('function returned nonfinite values')
-                subtract (yobs, nresids, nresids)
-                multiply (nresids, errinv, nresids)
-            def jwrap (pars, jac):
-                jfunc (pars, jac)
-                if anynotfinite (jac):
-                    raise RuntimeError ('jacobian returned nonfinite values')
-                multiply (jac, -1, jac)
-                jac *= errinv
+        ywrap = _ResidualWrapper (yobs, errinv, yfunc, False, reckless)
+        jwrap = bwrap = None
 
-        if jfunc is None:
-            jwrap = None
+        if jfunc is not None:
+            jwrap = _ResidualWrapper (yobs, errinv, jfunc, True, reckless)
+        if blockfunc is not None:
+            # The same arithmetic broadcasts over the rows of the block.
+            bwrap = _ResidualWrapper (yobs, errinv, blockfunc, False, reckless)
 
-        return self.setFunc (yobs.size, ywrap, jwrap)
+        return self.setFunc (yobs.size, ywrap, jwrap, bwrap)
 
 
     def _fixupCheck (self, dtype):
@@ -1493,6 +2141,10 @@ class Problem (object):
         elif not callable (self.normfunc):
             raise ValueError ('normfunc must be a callable or None')
 
+        if self.linalg not in _linalg_cores:
+            raise ValueError ('linalg must be one of: ' +
+                              ', '.join (sorted (_linalg_cores)))
+
         # Bounds and type checks
 
         if not issubclass (self.solclass, Solution):
@@ -1529,8 +2181,9 @@ class Problem (object):
 
 
     def copy (self):
-        n = Problem (self._npar, self._nout, self._yfunc, self._jfunc,
-                     self.solclass)
+        n = self.__class__ (self._npar, self._nout, self._yfunc, self._jfunc,
+                            self.solclass)
+        n._bfunc = self._bfunc
 
         if self._pinfof is not None:
             n._pinfof = self._pinfof.copy ()
@@ -1548,8 +2201,11 @@ class Problem (object):
         n.epsilon = self.epsilon
         n.maxiter = self.maxiter
         n.normfunc = self.normfunc
+        n.linalg = self.linalg
         n.debugCalls = self.debugCalls
         n.debugJac = self.debugJac
+        n.iterhook = self.iterhook
+        n.jacpool = self.jacpool
 
         return n
 
@@ -1574,11 +2230,15 @@ class Problem (object):
 
     def solve (self, initial_params=None, dtype=np.float):
         from numpy import any, clip, dot, isfinite, sqrt, where
+        from timeit import default_timer as clock
 
+        tstart = clock ()
         self._fixupCheck (dtype)
         ifree = self._ifree
         ycall = self._ycall
         n = ifree.size # number of free params; we try to allow n = 0
+        qr_factor, lm_solve, calc_covariance = _linalg_cores[self.linalg]
+        iterhook = self.iterhook
 
         # Set up initial values. These can either be specified via the
         # arguments to this function, or set implicitly with calls to
@@ -1632,9 +2292,17 @@ class Problem (object):
         fvec = np.ndarray (self._nout, dtype)
         fullfjac = np.zeros ((self._npar, self._nout), finfo.dtype)
         fjac = fullfjac[:n]
+        t0 = clock ()
         ycall (params, fvec)
+        tfunc = clock () - t0
         fnorm = enorm (fvec, finfo)
 
+        # Timing accumulators; tmark holds their values as of the
+        # last call to iterhook.
+
+        tjac = tqr = tlmsolve = 0.
+        tmark = (0., 0., 0., 0.)
+
         # Initialize Levenberg-Marquardt parameter and
         # iteration counter.
 
@@ -1651,7 +2319,9 @@ class Problem (object):
             if self._anytied:
                 self._apply_ties (params)
 
+            t0 = clock ()
             self._get_jacobian (params, fvec, fullfjac, ulim, dside, maxstep, isrel, finfo)
+            tjac += clock () - t0
 
             if anylimits:
                 # Check for parameters pegged at limits
@@ -1674,7 +2344,8 @@ class Problem (object):
             # wa1: "rdiag", diagonal part of R matrix, pivoting applied
             # wa2: "acnorm", unpermuted row norms of fjac
             # fjac: overwritten with Q and R matrix info, pivoted
-            pmut, wa1, wa2 = _qr_factor_packed (fjac, enorm, finfo)
+            t0 = clock ()
+            pmut, wa1, wa2 = qr_factor (fjac, enorm, finfo)
 
             if niter == 1:
                 # If "diag" unspecified, scale according to norms of rows
@@ -1704,6 +2375,8 @@ class Problem (object):
                 fjac[j,j] = wa1[j]
                 fqt[j] = wa4[j]
 
+            tqr += clock () - t0
+
             # Only the n-by-n part of fjac is important now, and this
             # test will probably be cheap since usually n << m.
 
@@ -1732,8 +2405,11 @@ class Problem (object):
             # Inner loop
             while True:
                 # Get Levenberg-Marquardt parameter. fjac is modified in-place
-                par, wa1 = _lm_solve (fjac, pmut, diag, fqt, delta, par,
-                                      enorm, finfo)
+                t0 = clock ()
+                par, wa1 = lm_solve (fjac, pmut, diag, fqt, delta, par,
+                                     enorm, finfo)
+                tlmsolve += clock () - t0
+                steppar = par
                 # "Store the direction p and x+p. Calculate the norm of p"
                 wa1 *= -1
                 alpha = 1.
@@ -1791,7 +2467,9 @@ class Problem (object):
 
                 # Evaluate func at x + p and calculate norm
 
+                t0 = clock ()
                 ycall (params, wa4)
+                tfunc += clock () - t0
                 fnorm1 = enorm (wa4, finfo)
 
                 # Compute scaled actual reductions
@@ -1868,6 +2546,24 @@ class Problem (object):
                 if gnorm <= finfo.eps:
                     status.add ('geps')
 
+                if iterhook is not None:
+                    info = IterationInfo ()
+                    info.niter = niter
+                    info.params = params.copy ()
+                    info.fnorm = fnorm1**2
+                    info.par = steppar
+                    info.pnorm = pnorm
+                    info.delta = delta
+                    info.ratio = ratio
+                    info.accepted = ratio >= 0.0001
+                    info.status = set (status)
+                    info.time_func = tfunc - tmark[0]
+                    info.time_jac = tjac - tmark[1]
+                    info.time_qr = tqr - tmark[2]
+                    info.time_lmsolve = tlmsolve - tmark[3]
+                    tmark = (tfunc, tjac, tqr, tlmsolve)
+                    iterhook (info)
+
                 # Repeat loop if iteration
                 # unsuccessful. "Unsuccessful" means that the ratio of
                 # actual to predicted norm reduction is less than 1e-4
@@ -1892,7 +2588,9 @@ class Problem (object):
         else:
             params[ifree] = x
 
+        t0 = clock ()
         ycall (params, fvec)
+        tfunc += clock () - t0
         fnorm = enorm (fvec, finfo)
         fnorm = max (fnorm, fnorm1)
         fnorm **= 2
@@ -1909,7 +2607,7 @@ class Problem (object):
             if sz[0] < n or sz[1] < n or len (pmut) < n:
                 covar = None
             else:
-                cv = _calc_covariance (fjac[:,:n], pmut[:n])
+                cv = calc_covariance (fjac[:,:n], pmut[:n])
                 cv.shape = (n, n)
 
                 for i in xrange (n): # can't do 2D fancy indexing
@@ -1939,6 +2637,11 @@ class Problem (object):
         soln.fjac = fjac
         soln.nfev = self._nfev
         soln.njev = self._njev
+        soln.time_func = tfunc
+        soln.time_jac = tjac
+        soln.time_qr = tqr
+        soln.time_lmsolve = tlmsolve
+        soln.time_total = clock () - tstart
         return soln
 
 
@@ -1994,30 +2697,59 @@ class Problem (object):
         if self.debugJac:
             print 'Jac-:', h
 
-        # Compute derivative for each parameter
+        # Stack up the perturbed parameter vectors: one per free
+        # parameter, plus an extra one for each two-sided derivative.
 
-        fp = np.empty (self._nout, dtype=finfo.dtype)
-        fm = np.empty (self._nout, dtype=finfo.dtype)
+        two = np.where ((dside == DSIDE_TWO)[ifree])[0]
+        xblock = np.empty ((n + two.size, self._npar), params.dtype)
+        xblock[:] = params
+        xblock[np.arange (n),ifree] += h
+        xblock[n + np.arange (two.size),ifree[two]] -= h[two]
 
-        for i in xrange (n):
-            xp = params.copy ()
-            xp[ifree[i]] += h[i]
-            self._ycall (xp, fp)
+        fblock = np.empty ((xblock.shape[0], self._nout), dtype=finfo.dtype)
+        self._ycall_block (xblock, fblock)
 
-            if dside[i] != DSIDE_TWO:
-                # One-sided derivative
-                fjacfull[i] = (fp - fvec) / h[i]
-            else:
-                # Two-sided ... extra func call
-                xp[ifree[i]] = params[ifree[i]] - h[i]
-                self._ycall (xp, fm)
-                fjacfull[i] = (fp - fm) / (2 * h[i])
+        # Compute derivative for each parameter
+
+        fjacfull[:n] = (fblock[:n] - fvec) / h[:,np.newaxis]
+        if two.size:
+            fjacfull[two] = (fblock[two] - fblock[n:]) / (2 * h[two,np.newaxis])
 
         if self.debugJac:
             for i in xrange (n):
                 print 'Jac :', fjacfull[i]
 
 
+    def _ycall_block (self, pblock, vblock):
+        if self._bfunc is None and self.jacpool is None:
+            for i in xrange (pblock.shape[0]):
+                self._ycall (pblock[i], vblock[i])
+            return
+
+        if self._anytied:
+            for i in xrange (pblock.shape[0]):
+                self._apply_ties (pblock[i])
+
+        nblock = pblock.shape[0]
+        self._nfev += nblock
+
+        if self.debugCalls:
+            print 'Call: #%4d-%4d f(%s) ->' % (self._nfev - nblock + 1, self._nfev, pblock),
+
+        if self._bfunc is not None:
+            self._bfunc (pblock, vblock)
+        else:
+            tasks = [(self._yfunc, p, self._nout) for p in pblock]
+            for i, vec in enumerate (self.jacpool.map (_pool_ycall, tasks)):
+                vblock[i] = vec
+
+        if self.debugCalls:
+            print vblock
+
+        if self.damp > 0:
+            np.tanh (vblock / self.damp, vblock)
+
+
     def _manual_jacobian (self, params, dtype=np.float):
         self._fixupCheck (dtype)
 
@@ -2093,8 +2825,7 @@ class Problem (object):
         t = leastsq (sofunc, initial_params, Dfun=sojac, full_output=1,
                      ftol=self.ftol, xtol=self.xtol, gtol=self.gtol,
                      maxfev=self.maxiter, # approximate
-                     epsfcn=self.epsilon, factor=self.factor, diag=self.diag,
-                     warning=False)
+                     epsfcn=self.epsilon, factor=self.factor, diag=self.diag)
 
         covar = t[1]
         perror = None
@@ -2122,20 +2853,798 @@ class Problem (object):
         return soln
 
 
-def checkDerivative (npar, nout, yfunc, jfunc, guess):
-    explicit = np.empty ((npar, nout))
-    jfunc (guess, explicit)
+class BatchProblem (Problem):
+    """A stack of independent problems sharing the same structure,
+solved in lockstep.
 
-    p = Problem (npar, nout, yfunc, None)
-    auto = p._manual_jacobian (guess)
+The model functions take and fill arrays with a leading batch axis:
+
+    def yfunc (params, vals):
+        # params.shape = (nbatch, npar); vals.shape = (nbatch, nout)
+    def jfunc (params, jac):
+        # jac.shape = (nbatch, npar, nout)
+
+The functions are always called with the full stack. Rows belonging
+to problems that have already terminated are evaluated at their final
+parameters and their outputs ignored. The parameter meta-information
+and the tolerances are shared by all of the problems. solve() returns
+a list of Solution objects, one per problem. The nfev and njev of each
+solution count calls of the batched functions. Every problem follows
+the algorithm of Problem.solve(), but the linear algebra is vectorized
+over the batch axis. The results are not bit-for-bit identical to
+those of the serial solver (BLAS dot products, for instance, round
+differently depending on the memory layout of their inputs), so a
+problem may take a slightly different number of iterations than it
+would on its own, though it converges to the same solution. The
+'normfunc', 'linalg', and 'iterhook' settings are ignored, and the
+solutions carry no timing information."""
+
+    _nbatch = None
+
+    def setResidualFunc (self, yobs, errinv, yfunc, jfunc, reckless=False):
+        """yobs has shape (nbatch, nout); errinv must broadcast
+        against it."""
+
+        from numpy import subtract, multiply
+
+        self._checkParamConfig ()
+
+        yobs = np.asarray (yobs)
+        if yobs.ndim != 2:
+            raise ValueError ('yobs must have shape (nbatch, nout)')
+
+        errinv = np.asarray (errinv)
+        if anynotfinite (errinv):
+            raise ValueError ('some inverse errors are nonfinite')
+        jerrinv = np.broadcast_to (errinv, yobs.shape)[:,np.newaxis,:]
+
+        def ywrap (pars, nresids):
+            yfunc (pars, nresids)
+            if not reckless and anynotfinite (nresids):
+                raise RuntimeError ('function returned nonfinite values')
+            subtract (yobs, nresids, nresids)
+            multiply (nresids, errinv, nresids)
+
+        def jwrap (pars, jac):
+            jfunc (pars, jac)
+            if not reckless and anynotfinite (jac):
+                raise RuntimeError ('jacobian returned nonfinite values')
+            multiply (jac, -1, jac)
+            jac *= jerrinv
+
+        if jfunc is None:
+            jwrap = None
+
+        self.setFunc (yobs.shape[1], ywrap, jwrap)
+        self._nbatch = yobs.shape[0]
+        return self
+
+
+    def copy (self):
+        n = super (BatchProblem, self).copy ()
+        n._nbatch = self._nbatch
+        return n
+
+
+    def _ycall (self, params, vec):
+        if self._anytied:
+            for i in xrange (params.shape[0]):
+                self._apply_ties (params[i])
+
+        self._nfev += 1
+
+        if self.debugCalls:
+            print 'Call: #%4d f(%s) ->' % (self._nfev, params),
+        self._yfunc (params, vec)
+        if self.debugCalls:
+            print vec
+
+        if self.damp > 0:
+            np.tanh (vec / self.damp, vec)
+
+
+    def _get_jacobian_explicit (self, params, fvec, fjacfull, ulimit, dside, maxstep, isrel, finfo):
+        self._njev += 1
+
+        if self.debugCalls:
+            print 'Call: #%4d j(%s) ->' % (self._njev, params),
+        self._jfunc (params, fjacfull)
+        if self.debugCalls:
+            print fjacfull
+
+        ifree = self._ifree
+
+        if ifree.size < self._npar:
+            for i in xrange (ifree.size):
+                fjacfull[:,i] = fjacfull[:,ifree[i]]
+
+
+    def _get_jacobian_automatic (self, params, fvec, fjacfull, ulimit, dside, maxstep, isrel, finfo):
+        eps = np.sqrt (max (self.epsilon, finfo.eps))
+        ifree = self._ifree
+        x = params[:,ifree]
+        n = ifree.size
+        h = eps * np.abs (x)
+
+        stepi = self._pinfof[PI_F_STEP,ifree]
+        wh = np.where (stepi > 0)[0]
+        h[:,wh] = stepi[wh] * np.where (isrel[ifree[wh]], x[:,wh], 1.)
+
+        np.minimum (h, maxstep, h)
+        h[np.where (h == 0)] = eps
+
+        mask = np.empty (h.shape, np.bool)
+        mask[:] = (dside == DSIDE_NEG)[ifree]
+        if ulimit is not None:
+            mask |= x > ulimit - h
+        h[mask] = -h[mask]
+
+        if self.debugJac:
+            print 'Jac-:', h
+
+        fp = np.empty (fvec.shape, dtype=finfo.dtype)
+        fm = np.empty (fvec.shape, dtype=finfo.dtype)
+
+        for i in xrange (n):
+            hi = h[:,i,np.newaxis]
+            xp = params.copy ()
+            xp[:,ifree[i]] += h[:,i]
+            self._ycall (xp, fp)
+
+            if dside[ifree[i]] != DSIDE_TWO:
+                fjacfull[:,i] = (fp - fvec) / hi
+            else:
+                xp[:,ifree[i]] = params[:,ifree[i]] - h[:,i]
+                self._ycall (xp, fm)
+                fjacfull[:,i] = (fp - fm) / (2 * hi)
+
+        if self.debugJac:
+            for i in xrange (n):
+                print 'Jac :', fjacfull[:,i]
+
+
+    def solve (self, initial_params=None, dtype=np.float):
+        from numpy import abs, isfinite, sqrt, where
+
+        self._fixupCheck (dtype)
+        ifree = self._ifree
+        ycall = self._ycall
+        n = ifree.size
+        m = self._nout
+
+        if initial_params is not None:
+            initial_params = np.asarray (initial_params, dtype=dtype)
+        else:
+            initial_params = self._pinfof[PI_F_VALUE]
+
+        if initial_params.ndim == 1:
+            if self._nbatch is None:
+                raise ValueError ('need a 2D array of initial parameters '
+                                  'to determine the batch size')
+            initial_params = np.tile (initial_params, (self._nbatch, 1))
+        elif initial_params.ndim != 2:
+            raise ValueError ('initial parameters must be 1D or 2D')
+
+        nb = initial_params.shape[0]
+
+        if self._nbatch is not None and nb != self._nbatch:
+            raise ValueError ('expected %d problems, got %d' % (self._nbatch, nb))
+        if initial_params.shape[1] != self._npar:
+            raise ValueError ('expected exactly %d parameters, got %d'
+                              % (self._npar, initial_params.shape[1]))
+
+        initial_params = initial_params.copy ()
+        w = where (self._pinfob & PI_M_FIXED)[0]
+        initial_params[:,w] = self._pinfof[PI_F_VALUE,w]
+
+        if anynotfinite (initial_params):
+            raise ValueError ('some nonfinite initial parameter values')
+
+        dtype = initial_params.dtype
+        finfo = np.finfo (dtype)
+        params = initial_params.copy ()
+        x = params[:,ifree]
+        bi = np.arange (nb)
+
+        isrel = self._getBits (PI_M_RELSTEP)
+        dside = self._pinfob & PI_M_SIDE
+        maxstep = self._pinfof[PI_F_MAXSTEP,ifree]
+        whmaxstep = where (isfinite (maxstep))[0]
+        anymaxsteps = whmaxstep.size > 0
+
+        hasulim = isfinite (self._pinfof[PI_F_ULIMIT,ifree])
+        ulim = self._pinfof[PI_F_ULIMIT,ifree]
+        hasllim = isfinite (self._pinfof[PI_F_LLIMIT,ifree])
+        llim = self._pinfof[PI_F_LLIMIT,ifree]
+        anylimits = hasulim.any () or hasllim.any ()
+
+        # Per-problem state.
+
+        fvec = np.empty ((nb, m), dtype)
+        fullfjac = np.zeros ((nb, self._npar, m), dtype)
+        jwork = np.zeros ((nb, self._npar, m), dtype)
+        fjac = fullfjac[:,:n]
+        ycall (params, fvec)
+        fnorm = _enorm_batch (fvec, finfo)
+        fnorm1 = -np.ones (nb, dtype)
+
+        par = np.zeros (nb, dtype)
+        delta = np.zeros (nb, dtype)
+        xnorm = np.zeros (nb, dtype)
+        gnorm = np.zeros (nb, dtype)
+        diag = np.ones ((nb, n), dtype)
+        fqt = np.zeros ((nb, n), dtype)
+        pmut = np.zeros ((nb, n), np.int)
+        lpeg = np.zeros ((nb, n), np.bool)
+        upeg = np.zeros ((nb, n), np.bool)
+        niter = np.ones (nb, np.int)
+        status = [set () for i in xrange (nb)]
+        active = np.ones (nb, np.bool)
+        needjac = np.ones (nb, np.bool)
+
+        with np.errstate (invalid='ignore', divide='ignore'):
+            while True:
+                # New Jacobians and Q-R factorizations for the problems
+                # that just took a successful step (the outer loop of
+                # Problem.solve).
+
+                wj = where (active & needjac)[0]
+
+                if wj.size:
+                    params[:,ifree] = x
+
+                    if self._anytied:
+                        for i in xrange (nb):
+                            self._apply_ties (params[i])
+
+                    self._get_jacobian (params, fvec, jwork, ulim, dside, maxstep, isrel, finfo)
+                    fj = jwork[wj,:n]
+                    fv = fvec[wj]
+                    k = wj.size
+                    bk = np.arange (k)
+
+                    if anylimits:
+                        xw = x[wj]
+                        g = _dot_batch (fj, fv[:,np.newaxis,:])
+                        lp = hasllim & (xw == llim)
+                        up = hasulim & (xw == ulim)
+                        fj[lp & (g > 0)] = 0
+                        fj[up & (g < 0)] = 0
+                        lpeg[wj] = lp
+                        upeg[wj] = up
+
+                    pm, rd, acn = _qr_factor_packed_batch (fj, finfo)
+
+                    init = niter[wj] == 1
+                    if init.any ():
+                        wi = wj[init]
+                        if self.diag is not None:
+                            diag[wi] = self.diag[ifree]
+                        else:
+                            d = acn[init]
+                            d[d == 0] = 1.
+                            diag[wi] = d
+
+                        xnorm[wi] = _enorm_batch (diag[wi] * x[wi], finfo)
+                        d = self.factor * xnorm[wi]
+                        d[d == 0] = self.factor
+                        delta[wi] = d
+
+                    wa4 = fv.copy ()
+                    fq = np.empty ((k, n), dtype)
+
+                    for j in xrange (n):
+                        temp3 = fj[:,j,j]
+                        nz = (temp3 != 0)[:,np.newaxis]
+                        fjj = fj[:,j,j:]
+                        wv = wa4[:,j:]
+                        d = _dot_batch (wv, fjj)
+                        upd = fjj * d[:,np.newaxis] / where (nz, temp3[:,np.newaxis], 1.)
+                        wa4[:,j:] = where (nz, wv - upd, wv)
+                        fj[:,j,j] = rd[:,j]
+                        fq[:,j] = wa4[:,j]
+
+                    bad = ~isfinite (fj[:,:,:n]).all (axis=2).all (axis=1)
+                    if bad.any ():
+                        raise RuntimeError ('nonfinite terms in Jacobian matrix '
+                                            'of problem #%d' % wj[bad][0])
+
+                    gn = np.zeros (k, dtype)
+                    fn = fnorm[wj]
+                    for j in xrange (n):
+                        wl = acn[bk,pm[:,j]]
+                        ok = (wl != 0) & (fn != 0)
+                        s = _dot_batch (fq[:,:j+1], fj[:,j,:j+1]) / fn
+                        gn = where (ok, np.maximum (gn, abs (s / wl)), gn)
+
+                    gnorm[wj] = gn
+                    fjac[wj] = fj
+                    pmut[wj] = pm
+                    fqt[wj] = fq
+                    needjac[wj] = False
+
+                    if self.diag is None:
+                        diag[wj] = np.maximum (diag[wj], acn)
+
+                    for i in wj[gn <= self.gtol]:
+                        status[i].add ('gtol')
+                        active[i] = False
+
+                wa = where (active)[0]
+                if not wa.size:
+                    break
+
+                # One pass of the inner loop for every active problem.
+
+                k = wa.size
+                r = fjac[wa]
+                p, wa1 = _lm_solve_batch (r, pmut[wa], diag[wa], fqt[wa], delta[wa],
+                                          par[wa], finfo)
+                fjac[wa] = r
+                wa1 *= -1
+                alpha = np.ones (k, dtype)
+                xw = x[wa]
+
+                if not anylimits and not anymaxsteps:
+                    wa2 = xw + wa1
+                else:
+                    if anylimits:
+                        lp = lpeg[wa]
+                        up = upeg[wa]
+                        wa1 = where (lp, _clip_batch (wa1, 0., wa1.max (axis=1)[:,np.newaxis]), wa1)
+                        wa1 = where (up, _clip_batch (wa1, wa1.min (axis=1)[:,np.newaxis], 0.), wa1)
+
+                        dwa1 = abs (wa1) > finfo.eps
+                        whl = dwa1 & hasllim & ((xw + wa1) < llim)
+                        t = where (whl, (llim - xw) / where (whl, wa1, 1.), np.inf)
+                        alpha = np.minimum (alpha, t.min (axis=1))
+                        whu = dwa1 & hasulim & ((xw + wa1) > ulim)
+                        t = where (whu, (ulim - xw) / where (whu, wa1, 1.), np.inf)
+                        alpha = np.minimum (alpha, t.min (axis=1))
+
+                    if anymaxsteps:
+                        nwa1 = wa1[:,whmaxstep] * alpha[:,np.newaxis]
+                        mrat = abs (nwa1 / maxstep[whmaxstep]).max (axis=1)
+                        alpha = where (mrat > 1, alpha / mrat, alpha)
+
+                    wa1 *= alpha[:,np.newaxis]
+                    wa2 = xw + wa1
+                    wa2 = where (hasulim & (wa2 >= ulim * (1 - finfo.eps)), ulim, wa2)
+                    wa2 = where (hasllim & (wa2 <= llim * (1 + finfo.eps)), llim, wa2)
+
+                dw = diag[wa]
+                pnorm = _enorm_batch (dw * wa1, finfo)
+                d = delta[wa]
+                d = where (niter[wa] == 1, np.minimum (d, pnorm), d)
+
+                ptrial = params.copy ()
+                ptrial[wa[:,np.newaxis],ifree] = wa2
+                wa4 = np.empty ((nb, m), dtype)
+                ycall (ptrial, wa4)
+                fn1 = _enorm_batch (wa4[wa], finfo)
+                fn = fnorm[wa]
+                fnorm1[wa] = fn1
+
+                actred = where (0.1 * fn1 < fn, 1 - np.power (fn1 / fn, 2), -1.)
+
+                fw = fjac[wa][:,:,:n]
+                pw = pmut[wa]
+                wp = wa1[np.arange (k)[:,np.newaxis],pw]
+                wa3 = np.zeros ((k, n), dtype)
+                for j in xrange (n):
+                    wa3[:,:j+1] += fw[:,j,:j+1] * wp[:,j,np.newaxis]
+
+                temp1 = _enorm_batch (alpha[:,np.newaxis] * wa3, finfo) / fn
+                temp2 = sqrt (alpha * p) * pnorm / fn
+                prered = np.power (temp1, 2) + 2 * np.power (temp2, 2)
+                dirder = -(np.power (temp1, 2) + np.power (temp2, 2))
+                ratio = where (prered != 0, actred / prered, 0.)
+
+                low = ratio <= 0.25
+                temp = where (actred >= 0, 0.5, 0.5 * dirder / (dirder + 0.5 * actred))
+                temp = where ((0.1 * fn1 >= fn) | (temp < 0.1), 0.1, temp)
+                d = where (low, temp * np.minimum (d, 10 * pnorm), d)
+                p = where (low, p / temp, p)
+                high = ~low & ((p == 0) | (ratio >= 0.75))
+                d = where (high, 2 * pnorm, d)
+                p = where (high, 0.5 * p, p)
+                delta[wa] = d
+                par[wa] = p
+
+                ok = ratio >= 0.0001
+                wo = wa[ok]
+                x[wo] = wa2[ok]
+                params[wo] = ptrial[wo]
+                fvec[wo] = wa4[wo]
+                xnorm[wo] = _enorm_batch (dw[ok] * wa2[ok], finfo)
+                fnorm[wo] = fn1[ok]
+                niter[wo] += 1
+                needjac[wo] = True
+
+                xn = xnorm[wa]
+                conds = [
+                    ('ftol', (abs (actred) <= self.ftol) & (prered <= self.ftol) & (ratio <= 2)),
+                    ('xtol', d <= self.xtol * xn),
+                    ('maxiter', niter[wa] >= self.maxiter),
+                    ('feps', (abs (actred) <= finfo.eps) & (prered <= finfo.eps) & (ratio <= 2)),
+                    ('xeps', d <= finfo.eps * xn),
+                    ('geps', gnorm[wa] <= finfo.eps),
+                ]
+
+                for name, cond in conds:
+                    for i in wa[cond]:
+                        status[i].add (name)
+                        active[i] = False
+
+                cont = ok & active[wa]
+                if anynotfinite (wa1[cont]):
+                    raise RuntimeError ('overflow in wa1')
+                if anynotfinite (wa2[cont]):
+                    raise RuntimeError ('overflow in wa2')
+
+        # Finalize params, fvec, and fnorm.
+
+        if n == 0:
+            params = initial_params.copy ()
+        else:
+            params[:,ifree] = x
+
+        ycall (params, fvec)
+        fnorm = np.power (np.maximum (_enorm_batch (fvec, finfo), fnorm1), 2)
+        ndof = self.getNDOF ()
+        solns = []
+
+        for i in xrange (nb):
+            covar = np.zeros ((self._npar, self._npar), dtype)
+
+            if n > 0:
+                cv = _calc_covariance (fjac[i,:,:n], pmut[i])
+
+                for j in xrange (n):
+                    covar[ifree[j],ifree] = cv[j]
+
+            perror = np.zeros (self._npar, dtype)
+            d = covar.diagonal ()
+            wh = where (d >= 0)
+            perror[wh] = sqrt (d[wh])
+
+            soln = self.solclass (self)
+            soln.ndof = ndof
+            soln.status = status[i]
+            soln.niter = niter[i]
+            soln.params = params[i]
+            soln.covar = covar
+            soln.perror = perror
+            soln.fnorm = fnorm[i]
+            soln.fvec = fvec[i]
+            soln.fjac = fjac[i]
+            soln.nfev = self._nfev
+            soln.njev = self._njev
+            solns.append (soln)
+
+        return solns
+
+
+class SparseProblem (Problem):
+    """A problem whose Jacobian is sparse -- typically because most of
+the parameters each affect only a few of the outputs. The Jacobian
+function returns a scipy.sparse matrix rather than filling in an
+array:
+
+    def jfunc (params):
+        return {sparse matrix of d(vals)/d(params), shape (npar, nout)}
+
+Automatic derivatives are not supported. Rather than Q-R factorizing
+the Jacobian, solve() finds each Levenberg-Marquardt step by solving
+the sparse normal equations (J J^T + mu D^2) step = -J fvec with
+scipy.sparse.linalg, adjusting the damping mu with the gain-ratio rule
+of Nielsen (1999). The dense (npar, nout) Jacobian is never formed;
+only the (npar, npar) covariance matrix is dense. Parameter limits are
+enforced by clipping each step, which is cruder than the treatment in
+Problem.solve(). The tolerances, 'maxiter', 'diag', 'damp', and
+'iterhook' are honored; 'normfunc', 'linalg', and the automatic
+derivative settings are ignored. Solution.fjac is the sparse Jacobian
+of the free parameters."""
+
+    def setFunc (self, nout, yfunc, jfunc, blockfunc=None):
+        if jfunc is None:
+            raise ValueError ('SparseProblem requires an explicit jfunc')
+        return super (SparseProblem, self).setFunc (nout, yfunc, jfunc)
+
+
+    def setResidualFunc (self, yobs, errinv, yfunc, jfunc, reckless=False):
+        """yobs and errinv may have any (broadcast-compatible) shapes;
+        they are flattened, and the model functions deal in the
+        flattened values."""
+        from scipy.sparse import csr_matrix, diags
+
+        self._checkParamConfig ()
+
+        yobs = np.asarray (yobs, dtype=np.float)
+        errinv = np.broadcast_to (np.asarray (errinv, dtype=np.float),
+                                  yobs.shape).ravel ()
+        yobs = yobs.ravel ()
+
+        if anynotfinite (errinv):
+            raise ValueError ('some inverse errors are nonfinite')
+
+        ywrap = _ResidualWrapper (yobs, errinv, yfunc, False, reckless)
+        negerrinv = diags (-errinv, 0)
+
+        def jwrap (pars):
+            jac = csr_matrix (jfunc (pars))
+            if not reckless and anynotfinite (jac.data):
+                raise RuntimeError ('jacobian returned nonfinite values')
+            return jac.dot (negerrinv)
+
+        return self.setFunc (yobs.size, ywrap, jwrap)
+
+
+    def _jcall (self, params):
+        from scipy.sparse import csr_matrix
+
+        self._njev += 1
+
+        if self.debugCalls:
+            print 'Call: #%4d j(%s) ->' % (self._njev, params),
+        jac = csr_matrix (self._jfunc (params))
+        if self.debugCalls:
+            print jac
+
+        if jac.shape != (self._npar, self._nout):
+            raise RuntimeError ('jacobian has shape %s; expected %s' %
+                                (jac.shape, (self._npar, self._nout)))
+
+        return jac
+
+
+    def solve (self, initial_params=None, dtype=np.float):
+        from numpy import clip, dot, sqrt, where
+        from scipy.sparse import diags
+        from scipy.sparse.linalg import spsolve
+        from timeit import default_timer as clock
+
+        tstart = clock ()
+        self._fixupCheck (dtype)
+        ifree = self._ifree
+        ycall = self._ycall
+        n = ifree.size
+        iterhook = self.iterhook
+
+        if initial_params is not None:
+            initial_params = np.atleast_1d (np.asarray (initial_params, dtype=dtype))
+        else:
+            initial_params = self._pinfof[PI_F_VALUE]
+
+        if initial_params.size != self._npar:
+            raise ValueError ('expected exactly %d parameters, got %d'
+                              % (self._npar, initial_params.size))
+
+        initial_params = initial_params.copy ()
+        w = where (self._pinfob & PI_M_FIXED)
+        initial_params[w] = self._pinfof[PI_F_VALUE,w]
+
+        if anynotfinite (initial_params):
+            raise ValueError ('some nonfinite initial parameter values')
+
+        dtype = initial_params.dtype
+        finfo = np.finfo (dtype)
+        params = initial_params.copy ()
+        x = params[ifree]
+        llim = self._pinfof[PI_F_LLIMIT,ifree]
+        ulim = self._pinfof[PI_F_ULIMIT,ifree]
+
+        fvec = np.empty (self._nout, dtype)
+        wa4 = np.empty (self._nout, dtype)
+        t0 = clock ()
+        ycall (params, fvec)
+        tfunc = clock () - t0
+        fnorm2 = dot (fvec, fvec)
+
+        tjac = tlmsolve = 0.
+        tmark = (0., 0., 0.)
+        mu = 1e-3
+        nu = 2.
+        niter = 1
+        status = set ()
+
+        while True:
+            params[ifree] = x
+
+            if self._anytied:
+                self._apply_ties (params)
+
+            t0 = clock ()
+            fjac = self._jcall (params)[ifree]
+            tjac += clock () - t0
+
+            t0 = clock ()
+            a = fjac.dot (fjac.T).tocsc ()
+            g = fjac.dot (fvec)
+            adiag = a.diagonal ()
+            tlmsolve += clock () - t0
+
+            if niter == 1:
+                if self.diag is not None:
+                    diag2 = self.diag[ifree]**2
+                else:
+                    diag2 = adiag.copy ()
+                    diag2[where (diag2 == 0)] = 1.
+            elif self.diag is None:
+                diag2 = np.maximum (diag2, adiag)
+
+            # Cosine of the angle between fvec and the Jacobian rows,
+            # as in Problem.solve ().
+
+            gnorm = 0.
+            wh = where (adiag > 0)
+
+            if fnorm2 != 0 and len (wh[0]):
+                gnorm = np.abs (g[wh] / sqrt (adiag[wh] * fnorm2)).max ()
+
+            if gnorm <= self.gtol:
+                status.add ('gtol')
+                break
+
+            xnorm = sqrt (dot (diag2, x**2))
+
+            while True:
+                t0 = clock ()
+                step = -spsolve ((a + diags (mu * diag2, 0)).tocsc (), g)
+                tlmsolve += clock () - t0
+                steppar = mu
+
+                trial = clip (x + step, llim, ulim)
+                step = trial - x
+                pnorm = sqrt (dot (diag2, step**2))
+
+                params[ifree] = trial
+                t0 = clock ()
+                ycall (params, wa4)
+                tfunc += clock () - t0
+                fnorm21 = dot (wa4, wa4)
+
+                # Actual and predicted (by the linearization) reductions
+                # of the sum of squares, relative to the current value.
+
+                jstep = fjac.T.dot (step)
+                actred = prered = 0.
+                if fnorm2 != 0:
+                    actred = 1 - fnorm21 / fnorm2
+                    prered = -(2 * dot (g, step) + dot (jstep, jstep)) / fnorm2
+
+                ratio = 0.
+                if prered > 0:
+                    ratio = actred / prered
+
+                if ratio >= 0.0001:
+                    mu *= max (1. / 3, 1 - (2 * ratio - 1)**3)
+                    nu = 2.
+                    x = trial
+                    fvec, wa4 = wa4, fvec
+                    fnorm2 = fnorm21
+                    xnorm = sqrt (dot (diag2, x**2))
+                    niter += 1
+                else:
+                    mu *= nu
+                    nu *= 2
+
+                if abs (actred) <= self.ftol and prered <= self.ftol and ratio <= 2:
+                    status.add ('ftol')
+
+                if pnorm <= self.xtol * xnorm:
+                    status.add ('xtol')
+
+                if niter >= self.maxiter:
+                    status.add ('maxiter')
+
+                if abs (actred) <= finfo.eps and prered <= finfo.eps and ratio <= 2:
+                    status.add ('feps')
+
+                if pnorm <= finfo.eps * xnorm:
+                    status.add ('xeps')
+
+                if gnorm <= finfo.eps:
+                    status.add ('geps')
+
+                if iterhook is not None:
+                    info = IterationInfo ()
+                    info.niter = niter
+                    info.params = params.copy ()
+                    info.fnorm = fnorm21
+                    info.par = steppar
+                    info.pnorm = pnorm
+                    info.ratio = ratio
+                    info.accepted = ratio >= 0.0001
+                    info.status = set (status)
+                    info.time_func = tfunc - tmark[0]
+                    info.time_jac = tjac - tmark[1]
+                    info.time_lmsolve = tlmsolve - tmark[2]
+                    tmark = (tfunc, tjac, tlmsolve)
+                    iterhook (info)
+
+                if ratio >= 0.0001 or len (status):
+                    break
+
+            if len (status):
+                break
+
+            if anynotfinite (x):
+                raise RuntimeError ('overflow in x')
+
+        params[ifree] = x
+        if self._anytied:
+            self._apply_ties (params)
+
+        # Covariance from the last Jacobian; only this is dense.
+
+        covar = np.zeros ((self._npar, self._npar), dtype)
+
+        if n > 0:
+            a = a.toarray ()
+
+            try:
+                cv = np.linalg.inv (a)
+            except np.linalg.LinAlgError:
+                cv = np.linalg.pinv (a)
+
+            covar[np.ix_ (ifree, ifree)] = cv
+
+        perror = np.zeros (self._npar, dtype)
+        d = covar.diagonal ()
+        wh = where (d >= 0)
+        perror[wh] = sqrt (d[wh])
+
+        soln = self.solclass (self)
+        soln.ndof = self.getNDOF ()
+        soln.status = status
+        soln.niter = niter
+        soln.params = params
+        soln.covar = covar
+        soln.perror = perror
+        soln.fnorm = fnorm2
+        soln.fvec = fvec
+        soln.fjac = fjac
+        soln.nfev = self._nfev
+        soln.njev = self._njev
+        soln.time_func = tfunc
+        soln.time_jac = tjac
+        soln.time_lmsolve = tlmsolve
+        soln.time_total = clock () - tstart
+        return soln
+
+
+def checkDerivative (npar, nout, yfunc, jfunc, guess):
+    explicit = np.empty ((npar, nout))
+    jfunc (guess, explicit)
+
+    p = Problem (npar, nout, yfunc, None)
+    auto = p._manual_jacobian (guess)
 
     return explicit, auto
 
 
 def ResidualProblem (npar, yobs, errinv, yfunc, jfunc,
-                     solclass=Solution, reckless=False):
+                     solclass=Solution, reckless=False, blockfunc=None):
     p = Problem (solclass=solclass)
     p.setNPar (npar)
+    p.setResidualFunc (yobs, errinv, yfunc, jfunc, reckless=reckless,
+                       blockfunc=blockfunc)
+    return p
+
+
+def BatchResidualProblem (npar, yobs, errinv, yfunc, jfunc,
+                          solclass=Solution, reckless=False):
+    p = BatchProblem (solclass=solclass)
+    p.setNPar (npar)
+    p.setResidualFunc (yobs, errinv, yfunc, jfunc, reckless=reckless)
+    return p
+
+
+def SparseResidualProblem (npar, yobs, errinv, yfunc, jfunc,
+                           solclass=Solution, reckless=False):
+    p = SparseProblem (solclass=solclass)
+    p.setNPar (npar)
     p.setResidualFunc (yobs, errinv, yfunc, jfunc, reckless=reckless)
     return p
 
@@ -2249,6 +3758,143 @@ def _jac_stepsizes ():
     p._manual_jacobian (1)
 
 
+@test
+def _jac_block ():
+    # Block-evaluated and pooled automatic derivatives should match
+    # the one-call-at-a-time ones exactly.
+
+    from multiprocessing.pool import ThreadPool
+    x = np.linspace (0, 1, 7)
+
+    def f (pars, vec):
+        vec[:] = pars[0] * np.exp (pars[1] * x) + pars[2]
+
+    def bf (pblock, vblock):
+        vblock[:] = (pblock[:,0,np.newaxis] * np.exp (pblock[:,1,np.newaxis] * x)
+                     + pblock[:,2,np.newaxis])
+
+    guess = [1., 0.5, 2.]
+
+    p = Problem (3, x.size, f, None)
+    p.pSide (1, 'two')
+    p.pValue (2, 2., fixed=True)
+    j1 = p._manual_jacobian (guess)
+
+    p.setFunc (x.size, f, None, blockfunc=bf)
+    Taaae (p._manual_jacobian (guess), j1, decimal=12)
+
+    p.setFunc (x.size, f, None)
+    p.jacpool = ThreadPool (2)
+    try:
+        Taaae (p._manual_jacobian (guess), j1, decimal=12)
+    finally:
+        p.jacpool.close ()
+
+
+@test
+def _iterhook ():
+    def f (pars, vec):
+        np.exp (-pars[0] * np.arange (16.), vec)
+        vec *= pars[1]
+        vec -= 2 * np.exp (-0.3 * np.arange (16.))
+
+    infos = []
+    p = Problem (2, 16, f, None)
+    p.iterhook = infos.append
+    s = p.solve ([1., 1.])
+
+    accepted = [i for i in infos if i.accepted]
+    assert len (accepted) == s.niter - 1
+    Taaae (accepted[-1].params, s.params)
+    Taae (accepted[-1].fnorm, s.fnorm)
+    assert all (i.time_func >= 0 and i.time_jac >= 0 for i in infos)
+    assert sum (i.time_jac for i in infos) <= s.time_jac
+    assert s.time_total >= s.time_func + s.time_jac + s.time_qr + s.time_lmsolve
+
+
+@test
+def _sparse_matches_dense ():
+    # Many per-segment offsets plus one shared shape parameter: the
+    # sparse solver should agree with the dense one.
+
+    from scipy import sparse
+
+    nseg, nper = 30, 12
+    npar = nseg + 1
+    x = np.tile (np.linspace (-1, 1, nper), nseg)
+    seg = np.repeat (np.arange (nseg), nper)
+    offsets = np.linspace (-2, 2, nseg)
+    yobs = offsets[seg] + np.exp (-x**2 / 0.3) + 0.01 * np.cos (31 * x)
+
+    def f (pars, vals):
+        vals[:] = pars[seg] + np.exp (-x**2 / pars[nseg])
+
+    def dense (pars, jac):
+        jac.fill (0)
+        jac[seg,np.arange (x.size)] = 1
+        jac[nseg] = np.exp (-x**2 / pars[nseg]) * x**2 / pars[nseg]**2
+
+    def sparsejac (pars):
+        j = np.empty ((npar, x.size))
+        dense (pars, j)
+        return sparse.csr_matrix (j)
+
+    guess = np.zeros (npar)
+    guess[nseg] = 1.
+
+    p = ResidualProblem (npar, yobs, 100., f, dense)
+    s1 = p.solve (guess)
+    sp = SparseResidualProblem (npar, yobs, 100., f, sparsejac)
+    s2 = sp.solve (guess)
+
+    assert len (s2.status & set (('ftol', 'xtol', 'gtol')))
+    Taaae (s2.params, s1.params, decimal=6)
+    Taae (s2.fnorm / s1.fnorm, 1., decimal=6)
+    Taaae (s2.perror / s1.perror, np.ones (npar), decimal=4)
+
+    # Fixed parameters and limits.
+    sp.pValue (0, -2., fixed=True)
+    sp.pLimit (nseg, 0.1, 0.25)
+    s3 = sp.solve (guess)
+    Taae (s3.params[0], -2.)
+    Taae (s3.params[nseg], 0.25)
+    assert s3.perror[0] == 0
+
+
+@test
+def _batch_matches_serial ():
+    # Lockstep-solved Gaussians should reproduce the one-at-a-time
+    # solutions, including with limits and automatic derivatives.
+
+    x = np.linspace (-3, 3, 40)
+    truth = np.asarray ([[2., 0.5, 1.], [1., -0.2, 0.7], [4., 0.1, 1.3]])
+
+    def gauss (pars, vals):
+        vals[:] = pars[0] * np.exp (-0.5 * ((x - pars[1]) / pars[2])**2)
+
+    def bgauss (pars, vals):
+        for i in xrange (pars.shape[0]):
+            gauss (pars[i], vals[i])
+
+    yobs = np.empty ((truth.shape[0], x.size))
+    bgauss (truth, yobs)
+    yobs += 0.01 * np.cos (17 * x)
+    guess = [1.5, 0., 1.]
+
+    bp = BatchResidualProblem (3, yobs, 100., bgauss, None)
+    bp.pLimit (2, 0.8, 2.)
+    bsolns = bp.solve (guess)
+    assert len (bsolns) == truth.shape[0]
+
+    for i in xrange (truth.shape[0]):
+        p = ResidualProblem (3, yobs[i], 100., gauss, None)
+        p.pLimit (2, 0.8, 2.)
+        s = p.solve (guess)
+        Taaae (bsolns[i].params, s.params, decimal=6)
+        Taae (bsolns[i].fnorm / s.fnorm, 1., decimal=6)
+        assert len (bsolns[i].status & set (('ftol', 'xtol', 'gtol')))
+
+
 # lmder1 / lmdif1 test cases
 
 def _lmder1_test (nout, func, jac, guess):
@@ -2291,7 +3937,30 @@ def _lmder1_driver (nout, func, jac, guess, target_fnorm1,
     p.gtol = 0
     p.maxiter = 100 * (guess.size + 1)
     s = p.solve (guess)
+    _lmder1_check (nout, func, s.params, target_fnorm2, target_params, decimal)
+
+    # The lockstep solver should reach the same answers. Roundoff can
+    # make its path differ from the serial one, so we only check the
+    # results.
 
+    def bfunc (params, vecs):
+        for i in xrange (params.shape[0]):
+            func (params[i], vecs[i])
+
+    def bjac (params, jacs):
+        for i in xrange (params.shape[0]):
+            jac (params[i], jacs[i])
+
+    bp = BatchProblem (guess.size, nout, bfunc, bjac)
+    bp.xtol = bp.ftol = tol
+    bp.gtol = 0
+    bp.maxiter = 100 * (guess.size + 1)
+
+    for bs in bp.solve (np.asarray ([guess, guess])):
+        _lmder1_check (nout, func, bs.params, target_fnorm2, target_params, decimal)
+
+
+def _lmder1_check (nout, func, params, target_fnorm2, target_params, decimal):
     if target_params is not None:
         # assert_array_almost_equal goes to a fixed number of decimal
         # places regardless of the scale of the number, so it breaks
@@ -2299,15 +3968,16 @@ def _lmder1_driver (nout, func, jac, guess, target_fnorm1,
         from numpy.testing import assert_array_almost_equal as aaae
         scale = np.maximum (np.abs (target_params), 1)
         try:
-            aaae (s.params / scale, target_params / scale, decimal=decimal)
+            aaae (params / scale, target_params / scale, decimal=decimal)
         except AssertionError:
             assert False, '''Arrays are not almost equal to %d (scaled) decimals
 
 x: %s
-y: %s''' % (decimal, s.params, target_params)
+y: %s''' % (decimal, params, target_params)
 
-    func (s.params, y)
-    fnorm2 = enorm_mpfit_careful (y, finfo)
+    y = np.empty (nout)
+    func (params, y)
+    fnorm2 = enorm_mpfit_careful (y, np.finfo (np.float))
     Taae (fnorm2, target_fnorm2)
 
 
@@ -2773,7 +4443,30 @@ def _lmder1_watson ():
                       0.9074113646884637e+01, -0.4541375466608216e+01, 0.1012011888536897e+01])
 
 
+@test
+def _lapack_core_lmder1 ():
+    # Rerun the lmder1 problems with the LAPACK-backed numerical core.
+
+    prev = Problem.linalg
+
+    failed = []
+
+    try:
+        Problem.linalg = 'lapack'
+        for f in _testfuncs:
+            if f.__name__.startswith ('_lmder1_'):
+                try:
+                    f ()
+                except AssertionError:
+                    failed.append (f.__name__)
+    finally:
+        Problem.linalg = prev
+
+    assert not len (failed), 'failed with LAPACK core: ' + ' '.join (failed)
+
+
 # Finally ...
 
 if __name__ == '__main__':
-    _runtests ()
+    if len (_runtests ()):
+        raise SystemExit (1)
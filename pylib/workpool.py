@@ -0,0 +1,31 @@
+# Copyright 2014 Peter Williams
+# Licensed under the GNU General Public License version 3 or higher
+
+"""workpool - Choose how to run a batch of independent jobs.
+
+make_pool (mode, nprocesses) returns an object with a map() method: a
+multiprocessing.Pool for mode 'process', a ThreadPool for 'thread', or a
+SerialMapper, which just runs the jobs in the calling thread, for
+'serial'. Callers should close() and join() the real pools when they're
+done; a SerialMapper has no such methods.
+"""
+
+__all__ = ['SerialMapper', 'make_pool']
+
+
+class SerialMapper (object):
+    def map (self, func, args):
+        return [func (a) for a in args]
+
+
+def make_pool (mode, nprocesses):
+    if mode == 'serial':
+        return SerialMapper ()
+    if mode == 'thread':
+        from multiprocessing.pool import ThreadPool
+        return ThreadPool (nprocesses)
+    if mode == 'process':
+        from multiprocessing import Pool
+        return Pool (nprocesses)
+    raise ValueError ('`mode` must be "serial", "thread", or "process"; got %r'
+                      % (mode, ))
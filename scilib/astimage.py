@@ -132,15 +132,55 @@ class AstroImage (object):
         raise NotImplementedError ()
 
 
+    def readRegion (self, region, squeeze=False, flip=False):
+        """Read part of the image. `region` indexes the image as a Numpy
+        array would be indexed, with integers and slices only, so that
+        readRegion (r, flip=f) returns the same data as read (flip=f)[r].
+        Where the backend allows it, only the data needed are read."""
+        self._checkOpen ()
+        region = _normalize_region (region, self.shape)
+        if flip:
+            region = _flip_region (region, self.shape)
+
+        data = self._readRegion (region)
+
+        if squeeze:
+            data = data.squeeze ()
+        return data
+
+
+    def readPlane (self, planeidx=(), squeeze=False, flip=False):
+        """Read a single 2D plane of the image. `planeidx` gives the
+        indices along the leading, non-planar axes (in C order, like
+        `shape`)."""
+        planeidx = tuple (int (i) for i in planeidx)
+        if len (planeidx) != self.shape.size - 2:
+            raise ValueError ('expected %d plane indices, got %d'
+                              % (self.shape.size - 2, len (planeidx)))
+        return self.readRegion (planeidx + (slice (None), slice (None)),
+                                squeeze=squeeze, flip=flip)
+
+
+    def _readRegion (self, region):
+        # Fallback for backends that can't read subsets efficiently;
+        # `region` has been normalized and is in unflipped terms.
+        return self.read ()[region]
+
+
     def write (self, data):
         raise NotImplementedError ()
 
 
     def toworld (self, pixel):
+        """Convert pixel coordinates to world coordinates. `pixel` has shape
+        (naxis, ...): either one coordinate vector, or many of them
+        stacked along the trailing axes, which are all converted in one
+        call. The result has the same shape."""
         raise NotImplementedError ()
 
 
     def topixel (self, world):
+        """The inverse of toworld(), with the same conventions."""
         raise NotImplementedError ()
 
 
@@ -162,6 +202,121 @@ class AstroImage (object):
         raise NotImplementedError ()
 
 
+def _normalize_region (region, shape):
+    """Turn a Numpy-style index of ints, slices, and possibly an Ellipsis into
+    a tuple with one int or slice per axis, with nonnegative ints."""
+
+    if not isinstance (region, tuple):
+        region = (region, )
+
+    naxis = len (shape)
+    nell = sum (1 for r in region if r is Ellipsis)
+    if nell > 1:
+        raise IndexError ('an index can only have a single ellipsis')
+    if nell == 1:
+        i = list (region).index (Ellipsis)
+        fill = (slice (None), ) * (naxis - len (region) + 1)
+        region = region[:i] + fill + region[i+1:]
+
+    if len (region) > naxis:
+        raise IndexError ('too many indices for a %d-dimensional image' % naxis)
+
+    region = region + (slice (None), ) * (naxis - len (region))
+    result = []
+
+    for r, n in zip (region, shape):
+        if isinstance (r, slice):
+            result.append (r)
+            continue
+
+        try:
+            i = int (r)
+        except TypeError:
+            raise IndexError ('image regions may only contain integers and slices')
+
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError ('index %d out of bounds for axis of size %d' % (r, n))
+        result.append (i)
+
+    return tuple (result)
+
+
+def _flip_region (region, shape):
+    """Express a normalized region of the latitude-flipped image (as returned
+    by read (flip=True)) in terms of the unflipped image."""
+
+    n = shape[-2]
+    r = region[-2]
+
+    if isinstance (r, slice):
+        start, stop, step = r.indices (n)
+        if len (xrange (start, stop, step)) == 0:
+            # The mapping below would send the start to -1, which wraps.
+            r = slice (0, 0)
+        else:
+            stop = n - 1 - stop
+            r = slice (n - 1 - start, None if stop < 0 else stop, -step)
+    else:
+        r = n - 1 - r
+
+    return region[:-2] + (r, ) + region[-1:]
+
+
+def _region_to_box (region, shape):
+    """Express a normalized region as (blc, trc, inc, post): the inclusive
+    corners and stride of a box of data that can be read with a positive
+    increment, and an index to apply to that box to get the final result
+    (reversing axes with negative steps and dropping integer-indexed
+    axes). Returns None if the region is empty."""
+
+    blc, trc, inc, post = [], [], [], []
+
+    for r, n in zip (region, shape):
+        if not isinstance (r, slice):
+            blc.append (r)
+            trc.append (r)
+            inc.append (1)
+            post.append (0)
+            continue
+
+        start, stop, step = r.indices (n)
+        count = len (xrange (start, stop, step))
+        if count == 0:
+            return None
+
+        last = start + (count - 1) * step
+
+        if step > 0:
+            blc.append (start)
+            trc.append (last)
+            post.append (slice (None))
+        else:
+            blc.append (last)
+            trc.append (start)
+            post.append (slice (None, None, -1))
+
+        inc.append (abs (step))
+
+    return blc, trc, inc, tuple (post)
+
+
+def _empty_region (region, shape):
+    """A masked array of the right shape for a region containing no data."""
+    rshape = [len (xrange (*r.indices (n))) for r, n in zip (region, shape)
+              if isinstance (r, slice)]
+    return np.ma.zeros (rshape, dtype=np.float32)
+
+
+def _mask_nonfinite (data):
+    """Wrap image data as a masked array, masking non-finite values. No mask
+    array is allocated unless some values actually are non-finite."""
+    if np.isfinite (data).all ():
+        return np.ma.MaskedArray (data)
+    return np.ma.masked_invalid (data, copy=False)
+
+
 def maybescale (x, a):
     if x is None:
         return None
@@ -199,28 +354,32 @@ def _get_wcs_scale (wcs, naxis):
     return wcscale
 
 
+def _coord_stack (coords, naxis, what):
+    """Check that `coords` has shape (naxis, ...) and return it along with a
+    (naxis, n) view of the coordinates, to be transformed in one go."""
+    coords = np.asarray (coords, dtype=np.float)
+    if coords.shape[:1] != (naxis, ):
+        raise ValueError ('%s coordinates must have shape (%d, ...); got %s'
+                          % (what, naxis, coords.shape))
+    return coords, coords.reshape ((naxis, -1))
+
+
 def _wcs_toworld (wcs, pixel, wcscale, naxis):
     # TODO: we don't allow the usage of "SIP" or "Paper IV"
     # transformations, let alone a concatenation of these, because
     # they're not invertible.
 
-    pixel = np.asarray (pixel)
-    if pixel.shape != (naxis, ):
-        raise ValueError ('pixel coordinate must be a %d-element vector', naxis)
-
-    pixel = pixel.reshape ((1, naxis))[:,::-1]
-    world = wcs.wcs_pix2sky (pixel, 0)
-    return world[0,::-1] * wcscale
+    pixel, flat = _coord_stack (pixel, naxis, 'pixel')
+    world = wcs.wcs_pix2sky (flat[::-1].T, 0)
+    world = world.T[::-1] * wcscale.reshape ((naxis, 1))
+    return world.reshape (pixel.shape)
 
 
 def _wcs_topixel (wcs, world, wcscale, naxis):
-    world = np.asarray (world)
-    if world.shape != (naxis, ):
-        raise ValueError ('world coordinate must be a %d-element vector', naxis)
-
-    world = (world / wcscale)[::-1].reshape ((1, naxis))
-    pixel = wcs.wcs_sky2pix (world, 0)
-    return pixel[0,::-1]
+    world, flat = _coord_stack (world, naxis, 'world')
+    flat = flat / wcscale.reshape ((naxis, 1))
+    pixel = wcs.wcs_sky2pix (flat[::-1].T, 0)
+    return pixel.T[::-1].reshape (world.shape)
 
 
 def _wcs_axes (wcs, naxis):
@@ -339,6 +498,28 @@ class MIRIADImage (AstroImage):
         return data
 
 
+    def _readRegion (self, region):
+        # Only the planes touched by the region are read.
+        nonplane = self.shape[:-2]
+        sel = [np.atleast_1d (np.arange (n)[r]) for r, n in zip (region[:-2], nonplane)]
+        selshape = tuple (x.size for x in sel) + tuple (self.shape[-2:])
+
+        if nonplane.size == 0:
+            data = self._handle.readPlane ([])
+        else:
+            data = np.ma.empty (selshape, dtype=np.float32)
+            data.mask = np.zeros (selshape, dtype=np.bool)
+
+            for idx in np.ndindex (*selshape[:-2]):
+                # Must convert from C to Fortran indexing convention
+                axes = [int (sel[i][j]) for i, j in enumerate (idx)][::-1]
+                self._handle.readPlane (axes, data[idx])
+
+        post = tuple (0 if not isinstance (r, slice) else slice (None)
+                      for r in region[:-2]) + region[-2:]
+        return data[post]
+
+
     def write (self, data):
         data = np.ma.asarray (data)
 
@@ -592,6 +773,15 @@ class PyrapImage (AstroImage):
         return data
 
 
+    def _readRegion (self, region):
+        box = _region_to_box (region, self.shape)
+        if box is None:
+            return _empty_region (region, self.shape)
+
+        blc, trc, inc, post = box
+        return self._handle.get (blc, trc, inc)[post]
+
+
     def write (self, data):
         data = np.ma.asarray (data)
 
@@ -606,15 +796,28 @@ class PyrapImage (AstroImage):
 
 
     def toworld (self, pixel):
+        # pyrap only converts one coordinate at a time.
         self._checkOpen ()
-        pixel = np.asarray (pixel)
-        return self._wcscale * np.asarray (self._handle.toworld (pixel))
+        pixel, flat = _coord_stack (pixel, self.shape.size, 'pixel')
+        world = np.empty (flat.shape)
+
+        for i in xrange (flat.shape[1]):
+            world[:,i] = self._handle.toworld (flat[:,i])
+
+        world *= self._wcscale.reshape ((-1, 1))
+        return world.reshape (pixel.shape)
 
 
     def topixel (self, world):
         self._checkOpen ()
-        world = np.asarray (world)
-        return np.asarray (self._handle.topixel (world / self._wcscale))
+        world, flat = _coord_stack (world, self.shape.size, 'world')
+        flat = flat / self._wcscale.reshape ((-1, 1))
+        pixel = np.empty (flat.shape)
+
+        for i in xrange (flat.shape[1]):
+            pixel[:,i] = self._handle.topixel (flat[:,i])
+
+        return pixel.reshape (world.shape)
 
 
     def saveCopy (self, path, overwrite=False, openmode=None):
@@ -659,6 +862,14 @@ def _casac_convert (d, unitstr):
     return qa.convert (x, unitstr)['value']
 
 
+def _casac_numeric (v):
+    # The "many" coordinate conversions return either an array or a
+    # record containing one, depending on the CASA version.
+    if isinstance (v, dict):
+        return v['numeric']
+    return v
+
+
 def _casac_findwcoord (cs, kind):
     v = cs.findcoordinate (kind)
     if 'world' in v:
@@ -745,6 +956,23 @@ class CasaCImage (AstroImage):
         return data
 
 
+    def _readRegion (self, region):
+        box = _region_to_box (region, self.shape)
+        if box is None:
+            return _empty_region (region, self.shape)
+
+        # Back to CASA's axis ordering, and Python ints; see read().
+        blc, trc, inc, post = box
+        blc = [int (x) for x in blc[::-1]]
+        trc = [int (x) for x in trc[::-1]]
+        inc = [int (x) for x in inc[::-1]]
+
+        data = self._handle.getchunk (blc, trc, inc, getmask=False).T
+        mask = self._handle.getchunk (blc, trc, inc, getmask=True).T
+        np.logical_not (mask, mask)
+        return np.ma.MaskedArray (data, mask=mask)[post]
+
+
     def write (self, data):
         self._checkOpen ()
         self._checkWriteable ()
@@ -762,39 +990,45 @@ class CasaCImage (AstroImage):
 
 
     def toworld (self, pixel):
-        # TODO: CASA quantities seem to be spat out in radians and Hz,
+        # TODO: CASA coordinates seem to be spat out in radians and Hz,
         # which work well enough for us. But this might not be
         # reliable. And perhaps we'll want to enforce units for
         # frequency and/or velocity axes.
 
         self._checkOpen ()
-        pixel = np.asarray (pixel)[::-1] # reverse to CASA's ordering
-        qtys = self._handle.toworld (pixel, format='q')['quantity']
+        pixel, flat = _coord_stack (pixel, self.shape.size, 'pixel')
+        cs = self._handle.coordsys ()
+
+        try:
+            # Reverse to CASA's ordering.
+            casaworld = _casac_numeric (cs.toworldmany (flat[::-1].copy ()))
+        finally:
+            cs.done ()
 
         # Our "world" coordinates are still in what CASA would call
         # its "pixel" ordering. This will probably all go down in
         # flames if anyone ever reorders or removes axes.
 
-        naxis = self.shape.size
-        world = np.empty (naxis)
-        for i in xrange (naxis):
-            s = '*%d' % (self._pax2wax[i] + 1)
-            world[i] = qtys[s]['value']
-
-        return world
+        world = np.asarray (casaworld).reshape ((-1, flat.shape[1]))[self._pax2wax]
+        return world.reshape (pixel.shape)
 
 
     def topixel (self, world):
         self._checkOpen ()
-        myworld = np.asarray (world)
+        world, flat = _coord_stack (world, self.shape.size, 'world')
         ncwa = self._wax2pax.size # num of CASA world axes
-        casaworld = np.zeros (ncwa)
+        casaworld = np.zeros ((ncwa, flat.shape[1]))
+        casaworld[self._pax2wax] = flat
+
+        cs = self._handle.coordsys ()
 
-        for i in xrange (ncwa):
-            casaworld[self._pax2wax[i]] = myworld[i]
+        try:
+            casapixel = _casac_numeric (cs.topixelmany (casaworld))
+        finally:
+            cs.done ()
 
-        casapixel = self._handle.topixel (casaworld)['numeric']
-        return casapixel[::-1].copy ()
+        casapixel = np.asarray (casapixel).reshape ((-1, flat.shape[1]))
+        return casapixel[::-1].reshape (world.shape)
 
 
     def saveCopy (self, path, overwrite=False, openmode=None):
@@ -850,6 +1084,10 @@ except ImportError:
 
 
 class FITSImage (AstroImage):
+    """The data are memory-mapped where pyfits allows it (it does not for
+    scaled integer data), so that readRegion() and readPlane() only
+    touch the parts of the file that they need."""
+
     _modemap = {'r': 'readonly',
                 'rw': 'update' # ???
                 }
@@ -875,7 +1113,7 @@ class FITSImage (AstroImage):
 
         super (FITSImage, self).__init__ (path, mode)
 
-        self._handle = pyfits.open (path, self._modemap[mode])
+        self._handle = pyfits.open (path, self._modemap[mode], memmap=True)
         header = self._handle[0].header
         self._wcs = pywcs.WCS (header)
         self._wcs.wcs.set ()
@@ -928,9 +1166,8 @@ class FITSImage (AstroImage):
 
     def read (self, squeeze=False, flip=False):
         self._checkOpen ()
-        data = np.ma.asarray (self._handle[0].data)
         # Are there other standards for expressing masking in FITS?
-        data.mask = -np.isfinite (data.data)
+        data = _mask_nonfinite (self._handle[0].data)
 
         if flip:
             data = data[...,::-1,:]
@@ -939,6 +1176,10 @@ class FITSImage (AstroImage):
         return data
 
 
+    def _readRegion (self, region):
+        return _mask_nonfinite (self._handle[0].data[region])
+
+
     def write (self, data):
         data = np.ma.asarray (data)
 
@@ -1053,7 +1294,7 @@ class SimpleImage (AstroImage):
     def read (self, squeeze=False, flip=False):
         self._checkOpen ()
         data = self._handle.read (flip=flip)
-        idx = list (self._pctmpl)
+        idx = [0] * self._handle.shape.size
         idx[self._platax] = slice (None)
         idx[self._plonax] = slice (None)
         data = data[tuple (idx)]
@@ -1069,6 +1310,18 @@ class SimpleImage (AstroImage):
         return data
 
 
+    def _readRegion (self, region):
+        idx = [0] * self._handle.shape.size
+        idx[self._platax] = region[0]
+        idx[self._plonax] = region[1]
+        data = self._handle._readRegion (tuple (idx))
+
+        if self._platax > self._plonax and data.ndim == 2:
+            data = data.T
+
+        return data
+
+
     def write (self, data):
         data = np.ma.asarray (data)
 
@@ -1080,7 +1333,7 @@ class SimpleImage (AstroImage):
         self._checkWriteable ()
 
         fulldata = np.ma.empty (self._handle.shape, dtype=data.dtype)
-        idx = list (self._pctmpl)
+        idx = [0] * self._handle.shape.size
         idx[self._platax] = slice (None)
         idx[self._plonax] = slice (None)
 
@@ -1093,16 +1346,22 @@ class SimpleImage (AstroImage):
         return self
 
 
+    def _expand (self, coords, tmpl, what):
+        # Embed (lat, lon) coordinates in the parent's coordinate
+        # system, filling in the other axes from the template.
+        coords, flat = _coord_stack (coords, 2, what)
+        full = np.empty ((tmpl.size, flat.shape[1]))
+        full[:] = tmpl.reshape ((-1, 1))
+        full[self._platax] = flat[0]
+        full[self._plonax] = flat[1]
+        return coords, full
+
+
     def toworld (self, pixel):
         self._checkOpen ()
-        p = self._pctmpl.copy ()
-        p[self._platax] = pixel[0]
-        p[self._plonax] = pixel[1]
+        pixel, p = self._expand (pixel, self._pctmpl, 'pixel')
         w = self._handle.toworld (p)
-        world = np.empty (2)
-        world[0] = w[self._platax]
-        world[1] = w[self._plonax]
-        return world
+        return w[[self._platax, self._plonax]].reshape (pixel.shape)
 
 
     def topixel (self, world):
@@ -1112,14 +1371,9 @@ class SimpleImage (AstroImage):
                                     'this subimage prevents mapping from '
                                     'world to pixel coordinates')
 
-        w = self._wctmpl.copy ()
-        w[self._platax] = world[0]
-        w[self._plonax] = world[1]
+        world, w = self._expand (world, self._wctmpl, 'world')
         p = self._handle.topixel (w)
-        pixel = np.empty (2)
-        pixel[0] = p[self._platax]
-        pixel[1] = p[self._plonax]
-        return pixel
+        return p[[self._platax, self._plonax]].reshape (world.shape)
 
 
     def simple (self):
@@ -1157,3 +1411,45 @@ def open (path, mode):
         return FITSImage (path, mode)
 
     raise UnsupportedError ('cannot infer format of image "%s"' % path)
+
+
+def _test_readregion ():
+    """Check that readRegion (r, flip=f) matches read (flip=f)[r] for a
+    FITS image, including empty and out-of-range slices. Run by hand:
+    python -c 'import astimage; astimage._test_readregion ()'."""
+    import os, shutil, tempfile, pyfits
+
+    data = np.arange (3 * 4 * 5 * 6, dtype=np.float32).reshape ((3, 4, 5, 6))
+    data[1,2,3,4] = np.nan
+    E, S = Ellipsis, slice
+
+    regions = [(), (1, 2), (2, S (45, 50)), (E, 3, S (None)), (E, S (1, 4), 5),
+               (0, S (1, 3), S (None, None, 2), S (4, 1, -1)),
+               (E, S (3, 3), S (None)), (E, S (7, 9), S (None)),
+               (E, S (-9, -7), S (None)), (E, S (4, 1), S (None)),
+               (E, S (1, 4, -1), S (None)), (E, S (-2, None), S (None, None, -2)),
+               (E, S (None, None, -3), S (2, 8)), (E, S (10, None, -2), 0),
+               (S (2, 0, -1), 1, S (0, 5, 2), S (-1, None))]
+
+    tmpdir = tempfile.mkdtemp ()
+
+    try:
+        path = os.path.join (tmpdir, 'test.fits')
+        pyfits.PrimaryHDU (data).writeto (path)
+
+        with open (path, 'r') as img:
+            for flip in (False, True):
+                full = img.read (flip=flip)
+
+                for r in regions:
+                    got = img.readRegion (r, flip=flip)
+                    want = full[r]
+                    assert got.shape == want.shape, (r, flip)
+                    assert (np.ma.getmaskarray (got) ==
+                            np.ma.getmaskarray (want)).all (), (r, flip)
+                    assert (np.ma.filled (got, 0) ==
+                            np.ma.filled (want, 0)).all (), (r, flip)
+    finally:
+        shutil.rmtree (tmpdir)
+
+    print 'readRegion: OK'
@@ -54,6 +54,13 @@ For each transform other than "none", *factory_map* contains an entry
 with an underscore and the transform name applied (e.g.,
 "pkgw_reverse") that has that transform applied.
 
+For display, evaluating a mapper and packing its output into pixels is
+slow. *get_argb32_lut* returns a lookup table of packed Cairo ARGB32
+pixel values for any *factory_map* entry, sampling the map at
+DEFAULT_LUT_SIZE evenly-spaced points, with one extra entry for masked
+values. *apply_argb32_lut* then maps an array (possibly a masked one) of
+values between 0 and 1 into pixel values with a single lookup.
+
 The initial inspiration was an implementation of the ideas in
 "Diverging Color Maps for Scientific Visualization (Expanded)",
 Kenneth Moreland,
@@ -85,6 +92,7 @@ L, A, B = range (3) # fortunately this B and RGB's B agree...
 M, S, H = range (3)
 
 DEFAULT_SAMPLE_POINTS = 512
+DEFAULT_LUT_SIZE = 4096
 
 TRANSFORM_NONE = 'none'
 TRANSFORM_REVERSE = 'reverse'
@@ -542,6 +550,84 @@ def _fill_transforms ():
 _fill_transforms ()
 
 
+# Precomputed lookup tables of packed 32-bit pixels. A mapper is
+# evaluated once, at the table's sample points, and after that mapping is
+# just indexing.
+
+def pack_argb32 (mapped, alpha=0xFF):
+    """Pack mapper output, an array of shape (S + (3,)) with values between 0
+and 1, into an array of shape S of Cairo ARGB32 pixel values (uint32).
+Values outside of [0, 1], which spline-interpolated maps can produce
+slightly, are clipped.
+"""
+    mapped = np.clip (mapped, 0, 1)
+    argb = np.empty (mapped.shape[:-1], dtype=np.uint32)
+    argb.fill (alpha << 24)
+    argb |= np.rint (mapped[...,R] * 0xFF).astype (np.uint32) << 16
+    argb |= np.rint (mapped[...,G] * 0xFF).astype (np.uint32) << 8
+    argb |= np.rint (mapped[...,B] * 0xFF).astype (np.uint32)
+    return argb
+
+
+def make_argb32_lut (mapper, size=DEFAULT_LUT_SIZE, maskcolor=0):
+    """Sample *mapper* at *size* evenly-spaced values between 0 and 1,
+inclusive, and return the results as packed ARGB32 values. The returned
+array has *size* + 1 entries; the last one is *maskcolor*, the pixel
+value used for masked data (transparent black by default).
+"""
+    if size < 2:
+        raise ValueError ('lookup table size must be at least 2; got %r' % size)
+
+    lut = np.empty (size + 1, dtype=np.uint32)
+    lut[:size] = pack_argb32 (mapper (np.linspace (0, 1, size)))
+    lut[size] = maskcolor
+    return lut
+
+
+_lut_cache = {}
+
+def get_argb32_lut (name, size=DEFAULT_LUT_SIZE, maskcolor=0):
+    """Get the ARGB32 lookup table for the *factory_map* entry *name*; see
+*make_argb32_lut*. Tables are cached, so the colormap is only evaluated
+the first time a given table is requested. The returned array should
+not be modified.
+"""
+    key = (name, size, maskcolor)
+    lut = _lut_cache.get (key)
+    if lut is None:
+        lut = make_argb32_lut (factory_map[name] (), size, maskcolor)
+        _lut_cache[key] = lut
+    return lut
+
+
+def apply_argb32_lut (lut, values, dest=None):
+    """Map *values*, an array of values between 0 and 1 that may be masked,
+into packed pixels using a table from *make_argb32_lut*. Values are
+rounded to the nearest table entry and clipped into range; masked and
+non-finite values get the table's mask color. The pixels are written
+into *dest* if it is given (it must have the same shape as *values* and
+dtype uint32, but needn't be contiguous) and returned.
+"""
+    n = lut.size - 1
+
+    idx = np.multiply (np.ma.getdata (values), n - 1)
+    bad = ~np.isfinite (idx)
+    np.clip (idx, 0, n - 1, idx)
+    idx += 0.5
+    idx[bad] = n
+    idx = idx.astype (np.intp)
+
+    mask = np.ma.getmask (values)
+    if mask is not np.ma.nomask:
+        idx[mask] = n
+
+    if dest is None:
+        return lut[idx]
+
+    np.take (lut, idx, out=dest)
+    return dest
+
+
 # Infrastructure for quickly rendering color maps.
 
 def showdemo (factoryname, **kwargs):
@@ -554,12 +640,7 @@ def showdemo (factoryname, **kwargs):
     array = array.reshape ((W, 1))
     array = np.repeat (array, H, 1).T
 
-    mapped = colormap (array)
-    argb = np.empty ((H, W), dtype=np.uint32)
-    argb.fill (0xFF000000)
-    argb |= (mapped[:,:,0] * 0xFF).astype (np.uint32) << 16
-    argb |= (mapped[:,:,1] * 0xFF).astype (np.uint32) << 8
-    argb |= (mapped[:,:,2] * 0xFF).astype (np.uint32)
+    argb = pack_argb32 (colormap (array))
 
     surf = cairo.ImageSurface.create_for_data (argb, cairo.FORMAT_ARGB32,
                                                W, H, W * 4)
@@ -585,6 +666,22 @@ def showdemo (factoryname, **kwargs):
     gtk.main ()
 
 
+def _test_apply_argb32_lut ():
+    lut = make_argb32_lut (black_to_white (), size=16, maskcolor=0x12345678)
+    values = np.ma.array ([[0., 0.5, 1., np.nan],
+                           [-1., 2., np.inf, 0.25]])
+    values[1,3] = np.ma.masked
+
+    expect = lut[np.array ([[0, 8, 15, 16], [0, 15, 16, 16]])]
+    assert (apply_argb32_lut (lut, values) == expect).all ()
+
+    dest = np.zeros ((4, 2), dtype=np.uint32).T
+    assert apply_argb32_lut (lut, values, dest) is dest
+    assert (dest == expect).all ()
+    assert (apply_argb32_lut (lut, values.data)[:,3] == lut[[16, 4]]).all ()
+    print 'apply_argb32_lut: OK'
+
+
 def printmaps ():
     print 'Available color maps:'
 
@@ -596,5 +693,7 @@ if __name__ == '__main__':
     import sys
     if len (sys.argv) < 2:
         printmaps ()
+    elif sys.argv[1] == '--test':
+        _test_apply_argb32_lut ()
     else:
         showdemo (sys.argv[1])
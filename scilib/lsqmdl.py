@@ -7,8 +7,12 @@ lsqmdl - model data with least-squares fitting
 
 Usage:
 
-  Model(func, data, [invsigma], [args]).solve(guess).printsoln()
+  Model(func, data, [invsigma], [args], [jfunc]).solve(guess).printsoln()
     func takes (p1, p2, p3[, *args]) and returns model data
+    jfunc, if given, takes the same arguments and returns a sequence of
+      the derivatives of the model data with respect to p1, p2, p3
+  Model(None, data, [invsigma]).setexpr('a * exp(-x / tau)', 'a tau', 'x', [args])
+    derivatives generated symbolically (requires sympy)
   PolynomialModel(maxexponent, x, data, [invsigma]).solve().plot()
   ScaleModel(x, data, [invsigma]).solve().showcov() # data = m*x
 
@@ -132,15 +136,19 @@ class _ModelBase (object):
 
 
 class Model (_ModelBase):
-    def __init__ (self, func, data, invsigma=None, args=()):
+    jfunc = None # optional analytic derivatives of func
+    expr = None # sympy expression, if set up with setexpr()
+
+    def __init__ (self, func, data, invsigma=None, args=(), jfunc=None):
         if func is not None:
-            self.setfunc (func, args)
+            self.setfunc (func, args, jfunc)
         if data is not None:
             self.setdata (data, invsigma)
 
 
-    def setfunc (self, func, args=()):
+    def setfunc (self, func, args=(), jfunc=None):
         self.func = func
+        self.jfunc = jfunc
         self._args = args
 
         # Create the Problem here so the caller can futz with it
@@ -153,27 +161,81 @@ class Model (_ModelBase):
         self.paramnames = func.func_code.co_varnames[:narg]
 
 
-    def setfunc_hack (self, func, npar, paramnames, args=()):
+    def setfunc_hack (self, func, npar, paramnames, args=(), jfunc=None):
         """This is a hack to make it not-impossible to have variable numbers of
         parameters in the lsqmodel framework."""
         self.func = func
+        self.jfunc = jfunc
         self._args = args
         import lmmin
         self.lm_prob = lmmin.Problem (npar)
         self.paramnames = list (paramnames)
 
 
+    def setexpr (self, expr, paramnames, argnames=(), args=()):
+        """Model the data with a symbolic expression, given either as a sympy
+        expression or as a string to be parsed by sympy. `paramnames` and
+        `argnames` name the symbols that are the fit parameters and the
+        extra arguments (e.g., the X values), either as sequences or as
+        whitespace-separated strings. The model function and its analytic
+        derivatives are compiled into numpy code with sympy.lambdify."""
+        import sympy
+
+        if isinstance (paramnames, basestring):
+            paramnames = paramnames.split ()
+        if isinstance (argnames, basestring):
+            argnames = argnames.split ()
+
+        psyms = [sympy.Symbol (n) for n in paramnames]
+        asyms = [sympy.Symbol (n) for n in argnames]
+        allsyms = psyms + asyms
+
+        if isinstance (expr, basestring):
+            expr = sympy.sympify (expr, locals=dict ((s.name, s) for s in allsyms))
+
+        func = sympy.lambdify (allsyms, expr, 'numpy')
+        jfunc = sympy.lambdify (allsyms, [sympy.diff (expr, p) for p in psyms],
+                                'numpy')
+
+        self.setfunc_hack (func, len (psyms), paramnames, args, jfunc)
+        self.expr = expr
+        return self
+
+
     def solve (self, guess):
         guess = np.array (guess, dtype=np.float, ndmin=1)
         f = self.func
-        args = self._args
+        jf = self.jfunc
+        args = list (self._args)
+        shape = self.data.shape
+
+        # The model values are written straight into lmmin's buffers,
+        # avoiding temporary copies. Values of the right size are taken in
+        # C order whatever their shape, since funcs may return flattened
+        # data; others are broadcast through a view with the data's shape.
 
         def lmfunc (params, vec):
-            vec[:] = f (*(tuple (params) + args)).flatten ()
+            result = np.asarray (f (*(params.tolist () + args)))
+            if result.size == vec.size:
+                vec[:] = result.reshape (-1)
+            else:
+                vec.reshape (shape)[...] = result
+
+        if jf is None:
+            lmjac = None
+        else:
+            def lmjac (params, jac):
+                # Derivatives may be scalars (e.g. for an additive constant).
+                for i, d in enumerate (jf (*(params.tolist () + args))):
+                    d = np.asarray (d)
+                    if d.size == jac.shape[1]:
+                        jac[i] = d.reshape (-1)
+                    else:
+                        jac[i].reshape (shape)[...] = d
 
         self.lm_prob.setResidualFunc (self.data.flatten (),
                                       self.invsigma.flatten (),
-                                      lmfunc, None)
+                                      lmfunc, lmjac)
         self.lm_soln = soln = self.lm_prob.solve (guess)
 
         self.params = soln.params
@@ -280,6 +342,17 @@ class ModelComponent (object):
         """Compute the Jacobian. `jac[i]` is d`mdata`/d`pars[i]`."""
         pass
 
+    def sparse_deriv (self, pars, ndata):
+        """Compute the Jacobian as a scipy.sparse matrix of shape (npar, ndata),
+        for ComposedModels solved with sparse=True. The default wraps the
+        dense result of `deriv`; components whose parameters each affect
+        only a few data points should override this to declare that
+        structure."""
+        from scipy import sparse
+        jac = np.zeros ((self.npar, ndata))
+        self.deriv (pars, jac)
+        return sparse.csr_matrix (jac)
+
     def extract (self, pars, perr, cov):
         """Extract fit results into the object for ease of inspection."""
         self.covar = cov
@@ -305,7 +378,15 @@ class ModelComponent (object):
 
 
 class ComposedModel (_ModelBase):
-    def __init__ (self, component, data, invsigma=None):
+    """If `sparse` is true, the Jacobian is assembled from the components'
+    `sparse_deriv` methods and the fit is done with lmmin.SparseProblem,
+    so that models with very many parameters, each affecting few data
+    points, never need the dense (npar, ndata) Jacobian."""
+
+    sparse = False
+
+    def __init__ (self, component, data, invsigma=None, sparse=False):
+        self.sparse = sparse
         if component is not None:
             self.setcomponent (component)
         if data is not None:
@@ -342,7 +423,10 @@ class ComposedModel (_ModelBase):
         component.finalize_setup ()
 
         import lmmin
-        self.lm_prob = lmmin.Problem (component.npar)
+        if self.sparse:
+            self.lm_prob = lmmin.SparseProblem (component.npar)
+        else:
+            self.lm_prob = lmmin.Problem (component.npar)
         self.force_guess = np.empty (component.npar)
         self.force_guess.fill (np.nan)
         self.paramnames = list (component._param_names ())
@@ -365,9 +449,15 @@ class ComposedModel (_ModelBase):
             self.component.model (pars, outputs)
 
         self.lm_model = model
-        self.lm_deriv = self.component.deriv
+
+        if self.sparse:
+            from functools import partial
+            self.lm_deriv = partial (_sparse_deriv, self.component, self.data.size)
+        else:
+            self.lm_deriv = self.component.deriv
+
         self.lm_prob.setResidualFunc (self.data, self.invsigma, model,
-                                      self.component.deriv)
+                                      self.lm_deriv)
         self.lm_soln = soln = self.lm_prob.solve (guess)
 
         self.params = soln.params
@@ -394,7 +484,11 @@ class ComposedModel (_ModelBase):
         """returns (explicit, auto)"""
         import lmmin
         return lmmin.checkDerivative (self.component.npar, self.data.size,
-                                      self.lm_model, self.lm_deriv, guess)
+                                      self.lm_model, self.component.deriv, guess)
+
+
+def _sparse_deriv (component, ndata, pars):
+    return component.sparse_deriv (pars, ndata)
 
 
 # Now specific components useful in the above framework. The general strategy
@@ -442,6 +536,10 @@ class AddValuesComponent (ModelComponent):
     def deriv (self, pars, jac):
         jac[:,:] = np.eye (self.npar)
 
+    def sparse_deriv (self, pars, ndata):
+        from scipy import sparse
+        return sparse.identity (self.npar, format='csr')
+
     def _outputshape (self):
         return (self.npar,)
 
@@ -609,6 +707,18 @@ class SeriesComponent (ModelComponent):
             ofs += c.npar
 
 
+    def sparse_deriv (self, pars, ndata):
+        from scipy import sparse
+        blocks = []
+        ofs = 0
+
+        for c in self.components:
+            blocks.append (c.sparse_deriv (pars[ofs:ofs+c.npar], ndata))
+            ofs += c.npar
+
+        return sparse.vstack (blocks, format='csr')
+
+
     def extract (self, pars, perr, cov):
         ofs = 0
 
@@ -773,6 +883,30 @@ class MatMultComponent (ModelComponent):
             jac[i] = (np.dot (ja[i], mb) + np.dot (ma, jb[i])).reshape (k * nd)
 
 
+    def sparse_deriv (self, pars, ndata):
+        # The parameters of B component i only affect the outputs through
+        # row i of B, so their block is the Kronecker product of column i
+        # of A with that component's own Jacobian.
+        from scipy import sparse
+
+        k = self.k
+        nd = ndata // k
+        ma, mb = self._sep_model (pars, nd)
+
+        c = self.acomponent
+        ja = np.zeros ((c.npar, k, k))
+        c.deriv (pars[:c.npar], ja.reshape ((c.npar, k**2)))
+        blocks = [sparse.csr_matrix (np.dot (ja, mb).reshape ((c.npar, k * nd)))]
+        pofs = c.npar
+
+        for i, c in enumerate (self.bcomponents):
+            jb = c.sparse_deriv (pars[pofs:pofs+c.npar], nd)
+            blocks.append (sparse.kron (ma[:,i].reshape ((1, k)), jb))
+            pofs += c.npar
+
+        return sparse.vstack (blocks, format='csr')
+
+
     def extract (self, pars, perr, cov):
         c = self.acomponent
         c.extract (pars[:c.npar], perr[:c.npar], cov[:c.npar,:c.npar])
@@ -888,6 +1022,15 @@ class ScaleComponent (ModelComponent):
         jac[1:] *= pars[0]
 
 
+    def sparse_deriv (self, pars, ndata):
+        from scipy import sparse
+        m = np.zeros ((1, ndata))
+        self.subcomp.model (pars[1:], m[0])
+        return sparse.vstack ([sparse.csr_matrix (m),
+                               self.subcomp.sparse_deriv (pars[1:], ndata) * pars[0]],
+                              format='csr')
+
+
     def extract (self, pars, perr, cov):
         self.f_factor = pars[0]
         self.u_factor = perr[0]
@@ -66,34 +66,33 @@ class LazyComputer (object):
         return self
 
 
-    def ensureRegionUpdated (self, data, xoffset, yoffset, width, height):
+    def tilesInRegion (self, xoffset, yoffset, width, height):
+        """Generate (tilei, tilej, pyofs, pxofs) for the tiles overlapping the
+        specified region: the tile indices into `valid` and the pixel
+        offsets of their top-left corners."""
         ts = self.tilesize
-        buf = self.buffer
-        valid = self.valid
-        func = self._makeFunc (np.ma.is_masked (data))
-
         tilej = xoffset // ts
         tilei = yoffset // ts
         nxt = (xoffset + width + ts - 1) // ts - tilej
         nyt = (yoffset + height + ts - 1) // ts - tilei
 
-        tyofs = tilei
-        pyofs = tilei * ts
+        for i in xrange (tilei, tilei + nyt):
+            for j in xrange (tilej, tilej + nxt):
+                yield i, j, i * ts, j * ts
 
-        for i in xrange (nyt):
-            txofs = tilej
-            pxofs = tilej * ts
 
-            for j in xrange (nxt):
-                if not valid[tyofs,txofs]:
-                    func (data[pyofs:pyofs+ts,pxofs:pxofs+ts],
-                          buf[pyofs:pyofs+ts,pxofs:pxofs+ts])
-                    valid[tyofs,txofs] = 1
+    def ensureRegionUpdated (self, data, xoffset, yoffset, width, height):
+        ts = self.tilesize
+        buf = self.buffer
+        valid = self.valid
+        func = self._makeFunc (np.ma.is_masked (data))
 
-                pxofs += ts
-                txofs += 1
-            pyofs += ts
-            tyofs += 1
+        for i, j, pyofs, pxofs in self.tilesInRegion (xoffset, yoffset,
+                                                      width, height):
+            if not valid[i,j]:
+                func (data[pyofs:pyofs+ts,pxofs:pxofs+ts],
+                      buf[pyofs:pyofs+ts,pxofs:pxofs+ts])
+                valid[i,j] = 1
 
         return self
 
@@ -146,7 +145,7 @@ class Clipper (LazyComputer):
 class ColorMapper (LazyComputer):
     def __init__ (self, mapname):
         import colormaps
-        self.mapper = colormaps.factory_map[mapname]()
+        self.lut = colormaps.get_argb32_lut (mapname)
 
 
     def allocBuffer (self, template):
@@ -156,59 +155,226 @@ class ColorMapper (LazyComputer):
 
 
     def _makeFunc (self, ismasked):
-        mapper = self.mapper
-        # I used to preallocate this scratch array, but doing
-        # "np.multiply (mapped[:,:,0], 0xFF, effscratch)" causes
-        # segfaults on Fedora 16. So, work around.
-        #scratch = np.zeros ((self.tilesize, self.tilesize), dtype=np.uint32)
+        # Masked pixels come out as transparent black either way, via the
+        # table's mask entry.
+        from colormaps import apply_argb32_lut
+        lut = self.lut
 
-        if not ismasked:
-            def func (src, dest):
-                #effscratch = scratch[:dest.shape[0],:dest.shape[1]]
-                mapped = mapper (src)
-                dest.fill (0xFF000000)
-                # New code:
-                effscratch = (mapped[:,:,0] * 0xFF).astype (np.uint32)
-                # Old code:
-                #np.multiply (mapped[:,:,0], 0xFF, effscratch)
-                np.left_shift (effscratch, 16, effscratch)
-                np.bitwise_or (dest, effscratch, dest)
-                effscratch = (mapped[:,:,1] * 0xFF).astype (np.uint32)
-                #np.multiply (mapped[:,:,1], 0xFF, effscratch)
-                np.left_shift (effscratch, 8, effscratch)
-                np.bitwise_or (dest, effscratch, dest)
-                effscratch = (mapped[:,:,2] * 0xFF).astype (np.uint32)
-                #np.multiply (mapped[:,:,2], 0xFF, effscratch)
-                np.bitwise_or (dest, effscratch, dest)
-        else:
-            scratch2 = np.zeros ((self.tilesize, self.tilesize), dtype=np.uint32)
-
-            def func (src, dest):
-                #effscratch = scratch[:dest.shape[0],:dest.shape[1]]
-                effscratch2 = scratch2[:dest.shape[0],:dest.shape[1]]
-                mapped = mapper (src)
-
-                dest.fill (0xFF000000)
-                # New code:
-                effscratch = (mapped[:,:,0] * 0xFF).astype (np.uint32)
-                # Old code:
-                #np.multiply (mapped[:,:,0], 0xFF, effscratch)
-                np.left_shift (effscratch, 16, effscratch)
-                np.bitwise_or (dest, effscratch, dest)
-                effscratch = (mapped[:,:,1] * 0xFF).astype (np.uint32)
-                #np.multiply (mapped[:,:,1], 0xFF, effscratch)
-                np.left_shift (effscratch, 8, effscratch)
-                np.bitwise_or (dest, effscratch, dest)
-                effscratch = (mapped[:,:,2] * 0xFF).astype (np.uint32)
-                #np.multiply (mapped[:,:,2], 0xFF, effscratch)
-                np.bitwise_or (dest, effscratch, dest)
-
-                np.invert (src.mask, effscratch2)
-                np.multiply (dest, effscratch2, dest)
+        def func (src, dest):
+            apply_argb32_lut (lut, src, dest)
 
         return func
 
 
+class Pyramid (object):
+    """Downsampled versions of a 2D (possibly masked) array, for displaying
+    it when zoomed out. Level 0 is the array itself, and each level after
+    that halves the resolution of the one before, combining blocks of 2x2
+    pixels with `reduce`, which is 'mean' or 'max'. Levels are computed
+    when first asked for, so only the ones that get viewed cost anything.
+    Levels stop once the array fits within `minsize` pixels in both
+    dimensions."""
+
+    def __init__ (self, data, reduce='mean', minsize=2*DEFAULT_TILESIZE):
+        if reduce not in ('mean', 'max'):
+            raise ValueError ('`reduce` must be "mean" or "max"; got %r'
+                              % (reduce, ))
+
+        self.reduce = reduce
+        self.levels = [data]
+
+        h, w = data.shape
+        self.nlevels = 1
+        while max (h, w) > minsize:
+            h, w = (h + 1) // 2, (w + 1) // 2
+            self.nlevels += 1
+
+
+    def level (self, i):
+        while len (self.levels) <= i:
+            self.levels.append (_downsample2 (self.levels[-1], self.reduce))
+        return self.levels[i]
+
+
+    def levelFor (self, scale):
+        """The index of the coarsest level whose pixels are no larger than
+        screen pixels when the full-resolution data are shown at `scale`
+        (screen pixels per data pixel)."""
+        if scale >= 0.5:
+            return 0
+        return min (int (np.floor (np.log2 (1. / scale))), self.nlevels - 1)
+
+
+def _downsample2 (data, reduce):
+    h, w = data.shape
+    h2, w2 = (h + 1) // 2, (w + 1) // 2
+
+    # Odd edges are padded with masked pixels, so that they don't affect
+    # the result.
+    if h % 2 or w % 2:
+        padded = np.ma.masked_all ((2 * h2, 2 * w2), dtype=data.dtype)
+        padded[:h,:w] = data
+    else:
+        padded = np.ma.asarray (data)
+
+    blocks = padded.reshape (h2, 2, w2, 2).swapaxes (1, 2).reshape (h2, w2, 4)
+
+    if reduce == 'max':
+        result = blocks.max (axis=2)
+    else:
+        result = blocks.mean (axis=2)
+        if np.issubdtype (data.dtype, np.floating):
+            result = result.astype (data.dtype)
+
+    if not np.ma.is_masked (result):
+        return result.filled ()
+    return result
+
+
+DEFAULT_RENDER_THREADS = 2
+
+class TileRenderer (object):
+    """Computes tiles of LazyComputers in a pool of background threads, so
+    that the GTK main loop doesn't block while a large region is being
+    recomputed.
+
+    A request names a chain of LazyComputers with the same shape and tile
+    size, each fed by the buffer of the one before it (the first is fed by
+    `data`); for instance, a Clipper and a ColorMapper. The workers compute
+    each invalid tile through the whole chain into scratch arrays. The
+    results are copied into the buffers, and the tiles marked valid, on
+    the main loop, which is polled while work is outstanding; `onupdate`
+    is then called, typically to queue a redraw. Results computed before
+    the most recent invalidate() are discarded."""
+
+    pollinterval = 25 # milliseconds
+
+    def __init__ (self, nthreads=DEFAULT_RENDER_THREADS, onupdate=None):
+        from multiprocessing.pool import ThreadPool
+        from Queue import Queue
+
+        # Without this, the GTK main loop holds the GIL while it waits
+        # for events, and the workers never get to run.
+        glib.threads_init ()
+
+        self.onupdate = onupdate
+        self.generation = 0
+        self.pending = set ()
+        self._done = Queue ()
+        self._pool = ThreadPool (nthreads)
+        self._sourceid = None
+
+
+    def close (self):
+        if self._sourceid is not None:
+            glib.source_remove (self._sourceid)
+            self._sourceid = None
+        self._pool.terminate ()
+        self._pool.join ()
+
+
+    def invalidate (self):
+        """Forget all outstanding work. The caller should invalidate the
+        LazyComputers themselves."""
+        self.generation += 1
+        self.pending.clear ()
+        return self
+
+
+    def request (self, data, chain, xoffset, yoffset, width, height,
+                 placeholder=None):
+        """Schedule computation of the invalid tiles of `chain` in the
+        specified region that aren't already in the works. If given,
+        `placeholder (pyofs, pxofs, tilesize)` is called for each newly
+        scheduled tile, so that the caller can fill in something to show
+        until it arrives. Returns whether any tiles are outstanding."""
+
+        last = chain[-1]
+        ts = last.tilesize
+        funcs = None
+
+        for i, j, pyofs, pxofs in last.tilesInRegion (xoffset, yoffset,
+                                                      width, height):
+            key = (id (last), i, j)
+            if last.valid[i,j] or key in self.pending:
+                continue
+
+            if funcs is None:
+                inputs = [data] + [c.buffer for c in chain[:-1]]
+                funcs = [c._makeFunc (np.ma.is_masked (x))
+                         for c, x in zip (chain, inputs)]
+
+            self.pending.add (key)
+            if placeholder is not None:
+                placeholder (pyofs, pxofs, ts)
+
+            self._pool.apply_async (self._work, (self.generation, key, data, chain,
+                                                 funcs, i, j, pyofs, pxofs),
+                                    callback=self._done.put)
+
+        if len (self.pending) and self._sourceid is None:
+            self._sourceid = glib.timeout_add (self.pollinterval, self._poll)
+
+        return len (self.pending) > 0
+
+
+    def _work (self, generation, key, data, chain, funcs, i, j, pyofs, pxofs):
+        if generation != self.generation:
+            return generation, key, None # stale; don't bother
+
+        try:
+            ts = chain[-1].tilesize
+            src = data[pyofs:pyofs+ts,pxofs:pxofs+ts]
+            results = []
+
+            for comp, func in zip (chain, funcs):
+                dest = comp.buffer[pyofs:pyofs+ts,pxofs:pxofs+ts].copy ()
+                func (src, dest)
+                results.append (dest)
+                src = dest
+        except Exception:
+            import sys, traceback
+            print >>sys.stderr, 'ndshow: error rendering tile:'
+            traceback.print_exc ()
+            return generation, key, None
+
+        return generation, key, (chain, results, i, j, pyofs, pxofs)
+
+
+    def _poll (self):
+        from Queue import Empty
+        updated = False
+
+        while True:
+            try:
+                generation, key, result = self._done.get_nowait ()
+            except Empty:
+                break
+
+            if generation != self.generation or key not in self.pending:
+                continue
+
+            self.pending.discard (key)
+            if result is None:
+                continue
+
+            chain, results, i, j, pyofs, pxofs = result
+            for comp, tile in zip (chain, results):
+                ts = comp.tilesize
+                comp.buffer[pyofs:pyofs+ts,pxofs:pxofs+ts] = tile
+                comp.valid[i,j] = 1
+            updated = True
+
+        if updated and self.onupdate is not None:
+            self.onupdate ()
+
+        if len (self.pending):
+            return True
+
+        self._sourceid = None
+        return False
+
+
 DRAG_TYPE_NONE = 0
 DRAG_TYPE_PAN = 1
 DRAG_TYPE_TUNER = 2
@@ -220,6 +386,7 @@ class Viewport (gtk.DrawingArea):
     getshape = None
     settuning = None
     getsurface = None
+    getsurface_multires = False
     onmotion = None
     drawoverlay = None
 
@@ -272,13 +439,31 @@ class Viewport (gtk.DrawingArea):
         return self
 
 
-    def setSurfaceGetter (self, getsurface):
+    def setSurfaceGetter (self, getsurface, multires=False):
+        """If `multires` is true, `getsurface` is passed the display scale as
+        a fifth argument and returns a fourth value, the number of data
+        pixels spanned by each pixel of the returned surface; the offsets
+        are still in data pixels. This lets it hand back a downsampled
+        surface when zoomed out. It also accepts a keyword argument `sync`;
+        if false, it may return a surface that is still being filled in
+        (see TileRenderer), and if true it must finish the job first."""
         if getsurface is not None and not callable (getsurface):
             raise ValueError ()
         self.getsurface = getsurface
+        self.getsurface_multires = multires
         return self
 
 
+    def _get_surface (self, xoffset, yoffset, width, height, scale, sync=False):
+        if not self.getsurface_multires:
+            surface, xoffset, yoffset = self.getsurface (xoffset, yoffset,
+                                                         width, height)
+            return surface, xoffset, yoffset, 1
+
+        return self.getsurface (xoffset, yoffset, width, height, scale,
+                                sync=sync)
+
+
     def setMotionHandler (self, onmotion):
         if onmotion is not None and not callable (onmotion):
             raise ValueError ()
@@ -336,7 +521,8 @@ class Viewport (gtk.DrawingArea):
             self.needtune = False
 
         dw, dh = self.getshape ()
-        surface, xoffset, yoffset = self.getsurface (0, 0, dw, dh)
+        surface, xoffset, yoffset, factor = self._get_surface (0, 0, dw, dh, 1.,
+                                                               sync=True)
         surface.write_to_png (filename)
 
 
@@ -358,7 +544,7 @@ class Viewport (gtk.DrawingArea):
         viewsurface = cairo.ImageSurface.create_for_data (viewdata, cairo.FORMAT_ARGB32,
                                                           width, height, stride)
         ctxt = cairo.Context (viewsurface)
-        self._draw_in_context (ctxt, width, height)
+        self._draw_in_context (ctxt, width, height, sync=True)
         viewsurface.write_to_png (filename)
 
 
@@ -376,7 +562,7 @@ class Viewport (gtk.DrawingArea):
         return datax, datay
 
 
-    def _draw_in_context (self, ctxt, width, height):
+    def _draw_in_context (self, ctxt, width, height, sync=False):
         if self.getshape is None or self.getsurface is None:
             raise Exception ('Must be called after setting '
                              'shape-getter and surface-getter')
@@ -395,14 +581,16 @@ class Viewport (gtk.DrawingArea):
         seendataheight = height / self.scale
         yoffset = 0.5 * (seendataheight - 1) - self.centery
 
-        surface, xoffset, yoffset = self.getsurface (xoffset, yoffset,
-                                                     seendatawidth, seendataheight)
+        surface, xoffset, yoffset, factor = \
+            self._get_surface (xoffset, yoffset, seendatawidth,
+                               seendataheight, self.scale, sync=sync)
 
+        # Each surface pixel spans `factor` data pixels.
         ctxt.save ()
         ctxt.set_source (self.bgpattern)
         ctxt.paint ()
-        ctxt.scale (self.scale, self.scale)
-        ctxt.set_source_surface (surface, xoffset, yoffset)
+        ctxt.scale (self.scale * factor, self.scale * factor)
+        ctxt.set_source_surface (surface, xoffset / factor, yoffset / factor)
         pat = ctxt.get_source ()
         pat.set_extend (cairo.EXTEND_NONE)
         pat.set_filter (cairo.FILTER_NEAREST)
@@ -600,8 +788,8 @@ class Viewer (object):
         return self
 
 
-    def setSurfaceGetter (self, getsurface):
-        self.viewport.setSurfaceGetter (getsurface)
+    def setSurfaceGetter (self, getsurface, multires=False):
+        self.viewport.setSurfaceGetter (getsurface, multires)
         return self
 
 
@@ -659,48 +847,97 @@ class Viewer (object):
 
 
 def view (array, title='Array Viewer', colormap='black_to_blue', toworld=None,
-          drawoverlay=None, yflip=False):
-    clipper = Clipper ()
-    clipper.allocBuffer (array)
-    clipper.setTileSize ()
-    clipper.defaultBounds (array)
-    processed = clipper.buffer
+          drawoverlay=None, yflip=False, reduce='mean',
+          nthreads=DEFAULT_RENDER_THREADS):
+    h, w = array.shape
+    pyramid = Pyramid (array, reduce)
+    top = pyramid.nlevels - 1
+
+    bounds = Clipper ().defaultBounds (array)
+    orig_min = bounds.dmin
+    orig_span = bounds.dmax - orig_min
+    tuning = [bounds.dmin, bounds.dmax]
+
+    # Per-level Clipper, ColorMapper, and surface, created on demand. The
+    # full-resolution buffers are never allocated if the image is only
+    # looked at zoomed out. The coarsest level is small and always
+    # computed synchronously; the others are computed in the background,
+    # with tiles of the coarsest level scaled up as placeholders.
+    levels = {}
+    renderer = TileRenderer (nthreads)
+
+    def getlevel (i):
+        lv = levels.get (i)
+        if lv is not None:
+            return lv
+
+        data = pyramid.level (i)
+        lh, lw = data.shape
+
+        clipper = Clipper ()
+        clipper.allocBuffer (data)
+        clipper.setTileSize ()
+        clipper.dmin, clipper.dmax = tuning
+
+        mapper = ColorMapper (colormap)
+        mapper.allocBuffer (data)
+        mapper.setTileSize ()
 
-    mapper = ColorMapper (colormap)
-    mapper.allocBuffer (array)
-    mapper.setTileSize ()
+        stride = cairo.ImageSurface.format_stride_for_width (cairo.FORMAT_ARGB32,
+                                                             lw)
+        assert stride % 4 == 0 # stride is in bytes
+        assert stride == 4 * lw # size of buffer is set in mapper
+        surface = cairo.ImageSurface.create_for_data (mapper.buffer,
+                                                      cairo.FORMAT_ARGB32,
+                                                      lw, lh, stride)
 
-    h, w = array.shape
-    stride = cairo.ImageSurface.format_stride_for_width (cairo.FORMAT_ARGB32,
-                                                         w)
-    assert stride % 4 == 0 # stride is in bytes
-    assert stride == 4 * w # size of buffer is set in mapper
-    imagesurface = cairo.ImageSurface.create_for_data (mapper.buffer,
-                                                       cairo.FORMAT_ARGB32,
-                                                       w, h, stride)
+        lv = levels[i] = (data, clipper, mapper, surface)
+        return lv
 
     def getshape ():
         return w, h
 
-    orig_min = clipper.dmin
-    orig_span = clipper.dmax - orig_min
-
     def settuning (tunerx, tunery):
-        clipper.dmin = orig_span * tunerx + orig_min
-        clipper.dmax = orig_span * tunery + orig_min
-        clipper.invalidate ()
-        mapper.invalidate ()
-
-    def getsurface (xoffset, yoffset, width, height):
-        pxofs = max (int (np.floor (-xoffset)), 0)
-        pyofs = max (int (np.floor (-yoffset)), 0)
-        pw = min (int (np.ceil (width)), w - pxofs)
-        ph = min (int (np.ceil (height)), h - pyofs)
-
-        clipper.ensureRegionUpdated (array, pxofs, pyofs, pw, ph)
-        mapper.ensureRegionUpdated (processed, pxofs, pyofs, pw, ph)
-
-        return imagesurface, xoffset, yoffset
+        tuning[:] = [orig_span * tunerx + orig_min,
+                     orig_span * tunery + orig_min]
+
+        for data, clipper, mapper, surface in levels.itervalues ():
+            clipper.dmin, clipper.dmax = tuning
+            clipper.invalidate ()
+            mapper.invalidate ()
+
+        renderer.invalidate ()
+
+    def getsurface (xoffset, yoffset, width, height, scale, sync=False):
+        i = pyramid.levelFor (scale)
+        factor = 1 << i
+        data, clipper, mapper, surface = getlevel (i)
+        lh, lw = data.shape
+
+        pxofs = max (int (np.floor (-xoffset / factor)), 0)
+        pyofs = max (int (np.floor (-yoffset / factor)), 0)
+        pw = min (int (np.ceil (width / factor)) + 1, lw - pxofs)
+        ph = min (int (np.ceil (height / factor)) + 1, lh - pyofs)
+
+        if sync or i == top:
+            clipper.ensureRegionUpdated (data, pxofs, pyofs, pw, ph)
+            mapper.ensureRegionUpdated (clipper.buffer, pxofs, pyofs, pw, ph)
+            return surface, xoffset, yoffset, factor
+
+        tdata, tclipper, tmapper, tsurface = getlevel (top)
+        tclipper.ensureAllUpdated (tdata)
+        tmapper.ensureAllUpdated (tclipper.buffer)
+        r = 1 << (top - i)
+
+        def placeholder (py, px, ts):
+            dest = mapper.buffer[py:py+ts,px:px+ts]
+            ys = np.arange (py, py + dest.shape[0]) // r
+            xs = np.arange (px, px + dest.shape[1]) // r
+            dest[...] = tmapper.buffer[ys[:,np.newaxis],xs]
+
+        renderer.request (data, (clipper, mapper), pxofs, pyofs, pw, ph,
+                          placeholder)
+        return surface, xoffset, yoffset, factor
 
     # I originally had the is_masked call inside fmtstatus and somehow
     # it ended up causing large lags in the label updates. Can't be
@@ -740,12 +977,14 @@ def view (array, title='Array Viewer', colormap='black_to_blue', toworld=None,
     viewer = Viewer (title=title)
     viewer.setShapeGetter (getshape)
     viewer.setTuningSetter (settuning)
-    viewer.setSurfaceGetter (getsurface)
+    viewer.setSurfaceGetter (getsurface, multires=True)
     viewer.setStatusFormatter (fmtstatus)
     viewer.setOverlayDrawer (drawoverlay)
+    renderer.onupdate = viewer.viewport.queue_draw
     viewer.win.show_all ()
     viewer.win.connect ('destroy', gtk.main_quit)
     gtk.main ()
+    renderer.close ()
 
 
 class Cycler (Viewer):
@@ -931,18 +1170,133 @@ class Cycler (Viewer):
         return super (Cycler, self)._on_key_press (widget, event)
 
 
+DEFAULT_CYCLE_CACHE = 6
+
+class PlaneCache (object):
+    """A bounded LRU cache of per-plane state for cycle(), with background
+    prefetching.
+
+    `loaders` is a list of functions returning the planes' data, and
+    `prepare (i, data)` turns the data for plane `i` into whatever is to be
+    cached. At most `size` prepared planes are kept. prefetch() loads and
+    prepares a plane in a background thread, one at a time; get() waits for
+    it to finish before loading anything itself, so that the loaders are
+    never run concurrently."""
+
+    def __init__ (self, loaders, prepare, size=DEFAULT_CYCLE_CACHE):
+        from collections import OrderedDict
+
+        if size < 1:
+            raise ValueError ('cache size must be at least 1; got %r' % size)
+
+        self.loaders = loaders
+        self.prepare = prepare
+        self.size = size
+        self._entries = OrderedDict ()
+        self._inflight = None # (index, AsyncResult)
+        self._pool = None
+
+
+    def _load (self, i):
+        return self.prepare (i, self.loaders[i] ())
+
+
+    def put (self, i, value):
+        self._entries.pop (i, None)
+        self._entries[i] = value
+        while len (self._entries) > self.size:
+            self._entries.popitem (last=False)
+        return value
+
+
+    def _collect (self, wait):
+        # Move a finished (or, if `wait`, the outstanding) prefetch into the
+        # cache.
+        if self._inflight is None:
+            return
+        i, result = self._inflight
+        if not wait and not result.ready ():
+            return
+        self._inflight = None
+        self.put (i, result.get ())
+
+
+    def get (self, i):
+        if i in self._entries:
+            value = self._entries.pop (i)
+            self._entries[i] = value # now most recently used
+            return value
+
+        if self._inflight is not None:
+            # The loaders needn't be reentrant (MIRIAD I/O isn't), so let
+            # any prefetch finish before loading on this thread.
+            prefetched = self._inflight[0] == i
+            self._collect (True)
+            if prefetched:
+                return self._entries[i]
+
+        return self.put (i, self._load (i))
+
+
+    def prefetch (self, i):
+        self._collect (False)
+        if i in self._entries or self._inflight is not None:
+            return
+
+        if self._pool is None:
+            from multiprocessing.pool import ThreadPool
+            glib.threads_init () # see TileRenderer
+            self._pool = ThreadPool (1)
+
+        self._inflight = (i, self._pool.apply_async (self._load, (i, )))
+
+
+    def close (self):
+        if self._pool is not None:
+            self._pool.terminate ()
+            self._pool.join ()
+            self._pool = None
+        self._inflight = None
+
+
+class _CyclePlane (object):
+    # The state that cycle() keeps for each plane in its PlaneCache.
+    array = fixed = antimask = imgdata = surface = None
+    nomask = True
+    tuning = None
+    maskversion = -1
+    merged = False
+
+
 def cycle (arrays, descs=None, cadence=0.6, toworlds=None,
-           drawoverlay=None, yflip=False):
+           drawoverlay=None, yflip=False, bounds=None,
+           cachesize=DEFAULT_CYCLE_CACHE, jointmask=False):
+    """Interactively cycle through a set of 2D arrays.
+
+    Each item of `arrays` may be an array or a function taking no arguments
+    that returns one (e.g., reading a plane of an image with `astimage`).
+    Arrays are converted for display when they're first shown, and only
+    the `cachesize` most recently viewed ones are kept; the next plane in
+    the cycle is loaded in the background while the current one is shown.
+    So only a few planes need to be in memory at once, and nothing needs to
+    be loaded before the first one can be shown.
+
+    All planes are displayed on the same scale, from `bounds`, a tuple of
+    (min, max). If it is None, it is computed from all of the planes if
+    they're all arrays, and from the first one otherwise. If `jointmask` is
+    true, a pixel masked in one plane is masked in all of them; as planes
+    are loaded lazily, this applies to the masks of the planes loaded so
+    far."""
+
     import time, glib
 
     n = len (arrays)
-    amin = amax = h = w = None
+    loaders = [a if callable (a) else (lambda a=a: a) for a in arrays]
 
     if descs is None:
         descs = [''] * n
 
-    for array in arrays:
-        thish, thisw = array.shape
+    def arraybounds (array):
         thismin, thismax = array.min (), array.max ()
 
         if not np.isfinite (thismin):
@@ -950,39 +1304,124 @@ def cycle (arrays, descs=None, cadence=0.6, toworlds=None,
         if not np.isfinite (thismax):
             thismax = array[np.ma.where (np.isfinite (array))].max ()
 
-        if amin is None:
-            w, h, amin, amax = thisw, thish, thismin, thismax
-        else:
-            if thisw != w:
-                raise ValueError ('array widths not all equal')
-            if thish != h:
-                raise ValueError ('array heights not all equal')
+        return thismin, thismax
+
+    first = loaders[0] ()
+    h, w = first.shape
 
+    if bounds is not None:
+        amin, amax = bounds
+    elif not any (callable (a) for a in arrays):
+        amin, amax = arraybounds (first)
+
+        for array in arrays[1:]:
+            if array.shape != first.shape:
+                raise ValueError ('array shapes not all equal')
+            thismin, thismax = arraybounds (array)
             amin = min (amin, thismin)
             amax = max (amax, thismax)
+    else:
+        amin, amax = arraybounds (first)
+
+    if amax == amin:
+        amax = amin + 1
 
     stride = cairo.ImageSurface.format_stride_for_width (cairo.FORMAT_ARGB32, w)
     # stride is in bytes:
     assert stride % 4 == 0
-    imgdata = np.empty ((n, h, stride // 4), dtype=np.uint32)
-    fixed = np.empty ((n, h, w), dtype=np.int32)
-    antimask = np.empty ((n, h, w), dtype=np.bool_)
-    surfaces = [None] * n
 
-    imgdata.fill (0xFF000000)
+    # The data are converted to fixed point, with the bounds mapping to 0
+    # and 0x0FFFFFF0. Values far outside of the bounds are clipped so that
+    # they can't overflow.
+    fscale = 0x0FFFFFF0 / float (amax - amin)
+    fclip = 4 * (amax - amin)
+
+    masks = dict (version=0, joint=None)
+    clipped = np.zeros ((h, w), dtype=np.int32) # scratch array
 
-    for i, array in enumerate (arrays):
-        surfaces[i] = cairo.ImageSurface.create_for_data (imgdata[i], cairo.FORMAT_ARGB32,
-                                                          w, h, stride)
+    def convert (i, array):
+        if array.shape != (h, w):
+            raise ValueError ('shape of plane %d (%s) does not agree with that '
+                              'of the first (%s)' % (i, array.shape, (h, w)))
 
-        if np.ma.is_masked (array):
+        p = _CyclePlane ()
+        p.array = array
+        p.nomask = not np.ma.is_masked (array) or array.mask is np.ma.nomask
+
+        if p.nomask:
+            filled = array
+            p.antimask = np.ones ((h, w), dtype=np.bool_)
+        else:
             filled = array.filled (amin)
-            antimask[i] = ~array.mask
+            p.antimask = ~array.mask
+
+        filled = np.clip (filled, amin - fclip, amax + fclip)
+        p.fixed = ((filled - amin) * fscale).astype (np.int32)
+
+        p.imgdata = np.empty ((h, stride // 4), dtype=np.uint32)
+        p.imgdata.fill (0xFF000000)
+        p.surface = cairo.ImageSurface.create_for_data (p.imgdata,
+                                                        cairo.FORMAT_ARGB32,
+                                                        w, h, stride)
+        return p
+
+    def mergemask (p):
+        # Called on the main thread when a plane is first used.
+        p.merged = True
+        if not jointmask or p.nomask:
+            return
+        if masks['joint'] is None:
+            masks['joint'] = ~p.antimask
+        elif not (masks['joint'] | p.antimask).all ():
+            np.logical_or (masks['joint'], ~p.antimask, masks['joint'])
         else:
-            filled = array
-            antimask[i].fill (True)
+            return
+        masks['version'] += 1
 
-        fixed[i] = (filled - amin) * (0x0FFFFFF0 / (amax - amin))
+    def tune (p, tunerx, tunery, scratch=clipped):
+        p.tuning = (tunerx, tunery)
+        p.maskversion = masks['version']
+
+        imgdata = p.imgdata
+        np.bitwise_and (imgdata, 0xFF000000, imgdata)
+
+        fmin = int (0x0FFFFFF0 * tunerx)
+        fmax = int (0x0FFFFFF0 * tunery)
+
+        # Current Numpys refuse these mixed-type in-place operations
+        # without an explicit casting rule.
+        if fmin == fmax:
+            np.add (imgdata, 255 * (p.fixed > fmin), imgdata, casting='unsafe')
+        else:
+            np.clip (p.fixed, fmin, fmax, scratch)
+            np.subtract (scratch, fmin, scratch)
+            np.multiply (scratch, 255. / (fmax - fmin), scratch, casting='unsafe')
+            np.add (imgdata, scratch, imgdata, casting='unsafe')
+
+        np.multiply (imgdata, p.antimask, imgdata)
+        if masks['joint'] is not None:
+            np.multiply (imgdata, ~masks['joint'], imgdata)
+
+    # The tuning is the same for all planes. A plane that was prepared
+    # before the latest change to it, or to the joint mask, is redone when
+    # it's next shown.
+    lasttuning = [None]
+
+    def prepare (i, array):
+        p = convert (i, array)
+        if lasttuning[0] is not None:
+            tune (p, *lasttuning[0], scratch=np.empty ((h, w), dtype=np.int32))
+        return p
+
+    cache = PlaneCache (loaders, prepare, cachesize)
+    cache.put (0, prepare (0, first))
+    del first
+
+    def getplane (i):
+        p = cache.get (i)
+        if not p.merged:
+            mergemask (p)
+        return p
 
     def getn ():
         return n
@@ -993,30 +1432,19 @@ def cycle (arrays, descs=None, cadence=0.6, toworlds=None,
     def getdesci (i):
         return descs[i]
 
-    clipped = np.zeros ((h, w), dtype=np.int32) # scratch array
-
     def settuningi (i, tunerx, tunery):
-        np.bitwise_and (imgdata[i], 0xFF000000, imgdata[i])
-
-        fmin = int (0x0FFFFFF0 * tunerx)
-        fmax = int (0x0FFFFFF0 * tunery)
-
-        if fmin == fmax:
-            np.add (imgdata[i], 255 * (fixed[i] > fmin), imgdata[i])
-        else:
-            np.clip (fixed[i], fmin, fmax, clipped)
-            np.subtract (clipped, fmin, clipped)
-            np.multiply (clipped, 255. / (fmax - fmin), clipped)
-            np.add (imgdata[i], clipped, imgdata[i])
-
-        np.multiply (imgdata[i], antimask[i], imgdata[i])
+        lasttuning[0] = (tunerx, tunery)
+        tune (getplane (i), tunerx, tunery)
 
     def getsurfacei (i, xoffset, yoffset, width, height):
-        return surfaces[i], xoffset, yoffset
+        p = getplane (i)
+
+        if lasttuning[0] is not None and (p.tuning != lasttuning[0] or
+                                          p.maskversion != masks['version']):
+            tune (p, *lasttuning[0])
 
-    # see comment in view()
-    nomasks = [not np.ma.is_masked (a) or a.mask is np.ma.nomask
-               for a in arrays]
+        cache.prefetch ((i + 1) % n)
+        return p.surface, xoffset, yoffset
 
     if toworlds is None:
         toworlds = [None] * n
@@ -1027,8 +1455,10 @@ def cycle (arrays, descs=None, cadence=0.6, toworlds=None,
         row = int (np.floor (y + 0.5))
         col = int (np.floor (x + 0.5))
         if row >= 0 and col >= 0 and row < h and col < w:
-            if nomasks[i] or not arrays[i].mask[row,col]:
-                s += '%g ' % arrays[i][row,col]
+            p = getplane (i)
+            if p.antimask[row,col] and (masks['joint'] is None or
+                                        not masks['joint'][row,col]):
+                s += '%g ' % p.array[row,col]
         if yflip:
             y = h - 1 - y
             row = h - 1 - row
@@ -1051,3 +1481,4 @@ def cycle (arrays, descs=None, cadence=0.6, toworlds=None,
     cycler.win.connect ('destroy', gtk.main_quit)
 
     gtk.main ()
+    cache.close ()
@@ -23,7 +23,7 @@ from __future__ import division
 import numpy as np
 from collections import namedtuple
 import time
-from multiprocessing import Pool
+from workpool import make_pool
 
 
 PDMResult = namedtuple ('PDMResult', 'thetas imin pmin mc_tmins '
@@ -67,8 +67,143 @@ def one_theta_feeder (data_list):
 
     return result
 
+
+# Rough cap on the number of (shift, period, point) elements handled at once
+# by many_thetas(); each one costs a few dozen bytes of temporaries.
+
+_block_elements = 1 << 21
+
+
+def many_thetas (t, x, wt, periods, nbin, nshift, v_all):
+    """Compute theta for every period in `periods` in one pass.
+
+    Equivalent to calling one_theta() for each period, but the phase binning
+    for all periods and all shifts is done with a single set of bincount()
+    calls, so there are no Python-level loops over periods, shifts, or bins.
+    Memory use scales as nshift * periods.size * t.size; callers with big
+    inputs should feed it blocks of periods (see period_blocks())."""
+
+    periods = np.atleast_1d (periods)
+    nper = periods.size
+    ngroup = nshift * nper
+    # One spare slot per group catches the (rare) case where floating-point
+    # rounding makes phase * nbin come out as exactly nbin; one_theta()
+    # ignores such points, and so do we.
+    stride = nbin + 1
+    nslot = ngroup * stride
+
+    # Center the data so that the variance sums are well-conditioned.
+    x = x - np.average (x, weights=wt)
+
+    shifts = np.arange (nshift) / (nshift * nbin)
+    phase = t / periods[:,np.newaxis]
+    phase = (phase + shifts[:,np.newaxis,np.newaxis]) % 1.
+    idx = np.floor (phase * nbin).astype (np.int)
+    del phase
+    idx += (np.arange (ngroup) * stride).reshape ((nshift, nper, 1))
+    idx = idx.ravel ()
+
+    wtall = np.tile (wt, ngroup)
+    wxall = np.tile (wt * x, ngroup)
+
+    n = np.bincount (idx, minlength=nslot)
+    sw = np.bincount (idx, weights=wtall, minlength=nslot)
+    swx = np.bincount (idx, weights=wxall, minlength=nslot)
+
+    # Second pass: weighted squared deviations about each bin's own mean, as
+    # in weighted_variance(), rather than the cancellation-prone E[x^2] -
+    # E[x]^2.
+    with np.errstate (invalid='ignore', divide='ignore'):
+        mean = swx / sw
+    dev = np.tile (x, ngroup) - mean[idx]
+    swdd = np.bincount (idx, weights=wtall * dev**2, minlength=nslot)
+
+    shape = (nshift, nper, stride)
+    n = n.reshape (shape)[...,:nbin]
+    sw = sw.reshape (shape)[...,:nbin]
+    swdd = swdd.reshape (shape)[...,:nbin]
+
+    ok = n >= 3
+    dof = np.where (ok, n - 1, 0)
+    with np.errstate (invalid='ignore', divide='ignore'):
+        contrib = np.where (ok, swdd / sw * dof, 0.)
+
+    numer = contrib.sum (axis=2).sum (axis=0)
+    denom = dof.sum (axis=2).sum (axis=0)
+    return numer / (denom * v_all)
+
+
+def period_blocks (npts, nperiods, nshift, nblocks_min=1):
+    """Return a list of slices dividing `nperiods` trial periods into blocks
+    small enough for many_thetas() to handle in bounded memory. At least
+    `nblocks_min` blocks are returned (if there are enough periods), so that
+    the work can be spread over that many workers."""
+
+    per_block = max (_block_elements // max (npts * nshift, 1), 1)
+    per_block = min (per_block, -(-nperiods // max (nblocks_min, 1)))
+    per_block = max (per_block, 1)
+    return [slice (i, min (i + per_block, nperiods))
+            for i in xrange (0, nperiods, per_block)]
+
+
+def many_thetas_feeder (data_list):
+    (t, x, wt, periods, nbin, nshift, v_all) = data_list
+    return many_thetas (t, x, wt, periods, nbin, nshift, v_all)
+
+
+def _pool_thetas (pool, nprocesses, t, x, wt, periods, nbin, nshift, v_all):
+    args = [(t, x, wt, periods[s], nbin, nshift, v_all)
+            for s in period_blocks (t.size, periods.size, nshift, nprocesses)]
+    return np.concatenate (list (pool.map (many_thetas_feeder, args)))
+
+
+def _all_thetas (t, x, wt, periods, nbin, nshift, v_all):
+    return np.concatenate ([many_thetas (t, x, wt, periods[s], nbin, nshift, v_all)
+                            for s in period_blocks (t.size, periods.size, nshift)])
+
+
+def mc_realizations (data_list):
+    """Run a batch of complete Monte Carlo realizations for pdm().
+
+    `data_list` is (t, x, wt, u, periods, nbin, nshift, v_all, kind, seeds).
+    For each entry of `seeds`, the data are either shuffled (`kind` =
+    'shuffle') or have noise added (`kind` = 'noise') using a RandomState
+    seeded with that value, and theta is evaluated over all periods. Returns
+    an array with one entry per seed: the minimal theta for 'shuffle', or the
+    index of the best period for 'noise'.
+
+    Each batch carries its own copy of the data, so pdm() ships the arrays
+    to each worker once rather than once per period per realization."""
+
+    (t, x, wt, u, periods, nbin, nshift, v_all, kind, seeds) = data_list
+    result = np.empty (len (seeds))
+
+    for i, seed in enumerate (seeds):
+        rs = np.random.RandomState (seed)
+
+        if kind == 'shuffle':
+            shuf = rs.permutation (x.size)
+            result[i] = _all_thetas (t, x[shuf], wt[shuf], periods, nbin,
+                                     nshift, v_all).min ()
+        elif kind == 'noise':
+            noised = rs.normal (x, u)
+            result[i] = _all_thetas (t, noised, wt, periods, nbin, nshift,
+                                     v_all).argmin ()
+        else:
+            raise ValueError ('unknown Monte Carlo kind %r' % kind)
+
+    return result
+
+
+def _split_seeds (seeds, nbatch):
+    # Always return at least one (possibly empty) batch so that the results
+    # can be concatenated unconditionally.
+    nbatch = max (min (nbatch, seeds.size), 1)
+    return np.array_split (seeds, nbatch)
+
+
 def pdm (t, x, u, periods, nbin, nshift=8, nsmc=256, numc=256, weights=False,
-         nprocesses = 8):
+         nprocesses = 8, mode='process', executor=None, seed=None):
     """Perform phase dispersion minimization.
 
     `t` - 1D array - time coordinate
@@ -81,6 +216,19 @@ def pdm (t, x, u, periods, nbin, nshift=8, nsmc=256, numc=256, weights=False,
        significance of the minimal theta value.
     `numc` - int=256 - number of Monte Carlo added-noise datasets to compute, to evaluate
        the uncertainty in the location of the minimal theta value.
+    `nprocesses` - int=8 - number of workers to use, and the number of batches
+       the Monte Carlo realizations are divided into.
+    `mode` - str='process' - how to parallelize if `executor` is None: 'process'
+       for a private multiprocessing.Pool, 'thread' for a private ThreadPool,
+       or 'serial' to do everything in the calling process.
+    `executor` - an existing pool or executor with a `map` method (e.g. a
+       multiprocessing.Pool or a concurrent.futures executor) to run the work
+       on. It is not shut down afterwards, so it can be reused across calls;
+       `mode` is then ignored.
+    `seed` - seed for the Monte Carlo random streams: None (draw from the
+       global numpy.random state), an int, or a numpy.random.RandomState.
+       Every realization gets its own stream derived from it, so results do
+       not depend on `nprocesses`, `mode`, or `executor`.
 
     Returns named tuple of:
 
@@ -96,8 +244,9 @@ def pdm (t, x, u, periods, nbin, nshift=8, nsmc=256, numc=256, weights=False,
     `mc_puncert` - standard deviation of `mc_pmins`; approximate uncertainty
        on `pmin`.
 
-    We don't do anything clever, so runtime scales at least as
-      t.size * periods.size * nbin * nshift * (nsmc + numc + 1)."""
+    Runtime scales as t.size * periods.size * nshift * (nsmc + numc + 1);
+    theta values for blocks of periods are computed at once by many_thetas(),
+    so there is little per-period or per-bin Python overhead."""
 
     t = np.asfarray (t)
     x = np.asfarray (x)
@@ -132,7 +281,17 @@ def pdm (t, x, u, periods, nbin, nshift=8, nsmc=256, numc=256, weights=False,
 
     if numc < 0:
         raise ValueError ('`numc` must be nonnegative')
-        
+
+    if nprocesses < 1:
+        raise ValueError ('`nprocesses` must be at least 1')
+
+    if seed is None:
+        rs = np.random
+    elif isinstance (seed, np.random.RandomState):
+        rs = seed
+    else:
+        rs = np.random.RandomState (seed)
+
     # We can finally get started!
 
     # allow weights or data uncertainties to be supplied
@@ -143,62 +302,48 @@ def pdm (t, x, u, periods, nbin, nshift=8, nsmc=256, numc=256, weights=False,
         wt = u ** -2
     v_all = weighted_variance (x, wt)
 
-    thetas = np.empty (periods.shape)
-
-    args = [None]*periods.size
-    for i in xrange (periods.size):
-        args[i] = (t, x, wt, periods[i], nbin, nshift, v_all)
-
-    # do period search with worker processes    
-    pool = Pool(nprocesses)
-    thetas_list = pool.map(one_theta_feeder, args)
-    thetas = np.array(thetas_list)
-
-    imin = thetas.argmin ()
-    pmin = periods[imin]
-
-    # Now do the Monte Carlo jacknifing so that the caller can have some idea
-    # as to the significance of the minimal value of `thetas`.
-
-    mc_tmins = np.empty (nsmc)
-    
-    for i in xrange (nsmc):
-        shuf = np.random.permutation (x.size)
-        args = [None]*periods.size
-        
-        for j in xrange (periods.size):
-            args[j] = (t, x[shuf], wt[shuf], periods[j], nbin, nshift, v_all)
-
-        # do period search with worker processes    
-        thetas_list = pool.map(one_theta_feeder, args)
-        mc_thetas = np.array(thetas_list)
-        mc_tmins[i] = np.array(thetas_list).min()
-
+    if executor is not None:
+        pool = executor
+    else:
+        pool = make_pool (mode, nprocesses)
+
+    try:
+        # do period search with the workers, each handling whole blocks of
+        # periods
+        thetas = _pool_thetas (pool, nprocesses, t, x, wt, periods, nbin,
+                               nshift, v_all)
+        imin = thetas.argmin ()
+        pmin = periods[imin]
+
+        # Now do the Monte Carlo jacknifing so that the caller can have some
+        # idea as to the significance of the minimal value of `thetas`, and
+        # add noise to assess the uncertainty of the period. Each worker gets
+        # one batch of whole realizations of each kind, along with a single
+        # copy of the data.
+
+        smc_seeds = rs.randint (0, 2**31 - 1, size=nsmc)
+        umc_seeds = rs.randint (0, 2**31 - 1, size=numc)
+
+        sargs = [(t, x, wt, u, periods, nbin, nshift, v_all, 'shuffle', batch)
+                 for batch in _split_seeds (smc_seeds, nprocesses)]
+        uargs = [(t, x, wt, u, periods, nbin, nshift, v_all, 'noise', batch)
+                 for batch in _split_seeds (umc_seeds, nprocesses)]
+        results = list (pool.map (mc_realizations, sargs + uargs))
+    finally:
+        # don't forget to close the pool!! (but only if it's ours)
+        if executor is None and mode != 'serial':
+            pool.terminate()
+            pool.join()
+
+    mc_tmins = np.concatenate (results[:len (sargs)])
     mc_tmins.sort ()
     mc_pvalue = mc_tmins.searchsorted (thetas[imin]) / nsmc
 
-    # Now add noise to assess the uncertainty of the period.
-
-    mc_pmins = np.empty (numc)
-
-    for i in xrange (numc):
-        noised = np.random.normal (x, u)
-
-        for j in xrange (periods.size):
-            args[j] = (t, noised, wt, periods[j], nbin, nshift, v_all)
-
-        # do period search with worker processes    
-        thetas_list = pool.map(one_theta_feeder, args)
-        mc_thetas = np.array(thetas_list)
-        mc_pmins[i] = periods[mc_thetas.argmin ()]
-
+    mc_imins = np.concatenate (results[len (sargs):]).astype (np.int)
+    mc_pmins = periods[mc_imins]
     mc_pmins.sort ()
     mc_puncert = mc_pmins.std ()
 
-    # don't forget to close the pool!!
-    pool.terminate()
-    pool.join()
-    
     # All done.
     return PDMResult (thetas=thetas, imin=imin, pmin=pmin, mc_tmins=mc_tmins,
                       mc_pvalue=mc_pvalue, mc_pmins=mc_pmins,
@@ -7,7 +7,8 @@ The main API is the stmapping() function, which creates a Mapping
 object for reading a flatdb as a source table.
 
 readst() is a convenience function analogous to flatdb.readtable()
-that uses stmapping() as its Mapping.
+that uses stmapping() as its Mapping; readstcols() is the same for
+flatdb.readcolumns().
 
 sfindcols is the list of columns that we can extract by parsing
 the output of MIRIAD sfind with parseSFind().
@@ -19,7 +20,7 @@ by parsing the output of the NVSS query program with parseNVSS().
 from astutil import *
 import flatdb
 
-__all__ = ('Holder readtable writetable stmapping readst '
+__all__ = ('Holder readtable writetable stmapping readst readstcols '
            'sfindcols nvsscols parseSFind parseNVSS').split ()
 
 
@@ -81,6 +82,10 @@ def readst (source, recfactory=Holder, **kwargs):
     return readtable (source, stmapping (**kwargs), recfactory=recfactory)
 
 
+def readstcols (source, colnames=None, **kwargs):
+    return flatdb.readcolumns (source, stmapping (**kwargs), colnames)
+
+
 # Parsing output of MIRIAD sfind
 
 _sfindMiscColumns = ('ra_uc dec_uc pkflux pkflux_uc totflux major '
@@ -361,17 +366,15 @@ def deconvolve (source, bmaj, bmin, bpa, minaxprod=0, preserve=True):
 
 def loadAsOverlay (source, topixel, imgheight):
     headers, cols, recs = readtable (source, stmapping ())
+    recs = list (recs)
     compact = []
 
-    for rec in recs:
-        y, x = topixel ([rec.dec, rec.ra])
-
-        if not hasattr (rec, 'major') or rec.major is None or rec.major == 0:
-            compact.append ((x, y))
-            continue
+    # TODO: draw Gaussians with the right shape for records with nonzero
+    # "major". All positions are converted in one topixel() call.
 
-        # TODO: draw Gaussians with the right shape
-        compact.append ((x, y))
+    if len (recs):
+        ys, xs = topixel ([[rec.dec for rec in recs], [rec.ra for rec in recs]])
+        compact = zip (xs, ys)
 
     def drawoverlay (ctxt, width, height, x0, y0, d2p):
         ctxt.set_source_rgb (255, 0, 0)
@@ -0,0 +1,325 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2014 Peter Williams
+# Licensed under the GNU General Public License version 3 or higher
+
+"""
+streamstats - bounded-memory statistics of large images
+
+`imagestats (path)` goes over an image opened with `astimage` one plane
+(or, for very large planes, one tile) at a time and accumulates the mean,
+RMS, extrema, masked-pixel count, and approximate percentiles, so the
+memory used does not depend on the size of the image. The planes can be
+processed in parallel.
+
+The accumulators are also usable on their own: `StreamStats.accumulate()`
+takes any array, and `StreamStats.merge()` combines the results of
+separate runs.
+"""
+
+import numpy as np
+from workpool import make_pool
+
+__all__ = 'QuantileSketch StreamStats imagestats'.split ()
+
+
+class QuantileSketch (object):
+    """Approximate quantiles of a stream of values in bounded memory.
+
+    This is a simplified version of the KLL sketch (Karnin, Lang, & Liberty
+    2016). Values are buffered in a stack of levels of at most `k` items
+    each, items at level h standing in for 2**h of the original values.
+    When a level overflows it is sorted and every other item, starting at
+    a random offset, is promoted to the next level up. Memory use grows
+    only as k log2 (n / k), and the rank error of a quantile is of order
+    a few times n / k. The result is exact until more than `k` values have
+    been added. Sketches can be merged, and the result is as good as a
+    sketch of the combined stream."""
+
+    def __init__ (self, k=4096, seed=None):
+        if k < 2:
+            raise ValueError ('sketch size must be at least 2; got %r' % k)
+
+        self.k = int (k)
+        self.count = 0
+        self.levels = []
+
+        if isinstance (seed, np.random.RandomState):
+            self._rand = seed
+        else:
+            self._rand = np.random.RandomState (seed)
+
+
+    def add (self, values):
+        """Add values to the sketch. Returns self."""
+        values = np.asarray (values, dtype=np.float64).ravel ()
+        if values.size:
+            self.count += values.size
+            self._insert (0, values)
+        return self
+
+
+    def merge (self, other):
+        """Fold another sketch into this one. Returns self."""
+        for level, items in enumerate (other.levels):
+            if items.size:
+                self._insert (level, items)
+        self.count += other.count
+        return self
+
+
+    def _insert (self, level, values):
+        while True:
+            while level >= len (self.levels):
+                self.levels.append (np.empty (0))
+
+            buf = np.concatenate ((self.levels[level], values))
+            if buf.size <= self.k:
+                self.levels[level] = buf
+                return
+
+            # With an odd count, one item stays at this level so that the
+            # total weight is preserved exactly.
+            buf.sort ()
+            neven = buf.size - buf.size % 2
+            self.levels[level] = buf[neven:]
+            values = buf[self._rand.randint (2):neven:2]
+            level += 1
+
+
+    def quantile (self, q):
+        """Approximate `q`th quantile(s) of the values added so far; `q` is a
+        scalar or array with values between 0 and 1. Returns NaN if no
+        values have been added."""
+        q = np.asarray (q, dtype=np.float64)
+        if np.any ((q < 0) | (q > 1)):
+            raise ValueError ('quantiles must be between 0 and 1')
+
+        if self.count == 0:
+            return q * np.nan
+
+        items = np.concatenate (self.levels)
+        weights = np.concatenate ([np.ones (l.size) * 2.**h
+                                   for h, l in enumerate (self.levels)])
+        order = np.argsort (items, kind='mergesort')
+        items = items[order]
+        cum = np.cumsum (weights[order])
+
+        # Like numpy.percentile (..., interpolation='lower'): the item at
+        # (zero-based) rank floor (q * (n - 1)) in the weighted ordering.
+        idx = np.searchsorted (cum, np.floor (q * (cum[-1] - 1)), side='right')
+        return items[np.minimum (idx, items.size - 1)]
+
+
+    def percentile (self, p):
+        """Like quantile(), with `p` in percent."""
+        return self.quantile (np.asarray (p, dtype=np.float64) / 100)
+
+
+class StreamStats (object):
+    """Running statistics of a stream of data.
+
+    `n` - number of valid values seen
+    `nmasked` - number of values that were masked or non-finite
+    `mean`, `std`, `rms` - mean, standard deviation, and root-mean-square of
+       the valid values
+    `min`, `max` - extrema of the valid values
+    `sketch` - a QuantileSketch of the valid values
+
+    The mean and variance are accumulated with the pairwise update of Chan,
+    Golub, & LeVeque (1979), so they don't suffer from the cancellation of
+    the naive sum-of-squares approach. The float statistics are NaN if no
+    valid values have been seen."""
+
+    def __init__ (self, sketchsize=4096, seed=None):
+        self.n = 0
+        self.nmasked = 0
+        self.mean = np.nan
+        self.min = np.nan
+        self.max = np.nan
+        self._m2 = 0.
+        self.sketch = QuantileSketch (sketchsize, seed)
+
+
+    def accumulate (self, data):
+        """Add the values in `data`, which may be a masked array; masked and
+        non-finite values are counted but otherwise ignored. Returns self."""
+        data = np.ma.asanyarray (data)
+        valid = ~np.ma.getmaskarray (data)
+        valid &= np.isfinite (np.ma.getdata (data))
+        vals = np.ma.getdata (data)[valid].astype (np.float64)
+
+        self.nmasked += data.size - vals.size
+        if not vals.size:
+            return self
+
+        mn, mx = vals.min (), vals.max ()
+        self.sketch.add (vals)
+        mean = vals.mean ()
+        vals -= mean
+        self._combine (vals.size, mean, np.dot (vals, vals), mn, mx)
+        return self
+
+
+    def merge (self, other):
+        """Fold the statistics accumulated by another StreamStats into this
+        one. Returns self."""
+        self.nmasked += other.nmasked
+        if other.n:
+            self._combine (other.n, other.mean, other._m2, other.min, other.max)
+        self.sketch.merge (other.sketch)
+        return self
+
+
+    def _combine (self, n, mean, m2, mn, mx):
+        if self.n == 0:
+            self.n, self.mean, self._m2 = n, mean, m2
+            self.min, self.max = mn, mx
+            return
+
+        ntot = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / ntot
+        self._m2 += m2 + delta**2 * self.n * n / ntot
+        self.n = ntot
+        self.min = min (self.min, mn)
+        self.max = max (self.max, mx)
+
+
+    @property
+    def std (self):
+        if self.n == 0:
+            return np.nan
+        return np.sqrt (self._m2 / self.n)
+
+
+    @property
+    def rms (self):
+        if self.n == 0:
+            return np.nan
+        return np.sqrt (self._m2 / self.n + self.mean**2)
+
+
+    def percentile (self, p):
+        """Approximate percentile(s) of the valid values; see
+        QuantileSketch."""
+        return self.sketch.percentile (p)
+
+
+    @property
+    def median (self):
+        return self.sketch.quantile (0.5)
+
+
+# Driving the accumulation over an image
+
+def _chunk_regions (shape, maxpixels):
+    """Divide an image into regions, in astimage.readRegion() form, that are
+    single planes if these have no more than `maxpixels` pixels, and
+    blocks of rows (or of columns within a row) otherwise."""
+
+    h, w = shape[-2:]
+    nrows = max (min (maxpixels // w, h), 1)
+    ncols = w if nrows > 1 else max (min (maxpixels, w), 1)
+
+    for planeidx in np.ndindex (*shape[:-2]):
+        for r0 in xrange (0, h, nrows):
+            for c0 in xrange (0, w, ncols):
+                yield planeidx + (slice (r0, r0 + nrows), slice (c0, c0 + ncols))
+
+
+def _regions_stats (args):
+    """Accumulate statistics over a batch of regions of an image, opened
+    anew so that this can run in a worker."""
+    import astimage
+    path, regions, sketchsize, seed = args
+    stats = StreamStats (sketchsize, seed)
+
+    with astimage.open (path, 'r') as img:
+        for region in regions:
+            stats.accumulate (img.readRegion (region))
+
+    return stats
+
+
+def imagestats (image, maxpixels=1<<22, sketchsize=4096, nprocesses=1,
+                mode='serial', executor=None, seed=None):
+    """Compute statistics of all of the pixels of an image, reading it a
+    piece at a time.
+
+    `image` - the path of an image, or an open astimage.AstroImage
+    `maxpixels` - int=4M - the most pixels to read at once; whole planes are
+       read if they're no bigger than this, tiles of them otherwise
+    `sketchsize` - int=4096 - size parameter of the percentile sketch; see
+       QuantileSketch
+    `nprocesses` - int=1 - number of workers to use, and the number of batches
+       the image pieces are divided into
+    `mode` - str='serial' - how to parallelize if `executor` is None:
+       'process' for a private multiprocessing.Pool, 'thread' for a private
+       ThreadPool, or 'serial' to do everything in the calling process.
+    `executor` - an existing pool or executor with a `map` method to run
+       the work on; `mode` is then ignored. It is not shut down afterwards.
+    `seed` - seed for the random choices made by the percentile sketch
+
+    Returns a StreamStats. Peak memory use is about that of a few copies of
+    `maxpixels` pixels per worker. Workers open the image themselves, so
+    in a parallel run `image` must be openable by path; statistics of a
+    SimpleImage are computed from the image that it wraps, since the two
+    contain the same pixels."""
+
+    import astimage
+
+    maxpixels = int (maxpixels)
+    if maxpixels < 1:
+        raise ValueError ('`maxpixels` must be positive; got %r' % maxpixels)
+
+    nprocesses = int (nprocesses)
+    if nprocesses < 1:
+        raise ValueError ('`nprocesses` must be at least 1; got %r' % nprocesses)
+
+    if executor is None and mode == 'serial':
+        if isinstance (image, astimage.AstroImage):
+            stats = StreamStats (sketchsize, seed)
+            for region in _chunk_regions (image.shape, maxpixels):
+                stats.accumulate (image.readRegion (region))
+            return stats
+
+        return _regions_stats ((image, _chunk_regions (_image_shape (image),
+                                                       maxpixels),
+                                sketchsize, seed))
+
+    if isinstance (image, astimage.SimpleImage):
+        image = image._handle
+    if isinstance (image, astimage.AstroImage):
+        path, shape = image.path, image.shape
+    else:
+        path, shape = image, _image_shape (image)
+
+    regions = list (_chunk_regions (shape, maxpixels))
+    nbatch = max (min (nprocesses, len (regions)), 1)
+    batches = [regions[i::nbatch] for i in xrange (nbatch)]
+
+    # Give every batch its own random stream, reproducible given `seed`.
+    seeds = np.random.RandomState (seed).randint (1 << 30, size=nbatch)
+    args = [(path, b, sketchsize, s) for b, s in zip (batches, seeds)]
+
+    if executor is not None:
+        results = executor.map (_regions_stats, args)
+    else:
+        pool = make_pool (mode, nprocesses)
+        try:
+            results = pool.map (_regions_stats, args)
+        finally:
+            if mode != 'serial':
+                pool.close ()
+                pool.join ()
+
+    stats = StreamStats (sketchsize, seed)
+    for r in results:
+        stats.merge (r)
+    return stats
+
+
+def _image_shape (path):
+    import astimage
+    with astimage.open (path, 'r') as img:
+        return img.shape
@@ -14,8 +14,9 @@ uncertainties on the block heights (ditto).
 """
 
 import numpy as np
+from multiprocessing import Pool
 
-__all__ = ['nlogn binbblock ttbblock bsttbblock']
+__all__ = ['nlogn binbblock ttlayout ttbblock bsttbblock']
 
 ## quickutil: holder
 #- snippet: holder.py (2012 Sep 29)
@@ -71,7 +72,235 @@ def nlogn (n, dt):
     return np.where (mask, 0, r)
 
 
-def binbblock (widths, counts, p0=0.05):
+def _bblock_dp (block_remainders, count_remainders, ncp_prior, prune, bufs):
+    """The dynamic-programming core of binbblock(). Returns the `last` array
+    of optimal block starts.
+
+    `block_remainders` and `count_remainders` are the total width and counts
+    to the right of each cell edge. `bufs` is a Holder of preallocated work
+    arrays, so that the inner loop doesn't allocate.
+
+    If `prune` is true, we drop candidate block starts that can never again
+    be optimal. After every cell we apply the PELT criterion of Killick+
+    (2012JASA..107.1590K): because the fitness is superadditive (by the
+    log-sum inequality, splitting a block never lowers its total fitness),
+    if start `s` is worse than the best partition ending at `r` even before
+    the change-point penalty, start `r+1` will beat it at every later cell.
+    This keeps the search close to O(N) when the data have many blocks, but
+    not when they have few: moving a start within a long block changes its
+    fitness by much less than the penalty. So once there are more than a
+    few hundred candidates, and whenever their number has doubled since,
+    we also apply the stronger, but costlier, test of _prune_candidates().
+    Either way, the result is the same as the exhaustive search up to
+    roundoff."""
+
+    ncells = block_remainders.size - 1
+    cand = bufs.cand
+    bestf = bufs.bestf # bestf[r+1] = best fitness of cells [0..r]; bestf[0] = 0
+    last = bufs.last
+    # The candidates' block_remainders, count_remainders, and bestf values,
+    # kept in step with `cand` so that the inner loop needn't gather them.
+    ct, cn, cb = bufs.ct, bufs.cn, bufs.cb
+    tk, nk, fit, keep = bufs.tk, bufs.nk, bufs.fit, bufs.keep
+    tiny = np.finfo (np.float).tiny
+
+    bestf[0] = 0.
+    ncand = 0
+    nref = 0 # candidates [0..nref) survived the last _prune_candidates()
+    nfunc = 512
+
+    for r in xrange (ncells):
+        cand[ncand] = r
+        ct[ncand] = block_remainders[r]
+        cn[ncand] = count_remainders[r]
+        cb[ncand] = bestf[r]
+        ncand += 1
+        t = tk[:ncand]
+        n = nk[:ncand]
+        f = fit[:ncand]
+
+        np.subtract (ct[:ncand], block_remainders[r+1], out=t)
+        np.subtract (cn[:ncand], count_remainders[r+1], out=n)
+
+        # Pluggable fitness expression: f = nlogn (n, t), computed in place
+        # as n * log (n / t) to save a logarithm. Clamping the ratio at
+        # `tiny` makes empty blocks come out as 0 * finite = 0.
+        np.divide (n, t, out=f)
+        np.maximum (f, tiny, out=f)
+        np.log (f, out=f)
+        f *= n
+
+        # This incrementally penalizes partitions with more blocks.
+        f += cb[:ncand]
+
+        imax = np.argmax (f)
+        last[r] = cand[imax]
+        bestf[r+1] = f[imax] - ncp_prior
+
+        if prune and ncand > 1:
+            k = keep[:ncand]
+            functional = ncand >= nfunc
+
+            if functional:
+                k[:] = _prune_candidates (ct[:ncand], cn[:ncand], cb[:ncand],
+                                          nref, block_remainders[r+1],
+                                          count_remainders[r+1], bestf[r+1])
+            else:
+                # The slop protects against pruning on the basis of roundoff.
+                thresh = bestf[r+1] - 1e-8 * (1 + abs (bestf[r+1]))
+                np.greater (f, thresh, out=k)
+
+            nkeep = np.count_nonzero (k)
+            nref = nkeep if functional else np.count_nonzero (k[:nref])
+
+            if nkeep < ncand:
+                for a in (cand, ct, cn, cb):
+                    a[:nkeep] = a[:ncand][k]
+                ncand = nkeep
+
+            if functional:
+                nfunc = max (2 * ncand, 512)
+
+    return last
+
+
+def _prune_candidates (ct, cn, cb, nref, tnext, nnext, bnext, nsample=32):
+    """Return a boolean array of the candidate block starts of _bblock_dp() that
+    may still be optimal. `ct`, `cn`, and `cb` are the candidates' block
+    remainders, count remainders, and best fitnesses up to their starts;
+    `tnext`, `nnext`, and `bnext` are those of the next start. Each
+    candidate is tested against the first `nref` candidates, `nsample` of
+    the others, and the next start.
+
+    The fitness of a block is the maximum over rates L of its Poisson
+    log-likelihood, n * log (L) - t * L (plus n, which sums to a constant),
+    so each start `s` corresponds to a function of L,
+    bestf[s] + n * (log (L) + 1) - t * L, and the best partition maximizes
+    over both the starts and L. Adding a cell to the data adds the same
+    function of L to every start, so a start that is beaten at every L by
+    one or another of the others always will be, and can be dropped. This
+    is the functional pruning of Maidstone+ (2017S&C....27..519M). It
+    subsumes the PELT criterion of Killick+ (2012JASA..107.1590K) -- a
+    start that loses to the next one at every L -- but unlike it also
+    works when there are few blocks, where moving a start within a block
+    changes its fitness by much less than the change-point penalty.
+
+    For each pair of starts i < j, start i beats j on an interval of L. A
+    candidate can win only within the intersection of its intervals
+    against the later starts, outside the intervals of the earlier starts
+    against it. Any subset of the other starts gives a valid test, and
+    comparing against the survivors of the previous test and a sample of
+    the newer candidates keeps the cost linear in `ncand`. Everything is
+    computed so as to err on the side of keeping candidates."""
+
+    ncand = ct.size
+    tiny = np.finfo (np.float).tiny
+    ct = np.append (ct, tnext)
+    cn = np.append (cn, nnext)
+    cb = np.append (cb, bnext)
+    ref = np.linspace (nref, ncand - 1, nsample).astype (np.int)
+    ref = np.unique (np.concatenate ((np.arange (nref), ref, [ncand])))
+
+    # Start a = min (i, ref) versus start b = max (i, ref): a wins where the
+    # block from a to b, appended to the best partition up to a, beats the
+    # best partition up to b, by a margin of at most g. Dummy values where
+    # a == b keep the arithmetic clean.
+    i = np.arange (ncand)[:,np.newaxis]
+    a = np.minimum (i, ref)
+    b = np.maximum (i, ref)
+    fwd = i < ref
+    bwd = i > ref
+    t = np.where (a < b, ct[a] - ct[b], 1.)
+    n = np.where (a < b, cn[a] - cn[b], 1.)
+    g = n * np.log (np.maximum (n / t, tiny)) + cb[a] - cb[b]
+    # The slop protects against pruning on the basis of roundoff.
+    slop = 1e-8 * (1 + np.abs (cb[a]) + np.abs (cb[b]))
+    lo, hi, ilo, ihi = _winning_rates (n, t, g + slop, g - slop)
+
+    # Intersection of the ranges against the later starts.
+    keep = np.where (fwd, g + slop > 0, True).all (axis=1)
+    clo = np.where (fwd, lo, 0.).max (axis=1)
+    chi = np.where (fwd, hi, np.inf).min (axis=1)
+    keep &= clo < chi
+
+    # Is what's left covered by the ranges of the earlier starts? Sort them
+    # by their lower edges and look for gaps.
+    w = np.flatnonzero (keep)
+    bwd = bwd[w] & (g[w] - slop[w] > 0)
+    blo = np.where (bwd, ilo[w], np.inf)
+    bhi = np.where (bwd, ihi[w], -np.inf)
+    rows = np.arange (w.size)[:,np.newaxis]
+    order = np.argsort (blo, axis=1)
+    blo = blo[rows,order]
+    bhi = np.maximum.accumulate (bhi[rows,order], axis=1)
+    clo = clo[w]
+    chi = chi[w,np.newaxis]
+    gaps = ((bhi[:,:-1] < chi) & (blo[:,1:] > bhi[:,:-1])).any (axis=1)
+    covered = (blo[:,0] <= clo) & (bhi[:,-1] >= chi[:,0]) & ~gaps
+    keep[w[covered]] = False
+    return keep
+
+
+def _winning_rates (n, t, gout, gin):
+    """Return bounds (lo, hi, ilo, ihi) on the range of L where
+    n * (log (L) + 1) - t * L exceeds its maximum, n * log (n / t), minus
+    `g`. (lo, hi) are outer bounds for g = `gout`, and (ilo, ihi) inner
+    bounds for g = `gin`, where `gin` <= `gout`; the latter are only
+    meaningful where `gin` > 0.
+
+    With L = x * n / t, the edges are the roots of x - 1 - log (x) = g / n.
+    We find them with Newton's method, which converges monotonically from
+    the outside since the left-hand side is convex. The chords between
+    these points and x = 1 cross g / n inside the roots."""
+
+    pos = n > 0
+    gout = np.maximum (gout, 0)
+    gin = np.maximum (gin, 0)
+    norm = np.where (pos, n, 1)
+    c = gout / norm
+    cin = gin / norm
+
+    hi = (1 + np.sqrt (c))**2 # x - 1 - log (x) >= c here
+
+    # Avoid underflow below; for such large c the lower root is ~0 anyway.
+    cl = np.minimum (c, 30)
+    lo = np.maximum (1 - np.sqrt (2 * cl), np.exp (-1 - cl)) # ditto
+
+    # Where c ~ 0 the starting points are 1 to machine precision, and the
+    # slop applied below is much wider than the true range.
+    for _ in xrange (2):
+        d = 1 - 1 / hi
+        hi -= (hi - 1 - np.log (hi) - c) / np.where (d == 0, 1, d)
+        d = 1 - 1 / lo
+        lo -= (lo - 1 - np.log (lo) - cl) / np.where (d == 0, 1, d)
+
+    rate = n / t
+
+    h = hi - 1 - np.log (hi)
+    ihi = 1 + (hi - 1) * cin / np.where (h > 0, h, 1)
+    h = lo - 1 - np.log (lo)
+    ilo = 1 - (1 - lo) * np.minimum (cin, 30) / np.where (h > 0, h, 1)
+
+    hi = np.where (pos, rate * hi, gout / t) * (1 + 1e-8)
+    lo = np.where (cl < 30, rate * lo, 0.) * (1 - 1e-8)
+    ihi = np.where (pos, rate * ihi, gin / t) * (1 - 1e-8)
+    ilo = np.where (pos, rate * ilo, 0.) * (1 + 1e-8)
+    return lo, hi, ilo, ihi
+
+
+def binbblock (widths, counts=None, p0=0.05, prune=True):
+    """Bayesian Blocks analysis of binned counts.
+
+    `widths` and `counts` give the width and number of counts in each cell.
+    Alternatively, `widths` may be a bin layout from ttlayout() (with
+    `counts` left as None), in which case the returned info also has the
+    `ledges`, `redges`, and `midpoints` of the blocks."""
+
+    layout = None
+    if counts is None:
+        layout = widths
+        widths, counts = layout.widths, layout.counts
+
     widths = np.asarray (widths)
     counts = np.asarray (counts)
     ncells = widths.size
@@ -84,43 +313,35 @@ def binbblock (widths, counts, p0=0.05):
     if p0 < 0 or p0 >= 1.:
         raise ValueError ('p0 must lie within [0, 1)')
 
+    # These are computed once and shared by all of the p0 iterations.
     vedges = np.cumsum (np.concatenate (([0], widths))) # size: ncells + 1
     block_remainders = vedges[-1] - vedges # size: nedges = ncells + 1
     ccounts = np.cumsum (np.concatenate (([0], counts)))
-    count_remainders = ccounts[-1] - ccounts
-
+    count_remainders = (ccounts[-1] - ccounts).astype (np.float)
+
+    bufs = Holder (cand=np.empty (ncells, dtype=np.int),
+                   bestf=np.empty (ncells + 1),
+                   last=np.zeros (ncells, dtype=np.int),
+                   ct=np.empty (ncells),
+                   cn=np.empty (ncells),
+                   cb=np.empty (ncells),
+                   tk=np.empty (ncells),
+                   nk=np.empty (ncells),
+                   fit=np.empty (ncells),
+                   keep=np.empty (ncells, dtype=np.bool))
+    work = np.empty (ncells, dtype=np.int)
     prev_blockstarts = None
-    best = np.zeros (ncells, dtype=np.float)
-    last = np.zeros (ncells, dtype=np.int)
 
     for _ in xrange (10):
         # Pluggable num-change-points prior-weight expression:
         ncp_prior = 4 - np.log (p0 / (0.0136 * ncells**0.478))
 
-        for r in xrange (ncells):
-            tk = block_remainders[:r+1] - block_remainders[r+1]
-            nk = count_remainders[:r+1] - count_remainders[r+1]
-
-            # Pluggable fitness expression:
-            try:
-                fit_vec = nlogn (nk, tk)
-            except:
-                print 'q', nk, tk
-                print 'r', widths, counts
-                raise
-
-            # This incrementally penalizes partitions with more blocks:
-            tmp = fit_vec - ncp_prior
-            tmp[1:] += best[:r]
-
-            imax = np.argmax (tmp)
-            last[r] = imax
-            best[r] = tmp[imax]
+        last = _bblock_dp (block_remainders, count_remainders, ncp_prior,
+                           prune, bufs)
 
         # different semantics than Scargle impl: our blockstarts is similar to
         # their changepoints, but we always finish with blockstarts[0] = 0.
 
-        work = np.zeros (ncells, dtype=int)
         workidx = 0
         ind = last[-1]
 
@@ -131,7 +352,7 @@ def binbblock (widths, counts, p0=0.05):
                 break
             ind = last[ind - 1]
 
-        blockstarts = work[:workidx][::-1]
+        blockstarts = work[:workidx][::-1].copy ()
 
         if prev_blockstarts is not None:
             if (blockstarts.size == prev_blockstarts.size and
@@ -155,26 +376,76 @@ def binbblock (widths, counts, p0=0.05):
     info.origp0 = origp0
     info.finalp0 = p0
     info.blockstarts = blockstarts
-    info.counts = np.empty (nblocks, dtype=np.int)
-    info.widths = np.empty (nblocks)
-
-    for iblk in xrange (nblocks):
-        cellstart = blockstarts[iblk]
-        if iblk == nblocks - 1:
-            cellend = ncells - 1
-        else:
-            cellend = blockstarts[iblk+1] - 1
+    info.widths = np.add.reduceat (widths, blockstarts).astype (np.float)
+    info.counts = np.add.reduceat (counts, blockstarts).astype (np.int)
+    info.rates = info.counts / info.widths
 
-        info.widths[iblk] = widths[cellstart:cellend+1].sum ()
-        info.counts[iblk] = counts[cellstart:cellend+1].sum ()
+    if layout is not None:
+        info.ledges = layout.ledges[blockstarts]
+        info.redges = _block_redges (layout.redges, blockstarts)
+        info.midpoints = 0.5 * (info.ledges + info.redges)
 
-    info.rates = info.counts / info.widths
     return info
 
 
-def ttbblock (tstarts, tstops, times, p0=0.05):
-    tstarts = np.asarray (tstarts)
-    tstops = np.asarray (tstops)
+def _ttcells (tstarts, tstops, utimes, ucounts):
+    """Compute the per-bin `counts`, `widths`, `ledges`, and `redges` for
+    ttbblock() from pre-validated goodtimes and sorted unique event times,
+    without any per-GTI Python loop. Each unique time gets a bin extending
+    halfway to its neighbors or to the edge of its GTI; a GTI with no events
+    gets a single zero-count bin."""
+
+    ngti = tstarts.size
+    nunique = utimes.size
+
+    gidx = np.searchsorted (tstarts, utimes, side='right') - 1
+    nper = np.bincount (gidx, minlength=ngti)
+    ncellper = np.maximum (nper, 1)
+    ncells = ncellper.sum ()
+    isevent = np.repeat (nper > 0, ncellper)
+    empty = (nper == 0)
+
+    first = np.ones (nunique, dtype=np.bool)
+    first[1:] = gidx[1:] != gidx[:-1]
+    last = np.ones (nunique, dtype=np.bool)
+    last[:-1] = first[1:]
+    midpoints = 0.5 * (utimes[1:] + utimes[:-1])
+
+    ev_ledges = np.empty (nunique)
+    ev_ledges[1:] = midpoints
+    ev_ledges[first] = tstarts[gidx[first]]
+    ev_redges = np.empty (nunique)
+    ev_redges[:-1] = midpoints
+    ev_redges[last] = tstops[gidx[last]]
+
+    counts = np.zeros (ncells)
+    counts[isevent] = ucounts
+    ledges = np.empty (ncells)
+    ledges[isevent] = ev_ledges
+    ledges[~isevent] = tstarts[empty]
+    redges = np.empty (ncells)
+    redges[isevent] = ev_redges
+    redges[~isevent] = tstops[empty]
+
+    return Holder (counts=counts, widths=redges - ledges, ledges=ledges,
+                   redges=redges)
+
+
+def ttlayout (tstarts, tstops, times):
+    """Validate the inputs to ttbblock() and lay out its bins.
+
+    `tstarts` and `tstops` give the goodtime intervals (GTIs) and `times` the
+    sorted event times. Returns a Holder with the validated `tstarts` and
+    `tstops`, the unique event times `utimes` and their multiplicities
+    `ucounts`, and the per-bin `counts`, `widths`, `ledges`, and `redges`.
+    The result can be passed to binbblock() in place of widths and counts,
+    and reused (e.g. for bootstrapping) without revalidating anything.
+
+    Events are assigned to GTIs with a single searchsorted(), so this is
+    O(N log ngti) rather than O(N * ngti)."""
+
+    tstarts = np.asarray (tstarts, dtype=np.float)
+    tstops = np.asarray (tstops, dtype=np.float)
     times = np.asarray (times)
 
     if tstarts.size != tstops.size:
@@ -196,68 +467,80 @@ def ttbblock (tstarts, tstops, times, p0=0.05):
         raise ValueError ('no times may be smaller than first tstart')
     if times.max () > tstops[-1]:
         raise ValueError ('no times may be larger than last tstop')
-    for i in xrange (1, ngti):
-        if np.where ((times > tstops[i-1]) & (times < tstarts[i]))[0].size:
-            raise ValueError ('no times may fall in goodtime gap #%d' % i)
-    if p0 < 0 or p0 >= 1.:
-        raise ValueError ('p0 must lie within [0, 1)')
 
-    utimes, uidxs = np.unique (times, return_index=True)
-    nunique = utimes.size
+    # Since the times are sorted, we can find the unique ones without
+    # np.unique()'s sort.
+    isnew = np.empty (times.size, dtype=np.bool)
+    isnew[0] = True
+    np.not_equal (times[1:], times[:-1], out=isnew[1:])
+    uidxs = np.flatnonzero (isnew)
+    utimes = times[uidxs].astype (np.float)
+    ucounts = np.diff (np.append (uidxs, times.size)).astype (np.float)
 
-    counts = np.empty (nunique)
-    counts[:-1] = uidxs[1:] - uidxs[:-1]
-    counts[-1] = times.size - uidxs[-1]
-    assert counts.sum () == times.size
+    gidx = np.searchsorted (tstarts, utimes, side='right') - 1
+    bad = np.flatnonzero (utimes > tstops[gidx])
+    if bad.size:
+        raise ValueError ('no times may fall in goodtime gap #%d'
+                          % (gidx[bad[0]] + 1))
 
-    # we grow these arrays with concats, which will perform badly with lots of
-    # GTIs. Not expected to be a big deal.
-    widths = np.empty (0)
-    ledges = np.empty (0)
-    redges = np.empty (0)
+    layout = _ttcells (tstarts, tstops, utimes, ucounts)
+    layout.set (tstarts=tstarts, tstops=tstops, utimes=utimes, ucounts=ucounts)
+    return layout
 
-    for i in xrange (ngti):
-        tstart, tstop = tstarts[i], tstops[i]
 
-        w = np.where ((utimes >= tstart) & (utimes <= tstop))[0]
+def _block_redges (redges, blockstarts):
+    # The right edge of the i'th block is the right edge of its rightmost
+    # bin, which is the bin before the leftmost bin of the (i+1)'th block:
+    return np.concatenate ((redges[blockstarts[1:] - 1], [redges[-1]]))
 
-        if not w.size:
-            # No events during this goodtime! We have to insert a zero-count
-            # event block. This may break assumptions within binbblock()?
 
-            # j = idx of first event after this GTI
-            wafter = np.where (utimes > tstop)[0]
-            if wafter.size:
-                j = wafter[0]
-            else:
-                j = utimes.size
-            assert i == 0 or np.where (utimes < tstart)[0][-1] == j - 1
+def ttbblock (tstarts, tstops, times, p0=0.05):
+    return binbblock (ttlayout (tstarts, tstops, times), p0=p0)
 
-            counts = np.concatenate ((counts[:j], [0], counts[j:]))
-            widths = np.concatenate ((widths, [tstop - tstart]))
-            ledges = np.concatenate ((ledges, [tstart]))
-            redges = np.concatenate ((redges, [tstop]))
-        else:
-            gtutimes = utimes[w]
-            midpoints = 0.5 * (gtutimes[1:] + gtutimes[:-1]) # size: n - 1
-            gtedges = np.concatenate (([tstart], midpoints, [tstop])) # size: n + 1
-            gtwidths = gtedges[1:] - gtedges[:-1] # size: n
-            assert gtwidths.sum () == tstop - tstart
-            widths = np.concatenate ((widths, gtwidths))
-            ledges = np.concatenate ((ledges, gtedges[:-1]))
-            redges = np.concatenate ((redges, gtedges[1:]))
-
-    assert counts.size == widths.size
-    info = binbblock (widths, counts, p0=p0)
-    info.ledges = ledges[info.blockstarts]
-    # The right edge of the i'th block is the right edge of its rightmost
-    # bin, which is the bin before the leftmost bin of the (i+1)'th block:
-    info.redges = np.concatenate ((redges[info.blockstarts[1:] - 1], [redges[-1]]))
-    info.midpoints = 0.5 * (info.ledges + info.redges)
-    return info
 
+def _bootstrap_cells (data_list):
+    """Run a batch of bootstrap replicates for bsttbblock(). `data_list` is
+    (tstarts, tstops, utimes, ucounts, midpoints, p0, seeds); returns an array
+    of the resampled rates at `midpoints`, one row per seed.
+
+    Rather than resampling and re-sorting the event list, we draw
+    multinomial counts onto the existing unique event times. This is the
+    same distribution of resampled events, but the inputs were validated and
+    uniqued once, up front, and the bins for each replicate are built by
+    _ttcells() without any sorting."""
+
+    (tstarts, tstops, utimes, ucounts, midpoints, p0, seeds) = data_list
+    np.seterr ('raise')
+    ntot = int (ucounts.sum ())
+    probs = ucounts / ucounts.sum ()
+    samprates = np.empty ((len (seeds), midpoints.size))
+
+    for i, seed in enumerate (seeds):
+        rs = np.random.RandomState (seed)
+        bscounts = rs.multinomial (ntot, probs)
+        present = bscounts > 0
+        cells = _ttcells (tstarts, tstops, utimes[present],
+                          bscounts[present].astype (np.float))
+        bsinfo = binbblock (cells, p0=p0)
+        blocknums = np.minimum (np.searchsorted (bsinfo.redges, midpoints),
+                                bsinfo.nblocks - 1)
+        samprates[i] = bsinfo.rates[blocknums]
+
+    return samprates
+
+
+def bsttbblock (times, tstarts, tstops, p0=0.05, nbootstrap=512,
+                method='cells', nprocesses=1, seed=None):
+    """Bayesian Blocks analysis of time-tagged events, with bootstrap
+    uncertainties on the block rates.
+
+    `method` chooses how replicates are drawn: 'cells' (the default) draws
+    multinomial counts onto the unique event times of the original data and
+    can use `nprocesses` worker processes; 'events' resamples the event list
+    and reruns ttbblock() from scratch, serially. `seed` (int, RandomState,
+    or None for the global numpy.random state) makes the 'cells' replicates
+    reproducible independent of `nprocesses`."""
 
-def bsttbblock (times, tstarts, tstops, p0=0.05, nbootstrap=512):
     np.seterr ('raise')
     times = np.asarray (times)
     tstarts = np.asarray (tstarts)
@@ -266,24 +549,56 @@ def bsttbblock (times, tstarts, tstops, p0=0.05, nbootstrap=512):
     nevents = times.size
     if nevents < 1:
         raise ValueError ('must be given at least 1 event')
+    if method not in ('cells', 'events'):
+        raise ValueError ('method must be "cells" or "events"')
+    if nprocesses < 1:
+        raise ValueError ('nprocesses must be at least 1')
 
-    info = ttbblock (tstarts, tstops, times, p0)
+    layout = ttlayout (tstarts, tstops, times)
+    info = binbblock (layout, p0=p0)
 
     # Now bootstrap resample to assess uncertainties on the bin heights. This
     # is the approach recommended by Scargle+.
 
-    bsrsums = np.zeros (info.nblocks)
-    bsrsumsqs = np.zeros (info.nblocks)
+    if method == 'events':
+        bsrsums = np.zeros (info.nblocks)
+        bsrsumsqs = np.zeros (info.nblocks)
+
+        for _ in xrange (nbootstrap):
+            bstimes = times[np.random.randint (0, times.size, times.size)]
+            bstimes.sort ()
+            bsinfo = ttbblock (tstarts, tstops, bstimes, p0)
+            blocknums = np.minimum (np.searchsorted (bsinfo.redges, info.midpoints),
+                                    bsinfo.nblocks - 1)
+            samprates = bsinfo.rates[blocknums]
+            bsrsums += samprates
+            bsrsumsqs += samprates**2
+    else:
+        if seed is None:
+            rs = np.random
+        elif isinstance (seed, np.random.RandomState):
+            rs = seed
+        else:
+            rs = np.random.RandomState (seed)
 
-    for _ in xrange (nbootstrap):
-        bstimes = times[np.random.randint (0, times.size, times.size)]
-        bstimes.sort ()
-        bsinfo = ttbblock (tstarts, tstops, bstimes, p0)
-        blocknums = np.minimum (np.searchsorted (bsinfo.redges, info.midpoints),
-                                bsinfo.nblocks - 1)
-        samprates = bsinfo.rates[blocknums]
-        bsrsums += samprates
-        bsrsumsqs += samprates**2
+        seeds = rs.randint (0, 2**31 - 1, size=nbootstrap)
+        args = [(layout.tstarts, layout.tstops, layout.utimes, layout.ucounts,
+                 info.midpoints, p0, batch)
+                for batch in np.array_split (seeds, max (min (nprocesses, nbootstrap), 1))]
+
+        if nprocesses == 1:
+            results = map (_bootstrap_cells, args)
+        else:
+            pool = Pool (nprocesses)
+            try:
+                results = pool.map (_bootstrap_cells, args)
+            finally:
+                pool.terminate ()
+                pool.join ()
+
+        samprates = np.concatenate (results)
+        bsrsums = samprates.sum (axis=0)
+        bsrsumsqs = (samprates**2).sum (axis=0)
 
     bsrmeans = bsrsums / nbootstrap
     mask = bsrsumsqs / nbootstrap <= bsrmeans**2